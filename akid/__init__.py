@@ -8,6 +8,9 @@ import inspect
 from akid.ops import image_ops as image
 
 from akid.core.sources import *
+if sys.version_info[0] > 2:
+    # Remote sources rely on asyncio.
+    from akid.core.remote_sources import *
 from akid import datasets
 from akid.datasets import *
 from akid.core.kids import *
@@ -175,7 +175,7 @@ def restore(path):
     tensor_by_name = th.load(path + "/checkpoint")
     cg.set_step(tensor_by_name.pop('step'))
     # Put the name back. Seems torch's save does not save additional names
-    for k in tensor_by_name:
+    for k in list(tensor_by_name.keys()):
         # Remove GPU device id if using CPU
         if not cg.use_cuda():
             if is_variable(tensor_by_name[k]):
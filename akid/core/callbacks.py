@@ -8,6 +8,7 @@ from __future__ import absolute_import
 from akid import backend as A
 import akid as K
 from akid import ops
+from .sensors import Sensor
 
 from ..utils import glog as log
 from ..utils.tools import is_tuple_or_list
@@ -71,6 +72,11 @@ def on_train_log_step(kid):
 
     _do_summary(kid)
 
+    if kid.do_summary and isinstance(kid.sensor, Sensor):
+        # Metrics of the data pipeline over the logging interval.
+        kid.sensor.metrics.summarize(kid.sensor.name, step)
+        kid.sensor.metrics.reset()
+
     if kid.do_batch_monitoring:
         kid.batch_monitoring(kid.cached_data)
 
@@ -9,6 +9,8 @@ import sys
 import inspect
 
 import tensorflow as tf
+import torch as th
+import torch.nn.functional as F
 
 from .blocks import ShadowableBlock
 from .systems import SequentialSystem
@@ -213,5 +215,130 @@ class ResizeJoker(Joker):
         return self._data
 
 
+class BatchCropJoker(Joker):
+    def __init__(self, height, width, padding=0, center=False, **kwargs):
+        """
+        A `Joker` that crops a region of `height` and `width` from each image
+        of a NCHW batch of the PyTorch backend, at an offset drawn for each
+        image.
+
+        Args:
+            padding: int
+                The number of zeros to pad each side of images with before
+                cropping.
+            center: Boolean
+                If True, crop the center of images instead.
+        """
+        super(BatchCropJoker, self).__init__(**kwargs)
+        self.height = height
+        self.width = width
+        self.padding = padding
+        self.center = center
+
+    def _forward(self, data_in):
+        data = data_in
+        if self.padding > 0:
+            p = self.padding
+            data = F.pad(data, (p, p, p, p))
+        N, C, H, W = data.shape
+        if H < self.height or W < self.width:
+            raise ValueError("Cannot crop {}x{} from images of {}x{}.".format(
+                self.height, self.width, H, W))
+
+        if self.center:
+            self.log("Center crop images.")
+            top, left = (H - self.height) // 2, (W - self.width) // 2
+            self._data = data[..., top:top+self.height, left:left+self.width]
+            return self._data
+
+        self.log("Randomly crop images.")
+        device = data.device
+        top = th.randint(0, H - self.height + 1, (N, 1), device=device)
+        left = th.randint(0, W - self.width + 1, (N, 1), device=device)
+        rows = top + th.arange(self.height, device=device)
+        cols = left + th.arange(self.width, device=device)
+        # Gather crops of all images at once by advanced indexing.
+        self._data = data[th.arange(N, device=device)[:, None, None, None],
+                          th.arange(C, device=device)[None, :, None, None],
+                          rows[:, None, :, None],
+                          cols[:, None, None, :]]
+
+        return self._data
+
+
+class BatchFlipJoker(Joker):
+    def __init__(self, flip_left_right=True, prob=0.5, **kwargs):
+        """
+        A `Joker` that flips each image of a NCHW batch of the PyTorch backend
+        with probability `prob`.
+
+        Args:
+            flip_left_right: Boolean
+                If True, do randomly horizontal flipping, otherwise, do
+                vertical flipping.
+        """
+        super(BatchFlipJoker, self).__init__(**kwargs)
+        self.flip_left_right = flip_left_right
+        self.prob = prob
+
+    def _forward(self, data_in):
+        if self.flip_left_right:
+            self.log("Randomly flip image left right.")
+            flipped = data_in.flip(-1)
+        else:
+            self.log("Randomly flip image up down.")
+            flipped = data_in.flip(-2)
+        mask = th.rand(data_in.shape[0], device=data_in.device) < self.prob
+        self._data = th.where(mask[:, None, None, None], flipped, data_in)
+
+        return self._data
+
+
+class BatchLightJoker(Joker):
+    def __init__(self,
+                 contrast=True, brightness=True,
+                 lower=0.2, upper=1.8, max_delta=63,
+                 **kwargs):
+        """
+        A `Joker` that randomly adjusts contrast and brightness of each image
+        of a NCHW batch of the PyTorch backend, as `LightJoker` does.
+
+        Args:
+            contrast: Boolean
+                If True, randomly scale the deviation of each channel from its
+                mean by a factor in [`lower`, `upper`].
+            brightness: Boolean
+                If True, randomly add a delta in [-`max_delta`, `max_delta`].
+                It is in the scale of pixel values, e.g., [0, 255] for uint8
+                images.
+        """
+        super(BatchLightJoker, self).__init__(**kwargs)
+        self.contrast = contrast
+        self.brightness = brightness
+        self.lower = lower
+        self.upper = upper
+        self.max_delta = max_delta
+
+    def _forward(self, data_in):
+        data = data_in.float()
+        N, device = data.shape[0], data.device
+        if self.contrast:
+            self.log("Randomly change contrast.")
+            factor = th.empty(N, 1, 1, 1, device=device).uniform_(self.lower, self.upper)
+            mean = data.mean(dim=(2, 3), keepdim=True)
+            data = (data - mean) * factor + mean
+        if self.brightness:
+            self.log("Randomly change brightness.")
+            delta = th.empty(N, 1, 1, 1, device=device).uniform_(
+                -self.max_delta, self.max_delta)
+            data = data + delta
+        if data_in.dtype == th.uint8:
+            data = data.round_().clamp_(0, 255).to(th.uint8)
+
+        self._data = data
+
+        return self._data
+
+
 __all__ = [name for name, x in locals().items() if
            not inspect.ismodule(x) and not inspect.isabstract(x)]
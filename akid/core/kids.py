@@ -7,6 +7,7 @@ import os
 import time
 import sys
 import inspect
+import numpy as np
 from tqdm import tqdm
 import akid as K
 
@@ -95,6 +96,7 @@ class Kid(Block):
                  do_summary_on_val=False,
                  skip_validation=False,
                  do_batch_monitoring=False,
+                 lazy_eval=False,
                  debug=False):
         """
         Assemble a sensor, a brain, and a KongFu to start the survival game.
@@ -126,7 +128,9 @@ class Kid(Block):
             max_steps: int
             max_epoch: int
                 You can only specify either max epoch to train or max
-                steps. Not both.
+                steps. Not both. If the number of batches of an epoch is
+                unknown, e.g., for a `StreamingSensor` whose source does not
+                tell its size, epochs are counted by the sensor instead.
             log_dir: str
                 The folder to hold tensorboard event, training logs and trained
                 models. If not given, first a folder named `log` will be
@@ -170,6 +174,16 @@ class Kid(Block):
                 to manually add summary ops when building the network to the
                 collection `BATCH_MONITORING_COLLECTION`, otherwise, nothing
                 would be done.
+            lazy_eval: bool
+                If True, the loss and evaluation metrics of training steps are
+                not pulled to the host each step, which waits for the device.
+                Instead, they are summed on the device, and their means over
+                the steps since the last training log are pulled at
+                `train_log_step`. Thus `loss` and `evals` of the kid are only
+                updated then during training, and the training log gets the
+                means instead of the values of the last step, as it does when
+                False. In debug mode, each step is still pulled to be printed.
+                Only for the torch backend.
             Other args are self-evident.
         """
         self.sensor = sensor_in
@@ -204,8 +218,13 @@ class Kid(Block):
         self.do_summary = do_summary
         self.save_chk_point = save_chk_point
         self.continue_from_chk_point = continue_from_chk_point
+        # The state of the sensor restored from a checkpoint.
+        self.sensor_state = None
         self.skip_validation = skip_validation
         self.do_batch_monitoring = do_batch_monitoring
+        self.lazy_eval = lazy_eval
+        # Running sums of the loss and evals of training steps, on the device.
+        self._running_evals = None
 
         # Log training dynamics
         self.loss_data_train = []
@@ -298,12 +317,17 @@ class Kid(Block):
             verbose_eval_blocks = None
         loss_block = BatchEvalBlock()
         steps_per_epoch = self.sensor.num_batches_per_epoch
+        if steps_per_epoch is None:
+            # The epoch ends when the sensor stops iterating.
+            batches = tqdm(self.sensor)
+        else:
+            batches = (None for step in tqdm(list(range(1, steps_per_epoch+1))))
 
-        for step in tqdm(list(range(1, steps_per_epoch+1))):
+        for data in batches:
             if verbose_eval_blocks is None:
-                loss, evals = self.run_step(update=False, val=True)
+                loss, evals = self.run_step(update=False, val=True, data=data)
             else:
-                loss, evals, verbose_evals = self.run_step(update=False, val=True)
+                loss, evals, verbose_evals = self.run_step(update=False, val=True, data=data)
 
             loss_block.add(loss)
             for i, v in enumerate(evals):
@@ -369,6 +393,12 @@ class Kid(Block):
         A.restore(self.model_dir)
         if A.backend() ==  A.TORCH and not self.inference_mode:
             self.kongfu.set_lr(A.retrieve_tensor('lr'))
+            # The position of the sensor is restored when training starts,
+            # since the sensor is reset then.
+            try:
+                self.sensor_state = A.retrieve_tensor('sensor_state')
+            except KeyError:
+                self.sensor_state = None
 
     def batch_monitoring(self, data):
         """
@@ -415,16 +445,25 @@ class Kid(Block):
         self.sensor.set_mode("train")
         self.sensor.setup()
         self.log("A epoch of training set contains {} batches".format(self.sensor.num_batches_per_epoch))
-        self.epoch = A.get_step() // self.sensor.num_batches_per_epoch
+        if self.sensor.num_batches_per_epoch is not None:
+            self.epoch = A.get_step() // self.sensor.num_batches_per_epoch
 
         self.init()
         self.on_train_begin()
         # Reset sensor, so to prevent any code from using some training batches
         # in advance, and making them missing from initial training.
         self.sensor.reset()
+        if self.sensor_state is not None:
+            # Continue the epoch in progress when the checkpoint is saved.
+            self.sensor.load_state_dict(self.sensor_state)
+            self.sensor_state = None
+        if self.sensor.num_batches_per_epoch is None:
+            self.epoch = self.sensor.epoch
 
         val_loss, val_evals = None, None
-        while A.get_step() < self.max_steps:
+        self._running_evals = None
+        while self.max_steps is None and self.epoch < self.max_epoch \
+              or self.max_steps is not None and A.get_step() < self.max_steps:
             try:
                 val_loss, val_evals = self.step_with_logistics()
             except EarlyStoppingEvent as e:
@@ -463,16 +502,24 @@ class Kid(Block):
         start_time = time.time()
 
         self.on_batch_begin()
-        self.loss, self.evals = self.run_step()
-
-        if self.debug:
-            print("Loss: {}; Eval: {}".format(self.loss, self.evals))
+        lazy_eval = self.lazy_eval and A.backend() == A.TORCH
+        if lazy_eval:
+            loss, evals, _ = self.step()
+            self._accumulate_evals(loss, evals)
+            if self.debug:
+                print("Loss: {}; Eval: {}".format(A.eval(loss), A.eval(evals)))
+        else:
+            self.loss, self.evals = self.run_step()
+            if self.debug:
+                print("Loss: {}; Eval: {}".format(self.loss, self.evals))
 
         self.step_time = time.time() - start_time
 
         A.step()
 
         if A.get_step() % self.train_log_step == 0:
+            if lazy_eval:
+                self.loss, self.evals = self._pull_evals()
             # Since during logging, loss and evals are passed in as attributes
             # of Kid, training log is put ahead of validation log to prevent
             # validation loss and evals from overriding the ones of training,
@@ -492,11 +539,10 @@ class Kid(Block):
             self.sensor.set_mode("train")
             self.sensor.setup()
 
-        if A.get_step() % self.sensor.num_batches_per_epoch is 0:
+        if self._epoch_ended():
             self.epoch += 1
             self.on_epoch_end()
-            if self.log_by_epoch \
-               and A.get_step() % (self.sensor.num_batches_per_epoch * self.num_epoch_per_log) == 0:
+            if self.log_by_epoch and self.epoch % self.num_epoch_per_log == 0:
                 if self.save_chk_point:
                     self.save_to_ckpt()
                 if not self.skip_validation:
@@ -538,6 +584,48 @@ class Kid(Block):
             else:
                 return loss, evals
 
+    def _epoch_ended(self):
+        """
+        Whether the step just taken ends an epoch. If the number of batches
+        of an epoch is unknown, it is when the sensor moves on to the next
+        epoch, which it may only know some batches after the last one of the
+        epoch is taken.
+        """
+        num_batches = self.sensor.num_batches_per_epoch
+        if num_batches is not None:
+            return A.get_step() % num_batches == 0
+        return self.sensor.epoch > self.epoch
+
+    def _accumulate_evals(self, loss, evals):
+        """
+        Add the loss and evals of a training step to the running sums. Sums
+        of tensors stay on the device. Values that are neither tensors nor
+        numbers, e.g., named tuples of evals, are kept as the latest ones.
+        """
+        values = [loss] + list(evals)
+        if self._running_evals is None:
+            self._running_evals = [None] * len(values)
+        for i, v in enumerate(values):
+            if A.is_tensor(v) or isinstance(v, (np.ndarray, np.number, float, int)):
+                if not isinstance(self._running_evals[i], BatchEvalBlock):
+                    self._running_evals[i] = BatchEvalBlock()
+                # Detach, so the graph of the step is not kept.
+                self._running_evals[i].add(v.detach() if A.is_tensor(v) else v)
+            else:
+                self._running_evals[i] = v
+
+    def _pull_evals(self):
+        """
+        Pull the means of the accumulated loss and evals to the host, and
+        start over.
+        """
+        values = [v.data if isinstance(v, BatchEvalBlock) else v
+                  for v in self._running_evals]
+        if A.backend() == A.TORCH:
+            values = A.eval(values)
+        self._running_evals = None
+        return values[0], values[1:]
+
     def step(self, update=True, val=False, data=None):
         """
         Computational graph wise, how the tensor should be run in a step.
@@ -617,6 +705,9 @@ class Kid(Block):
         # phase, so it should be saved.
         if A.backend() == A.TORCH:
             A.cache_tensor(self.kongfu.get_lr(), 'lr')
+            # So training resumes from the batch after the last one.
+            if isinstance(self.sensor, sensors.Sensor) and self.sensor.mode == A.Mode.TRAIN:
+                A.cache_tensor(self.sensor.state_dict(), 'sensor_state')
         A.save(self.model_dir)
         self.log("Checkpoint at step {} saved to folder:"
                  " {}".format(A.get_step(), self.model_dir))
@@ -666,7 +757,7 @@ class Kid(Block):
             func(self)
 
     def on_train_begin(self):
-        if self.max_epoch:
+        if self.max_epoch and self.sensor.num_batches_per_epoch is not None:
             # Convert the max epoch number to max steps.
             self.max_steps \
                 = self.sensor.num_batches_per_epoch * self.max_epoch
@@ -0,0 +1,395 @@
+"""
+Sources whose data live on a remote object store, which is read over HTTP
+with range requests. For example, to read records written by
+`write_records` and uploaded to a server::
+
+    source = RemoteRecordSource(train_records="http://store:8000/mnist/train",
+                                cache_dir="/tmp/mnist_cache",
+                                name="source")
+
+Reads are done with `asyncio`, so records of a batch are fetched
+concurrently over a pool of connections kept alive. Each process, e.g., a
+worker of `ParallelSensor`, runs an event loop and a pool of its own.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import json
+import os
+import threading
+
+import numpy as np
+from six.moves.urllib.parse import urlsplit
+
+from .sources import RecordSource, _decode_record, _parse_fields
+
+
+class _ConnectionPool(object):
+    """
+    At most `size` connections to a server, which are reused across
+    requests. Connections are made when asked for, and dropped if a request
+    on it fails, or the server does not keep it alive.
+    """
+    def __init__(self, host, port, ssl=False, size=8):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.size = size
+        self._idle = []
+        # Made in the running loop.
+        self._semaphore = None
+
+    async def acquire(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        await self._semaphore.acquire()
+        while len(self._idle) > 0:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        try:
+            return await asyncio.open_connection(self.host, self.port, ssl=self.ssl or None)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def release(self, connection, reuse=True):
+        if reuse:
+            self._idle.append(connection)
+        else:
+            connection[1].close()
+        self._semaphore.release()
+
+    async def close(self):
+        """
+        Close idle connections. Connections in use are closed when released.
+        """
+        writers = [writer for _, writer in self._idle]
+        self._idle = []
+        for writer in writers:
+            writer.close()
+        await asyncio.gather(*[writer.wait_closed() for writer in writers],
+                             return_exceptions=True)
+
+
+class BlockCache(object):
+    """
+    An on-disk read-through cache of blocks of remote files. Each block is
+    saved as a file under `cache_dir`, which is written to a temporary name
+    and renamed, so processes could share the cache.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _path(self, name, block):
+        return os.path.join(self.cache_dir, name.replace("/", "%2F"), "{}.blk".format(block))
+
+    def get(self, name, block):
+        path = self._path(name, block)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def put(self, name, block, data):
+        path = self._path(name, block)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Made by another process.
+                pass
+        tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+
+class RemoteRecordSource(RecordSource):
+    """
+    A source of records written by `write_records`, which are served by an
+    HTTP server that supports range requests, e.g., an object store.
+
+    The meta file and the offsets of records are read upon setup. Shards are
+    read by blocks of `block_size` bytes: to get a batch, the blocks holding
+    its records are decided, blocks that are not cached are fetched, where
+    contiguous ones are fetched by one request, and all requests are sent
+    concurrently. If `cache_dir` is given, blocks are saved there, and read
+    from there afterwards.
+
+    A request not answered in `hedge_after` seconds is sent again over
+    another connection, and the first answer is taken, so a slow read does
+    not stall the batch.
+    """
+    def __init__(self,
+                 cache_dir=None,
+                 block_size=1 << 20,
+                 num_connections=8,
+                 hedge_after=None,
+                 timeout=30,
+                 num_retries=2,
+                 **kwargs):
+        """
+        Args:
+            train_records, val_records, test_records: str
+                The URL of the prefix of records of each mode given to
+                `write_records`.
+            cache_dir: str
+                The directory to cache blocks read.
+            block_size: int
+                The number of bytes of a block.
+            num_connections: int
+                The largest number of connections to the server of each
+                process.
+            hedge_after: float
+                The seconds to wait before sending a request again. Requests
+                are not hedged if it is None.
+            timeout: float
+                The seconds to wait for a request before it fails.
+            num_retries: int
+                The number of times to retry a request that fails.
+        """
+        super(RemoteRecordSource, self).__init__(**kwargs)
+        self.cache = None if cache_dir is None else BlockCache(cache_dir)
+        self.block_size = block_size
+        self.num_connections = num_connections
+        self.hedge_after = hedge_after
+        self.timeout = timeout
+        self.num_retries = num_retries
+        # Event loops and pools by process, thread and mode.
+        self._loops = {}
+
+    def _state(self):
+        """
+        Return the event loop of the current thread, and the pool of
+        connections.
+        """
+        key = (os.getpid(), threading.current_thread().ident, self.mode)
+        if key not in self._loops:
+            # Loops and connections are not shared with the parent process,
+            # or other threads. Modes may be served by different servers.
+            url = urlsplit(self._prefix_dict[self.mode])
+            ssl = url.scheme == "https"
+            pool = _ConnectionPool(url.hostname,
+                                   url.port or (443 if ssl else 80),
+                                   ssl,
+                                   self.num_connections)
+            self._loops[key] = (asyncio.new_event_loop(), pool)
+        return self._loops[key]
+
+    def teardown(self):
+        """
+        Close the pools and event loops of this process. Those of other
+        processes, which are inherited through forking, are dropped, since
+        they are owned by their processes.
+        """
+        for key, (loop, pool) in list(self._loops.items()):
+            if key[0] == os.getpid():
+                loop.run_until_complete(pool.close())
+                loop.close()
+        self._loops = {}
+
+    def set_mode(self, mode):
+        # The loops and pools of the old mode are not used anymore.
+        self.teardown()
+        super(RemoteRecordSource, self).set_mode(mode)
+
+    def _run(self, coroutine):
+        """
+        Run `coroutine` to completion in the event loop of the current thread.
+        """
+        return self._state()[0].run_until_complete(coroutine)
+
+    async def _request(self, path, start=None, end=None):
+        """
+        Return the bytes in `[start, end)` of the file of `path`, or the whole
+        file if `start` is None.
+        """
+        url = urlsplit(self._prefix_dict[self.mode])
+        pool = self._state()[1]
+        connection = await pool.acquire()
+        reuse = False
+        try:
+            reader, writer = connection
+            request = "GET {} HTTP/1.1\r\nHost: {}\r\n".format(path, url.netloc)
+            if start is not None:
+                request += "Range: bytes={}-{}\r\n".format(start, end - 1)
+            writer.write((request + "\r\n").encode("latin-1"))
+            await writer.drain()
+
+            status_line = (await reader.readline()).decode("latin-1").split()
+            if len(status_line) < 2:
+                raise IOError("Bad response reading {}.".format(path))
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if line == "":
+                    break
+                k, v = line.split(":", 1)
+                headers[k.strip().lower()] = v.strip()
+            if "content-length" not in headers:
+                raise IOError("No content length reading {}.".format(path))
+            body = await reader.readexactly(int(headers["content-length"]))
+
+            status = int(status_line[1])
+            if status not in (200, 206):
+                raise IOError("Status {} reading {}.".format(status, path))
+            reuse = status_line[0] == "HTTP/1.1" \
+                and headers.get("connection", "").lower() != "close"
+            if status == 200 and start is not None:
+                # The server ignores the range.
+                body = body[start:end]
+            return body
+        finally:
+            # A connection whose request fails, or is cancelled, may be in the
+            # middle of a response.
+            pool.release(connection, reuse)
+
+    async def _fetch(self, path, start=None, end=None):
+        """
+        The same as `_request`, but the request is hedged and retried.
+        """
+        for attempt in range(self.num_retries + 1):
+            tasks = [asyncio.ensure_future(self._request(path, start, end))]
+            try:
+                if self.hedge_after is not None:
+                    done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+                    if len(done) == 0:
+                        tasks.append(asyncio.ensure_future(self._request(path, start, end)))
+                error = None
+                while len(tasks) > 0:
+                    done, _ = await asyncio.wait(tasks,
+                                                 timeout=self.timeout,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    if len(done) == 0:
+                        error = IOError("Timeout reading {}.".format(path))
+                        break
+                    for t in done:
+                        tasks.remove(t)
+                        if t.exception() is None:
+                            return t.result()
+                        error = t.exception()
+            finally:
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            if attempt == self.num_retries:
+                raise error
+
+    def _path(self, name):
+        return os.path.join(os.path.dirname(urlsplit(self._prefix_dict[self.mode]).path), name)
+
+    async def _read_file(self, name):
+        """
+        Return the whole remote file `name` relative to the prefix, through
+        the cache.
+        """
+        data = None if self.cache is None else self.cache.get(name, "file")
+        if data is None:
+            data = await self._fetch(self._path(name))
+            if self.cache is not None:
+                self.cache.put(name, "file", data)
+        return data
+
+    async def _fetch_blocks(self, shard, blocks):
+        """
+        Fetch contiguous `blocks` of the data file of `shard` by one request,
+        and cache them.
+        """
+        size = self._offsets[shard][-1]
+        start = blocks[0] * self.block_size
+        end = min((blocks[-1] + 1) * self.block_size, size)
+        data = await self._fetch(self._path(shard + ".rec"), start, end)
+        ret = {}
+        for b in blocks:
+            ret[b] = data[b * self.block_size - start:(b + 1) * self.block_size - start]
+            if self.cache is not None:
+                self.cache.put(shard + ".rec", b, ret[b])
+        return ret
+
+    async def _read_blocks(self, needed):
+        """
+        Return blocks in `needed`, a set of tuples `(shard, block)`, as a dict
+        from the tuples to their bytes.
+        """
+        blocks = {}
+        missing = []
+        for key in sorted(needed):
+            data = None if self.cache is None else self.cache.get(key[0] + ".rec", key[1])
+            if data is not None:
+                blocks[key] = data
+            else:
+                missing.append(key)
+
+        # Coalesce contiguous blocks of a shard into one request.
+        runs = []
+        for shard, b in missing:
+            if len(runs) > 0 and runs[-1][0] == shard and runs[-1][1][-1] == b - 1:
+                runs[-1][1].append(b)
+            else:
+                runs.append((shard, [b]))
+        # Wait for all requests, so that none is left running, or with its
+        # error never retrieved, when one fails.
+        results = await asyncio.gather(*[self._fetch_blocks(shard, run) for shard, run in runs],
+                                       return_exceptions=True)
+        for (shard, _), ret in zip(runs, results):
+            if isinstance(ret, BaseException):
+                raise ret
+            for b, data in ret.items():
+                blocks[(shard, b)] = data
+        return blocks
+
+    async def _read_records(self, shard_ids, indices):
+        """
+        Return the records of local `indices` of shards of `shard_ids`.
+        """
+        spans = []
+        needed = set()
+        for s, i in zip(shard_ids, indices):
+            shard = self._shards[s]
+            start, end = self._offsets[shard][i], self._offsets[shard][i + 1]
+            spans.append((shard, start, end))
+            for b in range(start // self.block_size, (end - 1) // self.block_size + 1):
+                needed.add((shard, b))
+        blocks = await self._read_blocks(needed)
+
+        samples = []
+        for shard, start, end in spans:
+            chunks = []
+            for b in range(start // self.block_size, (end - 1) // self.block_size + 1):
+                offset = b * self.block_size
+                chunks.append(blocks[(shard, b)][max(start - offset, 0):end - offset])
+            buf = np.frombuffer(b"".join(chunks), dtype=np.uint8)
+            samples.append(_decode_record(buf, self.fields))
+        return samples
+
+    def _setup(self):
+        prefix = self._prefix_dict[self.mode]
+        if prefix is None:
+            raise ValueError("No records are provided for mode {}.".format(self.mode))
+        name = os.path.basename(urlsplit(prefix).path)
+        meta = json.loads(self._run(self._read_file(name + ".json")).decode("utf-8"))
+        self.fields = _parse_fields(meta["fields"])
+        self._shards = [n for n, _ in meta["shards"]]
+        self._starts = np.cumsum([0] + [n for _, n in meta["shards"]])
+
+        async def read_offsets():
+            data = await asyncio.gather(*[self._read_file(s + ".idx") for s in self._shards])
+            return dict((s, np.frombuffer(d, dtype="<i8")) for s, d in zip(self._shards, data))
+        self._offsets = self._run(read_offsets())
+
+    def _read(self, shard, chunk_size=256):
+        s = self._shards.index(shard)
+        num_records = len(self._offsets[shard]) - 1
+        for start in range(0, num_records, chunk_size):
+            indices = list(range(start, min(start + chunk_size, num_records)))
+            for sample in self._run(self._read_records([s] * len(indices), indices)):
+                yield sample
+
+    def _get(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_ids = np.searchsorted(self._starts, indices, side="right") - 1
+        return self.collate(self._run(self._read_records(shard_ids, indices - self._starts[shard_ids])))
+
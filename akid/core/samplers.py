@@ -5,7 +5,7 @@ from __future__ import print_function
 from __future__ import absolute_import
 from six import raise_from
 
-import random
+import numpy as np
 
 from ..utils import glog as log
 from .events import EpochCompletedEvent
@@ -58,15 +58,70 @@ class Sampler(object):
     """
     Given a list of indices, a `Sampler` provides a function `next` to return
     the next batch of indices in a certain order.
+
+    Indices are held in a numpy array, and batches are views of it, so they
+    are cheap to make and to pickle. An array of indices is never modified
+    once batches are taken from it, since batches may still be waiting in
+    queues to be sent.
     """
-    def __init__(self, length, *args, **kwargs):
+    def __init__(self, length, seed=None, *args, **kwargs):
+        """
+        Args:
+            length: int
+                The number of samples to sample from.
+            seed: int
+                The seed of the random number generator used by the
+                sampler, so the sequence of batches is reproducible. If None,
+                a seed is drawn from the system.
+        """
         super(Sampler, self).__init__(*args, **kwargs)
-        self.indices = list(range(length))
+        self.length = length
+        self.dtype = np.int32 if length <= np.iinfo(np.int32).max else np.int64
+        self.rng = np.random.default_rng(seed)
+        # The state of the generator when the epoch in progress is laid out.
+        self._rng_state = self.rng.bit_generator.state
+        self.indices = np.arange(length, dtype=self.dtype)
         self.current_idx = 0
 
+    @property
+    def num_samples(self):
+        """
+        The number of samples drawn in an epoch.
+        """
+        return len(self.indices)
+
+    def num_batches(self, batch_size):
+        """
+        The number of batches in an epoch, given the size of batches asked
+        for.
+        """
+        return (self.num_samples - 1) // batch_size + 1
+
     def reset(self):
         self.current_idx = 0
 
+    def state_dict(self):
+        """
+        Return the state of the sampler, from which the epoch in progress is
+        resumed exactly by `load_state_dict`. Indices are not saved, but the
+        state of the random number generator they are drawn with.
+        """
+        return {"current_idx": int(self.current_idx),
+                "rng_state": self._rng_state}
+
+    def load_state_dict(self, state):
+        self._rng_state = state["rng_state"]
+        self.rng.bit_generator.state = self._rng_state
+        self._lay_out()
+        self.current_idx = state["current_idx"]
+
+    def _lay_out(self):
+        """
+        Lay out indices of an epoch. Subclasses that draw indices randomly
+        should do it here, and record the state of the generator first.
+        """
+        pass
+
     def _check_epoch_finishes(self):
         if self.current_idx >= len(self.indices):
             self.reset()
@@ -77,12 +132,8 @@ class SequenceSampler(Sampler):
     def next(self, size=1):
         self._check_epoch_finishes()
 
-        if self.current_idx + size > len(self.indices):
-            index_batch = self.indices[self.current_idx:]
-            self.current_idx = len(self.indices)
-        else:
-            index_batch = self.indices[self.current_idx:self.current_idx+size]
-            self.current_idx += size
+        index_batch = self.indices[self.current_idx:self.current_idx+size]
+        self.current_idx = min(self.current_idx + size, len(self.indices))
 
         return index_batch
 
@@ -90,11 +141,336 @@ class SequenceSampler(Sampler):
 class ShuffleSampler(SequenceSampler):
     def __init__(self, *args, **kwargs):
         super(ShuffleSampler, self).__init__(*args, **kwargs)
-        random.shuffle(self.indices)
+        self._lay_out()
+
+    def _lay_out(self):
+        # A new permutation is made instead of shuffling in place, so batches
+        # taken before are intact.
+        self._rng_state = self.rng.bit_generator.state
+        self.indices = self.rng.permutation(self.length).astype(
+            self.dtype, copy=False)
 
     def reset(self):
         super(ShuffleSampler, self).reset()
-        random.shuffle(self.indices)
+        self._lay_out()
+
+
+class DistributedShuffleSampler(SequenceSampler):
+    """
+    Shuffle the dataset for each epoch, and sample the shard of the rank
+    `rank` among `world_size` ranks.
+
+    All ranks draw the same permutation from the shared seed and the number of
+    the epoch, so shards are disjoint without any communication. To make
+    shards of the same size, the permutation is padded by repeating its head
+    to be evenly divided, or truncated if `drop_last` is True.
+    """
+    def __init__(self, length, rank=0, world_size=1, seed=0, drop_last=False,
+                 *args, **kwargs):
+        """
+        Args:
+            rank: int
+                The rank of the process, in `[0, world_size)`.
+            world_size: int
+                The number of processes the dataset is partitioned to.
+            seed: int
+                The seed shared by all ranks.
+            drop_last: bool
+                Drop the tail of the permutation instead of padding it.
+        """
+        if world_size < 1 or rank < 0 or rank >= world_size:
+            raise ValueError("Rank {} out of world size {}.".format(rank, world_size))
+        if seed is None:
+            raise ValueError("A seed shared by all ranks is needed.")
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        super(DistributedShuffleSampler, self).__init__(length, seed, *args, **kwargs)
+        self._lay_out()
+
+    @property
+    def num_samples(self):
+        if self.drop_last:
+            return self.length // self.world_size
+        else:
+            return (self.length - 1) // self.world_size + 1
+
+    def state_dict(self):
+        state = super(DistributedShuffleSampler, self).state_dict()
+        state["seed"] = self.seed
+        state["epoch"] = self.epoch
+        return state
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        super(DistributedShuffleSampler, self).load_state_dict(state)
+
+    def _lay_out(self):
+        perm = np.random.default_rng([self.seed, self.epoch]).permutation(self.length)
+        total = self.num_samples * self.world_size
+        perm = np.resize(perm.astype(self.dtype, copy=False), total)
+        self.indices = perm[self.rank:total:self.world_size]
+
+    def reset(self):
+        super(DistributedShuffleSampler, self).reset()
+        self.epoch += 1
+        self._lay_out()
+
+
+def build_alias_table(weights):
+    """
+    Build Walker's alias table of a discrete distribution, so each draw from
+    the distribution takes O(1) time: draw a column `i` uniformly, then take
+    `i` with probability `prob[i]`, otherwise `alias[i]`.
+
+    Instead of pairing an underfull column with an overfull one at a time,
+    all underfull columns are paired in a round: each is filled by the
+    overfull column whose surplus, laid end to end, covers the end of its
+    deficit. Overfull columns that are overdrawn become underfull ones of the
+    next round.
+
+    Args:
+        weights: array like
+            Non-negative weights of the outcomes, which need not sum to one.
+    Return:
+        prob, alias: numpy.ndarray
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.ndim != 1 or len(weights) == 0:
+        raise ValueError("Weights should be a non-empty vector.")
+    if (weights < 0).any() or not weights.sum() > 0:
+        raise ValueError("Weights should be non-negative, and not all zero.")
+
+    n = len(weights)
+    p = weights * (n / weights.sum())
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = np.flatnonzero(p < 1)
+    large = np.flatnonzero(p >= 1)
+    while len(small) > 0 and len(large) > 0:
+        deficit = 1 - p[small]
+        owner = np.searchsorted(np.cumsum(p[large] - 1), np.cumsum(deficit))
+        owner = np.minimum(owner, len(large) - 1)
+        prob[small] = p[small]
+        alias[small] = large[owner]
+        p[large] -= np.bincount(owner, weights=deficit, minlength=len(large))
+        overdrawn = p[large] < 1
+        small = large[overdrawn]
+        large = large[~overdrawn]
+    # Columns left are full up to rounding errors.
+
+    return prob, alias
+
+
+class WeightedSampler(SequenceSampler):
+    """
+    Sample indices with replacement, with probabilities proportional to
+    `weights`.
+
+    Draws are made from an alias table, see `build_alias_table`. The indices of
+    an epoch are drawn when it starts, so weights set by `set_weights`, e.g.,
+    losses of samples for hard example mining, take effect from the next
+    epoch. Weights are not part of the state of the sampler, so they should
+    be set before the state is loaded.
+    """
+    def __init__(self, length, weights=None, num_samples=None, *args, **kwargs):
+        """
+        Args:
+            weights: array like
+                The weights of samples. If None, samples are drawn uniformly.
+            num_samples: int
+                The number of samples to draw in an epoch. If None, it is
+                `length`.
+        """
+        super(WeightedSampler, self).__init__(length, *args, **kwargs)
+        self._num_samples = length if num_samples is None else num_samples
+        self.set_weights(np.ones(length) if weights is None else weights)
+        self._lay_out()
+
+    @property
+    def num_samples(self):
+        return self._num_samples
+
+    def set_weights(self, weights):
+        if len(weights) != self.length:
+            raise ValueError("{} weights are given for {} samples.".format(
+                len(weights), self.length))
+        self.prob, self.alias = build_alias_table(weights)
+
+    def _lay_out(self):
+        self._rng_state = self.rng.bit_generator.state
+        column = self.rng.integers(self.length,
+                                   size=self._num_samples,
+                                   dtype=self.dtype)
+        coin = self.rng.random(self._num_samples)
+        self.indices = np.where(coin < self.prob[column],
+                                column,
+                                self.alias[column].astype(self.dtype))
+
+    def reset(self):
+        super(WeightedSampler, self).reset()
+        self._lay_out()
+
+
+class ClassBalancedSampler(WeightedSampler):
+    """
+    Sample indices with replacement, so each class is drawn equally often.
+    """
+    def __init__(self, length, labels=None, *args, **kwargs):
+        """
+        Args:
+            labels: array like
+                The class labels of samples.
+        """
+        if labels is None:
+            raise ValueError("Labels of samples are needed.")
+        labels = np.asarray(labels)
+        _, label_ids, counts = np.unique(labels,
+                                         return_inverse=True,
+                                         return_counts=True)
+        weights = 1. / counts[label_ids.reshape(-1)]
+        super(ClassBalancedSampler, self).__init__(length, weights, *args, **kwargs)
+
+
+class BucketSampler(Sampler):
+    """
+    Sample batches of samples of similar sizes, e.g., lengths of sequences, so
+    little padding is needed.
+
+    For each epoch, the dataset is shuffled and split into buckets, each of
+    which holds `bucket_size` batches. Samples are sorted by size within a
+    bucket, cut into batches, and batches are shuffled. If `max_tokens` is
+    given, the size of a batch is not fixed, but the largest making the
+    padded batch, i.e., the number of samples times the largest size among
+    them, hold at most `max_tokens` elements.
+
+    The sizes of samples are computed once when the sampler is built.
+    """
+    def __init__(self, length, sizes=None, size_fn=None, max_tokens=None,
+                 bucket_size=100, *args, **kwargs):
+        """
+        Args:
+            sizes: array like
+                The sizes of samples.
+            size_fn: callable
+                If `sizes` is None, the function is called with the index of
+                each sample to get its size.
+            max_tokens: int
+                The budget of elements of a padded batch. If None, batches are
+                of the size asked by `next`.
+            bucket_size: int
+                The number of batches in a bucket.
+        """
+        super(BucketSampler, self).__init__(length, *args, **kwargs)
+        if sizes is None:
+            if size_fn is None:
+                raise ValueError("Either sizes or size_fn should be given.")
+            sizes = [size_fn(i) for i in range(length)]
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        if len(self.sizes) != length:
+            raise ValueError("{} sizes are given for {} samples.".format(
+                len(self.sizes), length))
+        if max_tokens is not None and max_tokens < self.sizes.max():
+            raise ValueError("max_tokens {} is less than the largest sample"
+                             " size {}.".format(max_tokens, self.sizes.max()))
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self._batch_size = None
+        # The offsets of batches in `indices`.
+        self._bounds = None
+        self._batch_idx = 0
+
+    def _plan(self, batch_size):
+        """
+        Lay out batches of an epoch.
+        """
+        if self.max_tokens is None:
+            bucket_len = batch_size * self.bucket_size
+        else:
+            mean_size = max(1, int(np.ceil(self.sizes.mean())))
+            bucket_len = self.max_tokens // mean_size * self.bucket_size
+        bucket_len = max(bucket_len, 1)
+
+        self._rng_state = self.rng.bit_generator.state
+        perm = self.rng.permutation(self.length)
+        bucket = np.arange(self.length) // bucket_len
+        # Sort by size in descending order within buckets, so the first sample
+        # of a batch is the largest.
+        order = perm[np.lexsort((-self.sizes[perm], bucket))]
+        sizes = self.sizes[order]
+
+        batches = []
+        for start in range(0, self.length, bucket_len):
+            end = min(start + bucket_len, self.length)
+            a = start
+            while a < end:
+                if self.max_tokens is None:
+                    b = a + batch_size
+                else:
+                    b = a + self.max_tokens // max(sizes[a], 1)
+                b = min(b, end)
+                batches.append(order[a:b])
+                a = b
+        batches = [batches[i] for i in self.rng.permutation(len(batches))]
+
+        self.indices = np.concatenate(batches).astype(self.dtype, copy=False)
+        self._bounds = np.cumsum([0] + [len(b) for b in batches])
+        self._batch_size = batch_size
+        self._batch_idx = 0
+
+    def num_batches(self, batch_size):
+        if self._needs_plan(batch_size):
+            self._plan(batch_size)
+        return len(self._bounds) - 1
+
+    def _needs_plan(self, batch_size):
+        # A new batch size only takes effect when an epoch starts.
+        return self._bounds is None \
+            or (self.current_idx == 0
+                and self.max_tokens is None
+                and batch_size != self._batch_size)
+
+    def next(self, size=1):
+        """
+        Args:
+            size: int
+                The size of the batch. It is ignored if `max_tokens` is given.
+        """
+        self._check_epoch_finishes()
+        if self._needs_plan(size):
+            self._plan(size)
+
+        start, end = self._bounds[self._batch_idx], self._bounds[self._batch_idx + 1]
+        self._batch_idx += 1
+        self.current_idx = end
+
+        return self.indices[start:end]
+
+    def reset(self):
+        super(BucketSampler, self).reset()
+        self._bounds = None
+
+    def state_dict(self):
+        state = super(BucketSampler, self).state_dict()
+        if self._bounds is None:
+            # Batches of the epoch are not planned yet.
+            state["rng_state"] = self.rng.bit_generator.state
+            state["batch_size"] = None
+        else:
+            state["batch_size"] = self._batch_size
+        state["batch_idx"] = self._batch_idx
+        return state
+
+    def load_state_dict(self, state):
+        self.rng.bit_generator.state = state["rng_state"]
+        self._bounds = None
+        if state["batch_size"] is not None:
+            self._plan(state["batch_size"])
+        self.current_idx = state["current_idx"]
+        self._batch_idx = state["batch_idx"]
 
 
 SamplerRegistry("shuffle",
@@ -103,3 +479,17 @@ SamplerRegistry("shuffle",
 SamplerRegistry("sequence",
                 SequenceSampler,
                 message="Sequentially sample the dataset for each epoch.")
+SamplerRegistry("distributed_shuffle",
+                DistributedShuffleSampler,
+                message="Randomly shuffle the dataset for each epoch, and"
+                " sample the shard of a rank.")
+SamplerRegistry("weighted",
+                WeightedSampler,
+                message="Sample the dataset with replacement by weights.")
+SamplerRegistry("class_balanced",
+                ClassBalancedSampler,
+                message="Sample the dataset with replacement, so classes are"
+                " balanced.")
+SamplerRegistry("bucket",
+                BucketSampler,
+                message="Sample batches of samples of similar sizes.")
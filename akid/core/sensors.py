@@ -50,6 +50,7 @@ import sys
 import abc
 import os
 import inspect
+from collections import namedtuple, deque
 from deprecated import deprecated
 import six
 from six.moves import range
@@ -61,7 +62,11 @@ else:
     from queue import Queue
     import queue
 import threading
+import time
+from multiprocessing import connection
+from multiprocessing.pool import ThreadPool
 
+import numpy as np
 import tensorflow as tf
 import torch as th
 from torch import multiprocessing as mp
@@ -80,127 +85,762 @@ from akid import backend as A
 from akid.utils import glog as log
 
 
-def _check_if_main_thread_is_dead():
-    # If the main thread is dead, quit.
-    for t in threading.enumerate():
-        if t.name == "MainThread":
-            if not t.is_alive():
-                return True
-            else:
+# A reference to a batch written in a slot of a `_SharedBatchRing`. It is what
+# is sent through the queue instead of the batch itself.
+_SharedBatchSlot = namedtuple("_SharedBatchSlot", ["index", "length"])
+
+
+class _SharedBatchRing(object):
+    """
+    A ring of preallocated batches in shared memory, which is used by
+    `ParallelSensor` to move batches from worker processes to the main process
+    without pickling them.
+
+    Workers write a fetched batch into a free slot, and only pass on the slot
+    index through the data queue. The consumer copies the batch out of the slot
+    and releases the slot to be reused.
+    """
+    def __init__(self, template, batch_size, num_slots):
+        """
+        Args:
+            template: list
+                A batch returned by `Source.get`, from which the shape and data
+                type of each slot is decided.
+            batch_size: int
+                The largest number of samples a batch could have.
+            num_slots: int
+                The number of batches that could be held at the same time.
+        """
+        self._slots = []
+        for _ in range(num_slots):
+            slot = []
+            for d in template:
+                d = th.as_tensor(d)
+                slot.append(th.empty((batch_size,) + tuple(d.shape[1:]),
+                                     dtype=d.dtype).share_memory_())
+            self._slots.append(slot)
+
+        self._free_slots = mp.Queue(num_slots)
+        for i in range(num_slots):
+            self._free_slots.put(i)
+
+    def _fits(self, data):
+        if len(data) != len(self._slots[0]):
+            return False
+        for d, s in zip(data, self._slots[0]):
+            if d.dtype != s.dtype \
+               or d.shape[1:] != s.shape[1:] \
+               or d.shape[0] > s.shape[0]:
                 return False
+        return True
 
+    def write(self, data, done_event):
+        """
+        Write `data` into a free slot, and return the `_SharedBatchSlot`
+        referring to it. It blocks until a slot is free. If the done event is
+        set when a slot is got, release the slot and return None.
 
-def _data_fetching_worker(source, index_queue, data_queue, done_event):
-    # If index queue is not empty, then fetch the indices of a batch, and load
-    # the data to data queue.
-    while True:
-        if _check_if_main_thread_is_dead():
-            return
+        If `data` does not fit in the slots (e.g., the source returns batches
+        of different shapes), return it as it is, so it would be passed through
+        the queue as usual.
+        """
+        data = [th.as_tensor(d) for d in data]
+        if not self._fits(data):
+            return data
 
-        # If the done event is set, quit.
+        # Slots are released by the consumer, which keeps consuming until all
+        # workers finish, so it would not block forever.
+        i = self._free_slots.get()
         if done_event.is_set():
+            self._free_slots.put(i)
+            return None
+
+        length = data[0].shape[0]
+        for d, s in zip(data, self._slots[i]):
+            s[:length].copy_(d)
+
+        return _SharedBatchSlot(i, length)
+
+    def read(self, slot):
+        """
+        Return the batch referred by `slot`. The returned tensors are views of
+        the shared memory, which are only valid until the slot is released.
+        """
+        return [s[:slot.length] for s in self._slots[slot.index]]
+
+    def release(self, slot):
+        self._free_slots.put(slot.index)
+
+
+def _raise_if_dead_event(item):
+    """
+    Workers that die put an event in the data queue instead of data, so the
+    consumer waiting on the queue would know it. Raise it if `item` is such an
+    event.
+    """
+    if isinstance(item, (DataPrefetchThreadsDeadEvent, DataPrefetchProcessesDeadEvent)):
+        raise item
+
+
+def _put_event(data_queue, event, done_event):
+    """
+    Put `event` in the data queue to tell the consumer that workers die. Give
+    up if the sensor is being torn down, in which case nobody consumes it.
+    """
+    while not done_event.is_set():
+        try:
+            data_queue.put(event, timeout=A.TIMEOUT)
             return
+        except queue.Full:
+            continue
+
 
+def _drain(q):
+    """
+    Remove all items in queue `q` without blocking.
+    """
+    while True:
         try:
-            log.debug("Data Prefetching Worker: Fetching data according to indices ... ")
-            indices = index_queue.get(timeout=A.TIMEOUT)
-            data = source.get(indices)
-            data_gpu = [A.Tensor(d) for d in data]
-            data_queue.put(data_gpu, timeout=A.TIMEOUT)
-            log.debug("Data Prefetching Worker: Data fetched")
+            q.get_nowait()
         except queue.Empty:
-            continue
+            return
+
+
+def _exit_with_parent():
+    """
+    Start a daemon thread in a worker process that exits the process once its
+    parent dies, so workers blocking on queues would not be orphaned.
+    """
+    def watch():
+        parent = getattr(mp, "parent_process", lambda: None)()
+        if parent is not None and parent.sentinel is not None:
+            connection.wait([parent.sentinel])
+        else:
+            ppid = os.getppid()
+            while os.getppid() == ppid:
+                time.sleep(A.TIMEOUT)
+        os._exit(1)
+
+    t = threading.Thread(target=watch, name="Parent Watchdog")
+    t.daemon = True
+    t.start()
+
+
+def _normalize_batch(data, normalization):
+    """
+    Convert uint8 images, the first item of the batch `data`, to float, and
+    normalize them by `normalization`, a pair of the mean and standard
+    deviation of each channel in [0, 1], on the device where they are.
+    """
+    if normalization is None:
+        return data
+    images = data[0]
+    mean, std = normalization
+    shape = (1, -1) + (1,) * (images.dim() - 2)
+    scale = 1 / (255 * th.tensor(std, dtype=th.float32, device=images.device).view(shape))
+    shift = -th.tensor(mean, dtype=th.float32, device=images.device).view(shape) * 255 * scale
+    # (images / 255 - mean) / std in one op.
+    return [th.addcmul(shift, images.float(), scale)] + list(data[1:])
 
 
-def _data_fetching_worker_process(i, source, index_queue, data_queue, done_event):
-    repeat = False
+class _DeviceStager(object):
+    """
+    Move batches to the device, and normalize them there if asked to. It is
+    used by the thread that feeds the data queue, and should be built in the
+    main thread, whose stream is the one batches are consumed on.
+
+    With `pin_memory` on a CUDA device, a batch is copied into reusable
+    pinned host buffers, from which non-blocking copies are issued on a side
+    stream, so the copy of the next batch overlaps the computation on the
+    current one, and batches waiting in the data queue are the other buffers.
+    The stager waits for the copy before returning, which blocks the feeding
+    thread only. On hosts without GPU, arrays are wrapped without copy.
+    """
+    def __init__(self, normalization=None, pin_memory=True):
+        self.normalization = normalization
+        self.use_cuda = A.use_cuda()
+        self.pin_memory = pin_memory and self.use_cuda
+        if self.pin_memory:
+            self.device = th.device("cuda", th.cuda.current_device())
+            self.stream = th.cuda.Stream(self.device)
+            self.compute_stream = th.cuda.current_stream(self.device)
+            # One pinned buffer per item of a batch, grown on demand.
+            self.buffers = []
+
+    @property
+    def copies(self):
+        """
+        Whether staged batches are copies, so the host memory of batches
+        could be reused once they are staged.
+        """
+        return self.use_cuda
+
+    def _as_tensor(self, d, keep_dtype=False):
+        if isinstance(d, th.Tensor):
+            return d
+        if isinstance(d, np.ndarray):
+            # Keep the dtype convention of `A.Tensor`, i.e., int64 arrays
+            # stay, and the others are float32, but only copy if the dtype
+            # changes. Images to normalize here stay as they are, e.g.,
+            # uint8, until they are normalized on the device.
+            if not keep_dtype and d.dtype != np.int64 and d.dtype != np.float32:
+                d = d.astype(np.float32)
+            return th.from_numpy(d)
+        return th.as_tensor(d)
+
+    def _pinned(self, i, t):
+        if i == len(self.buffers):
+            self.buffers.append(None)
+        buf = self.buffers[i]
+        if buf is None or buf.dtype != t.dtype or buf.numel() < t.numel():
+            buf = th.empty(t.numel(), dtype=t.dtype, pin_memory=True)
+            self.buffers[i] = buf
+        return buf[:t.numel()].view(t.shape)
+
+    def stage(self, data):
+        """
+        Return the batch `data`, a list of tensors or arrays, on the device.
+        """
+        data = [self._as_tensor(d, i == 0 and self.normalization is not None)
+                for i, d in enumerate(data)]
+        if not self.use_cuda:
+            return _normalize_batch(data, self.normalization)
+        if not self.pin_memory:
+            return _normalize_batch([d.cuda() for d in data], self.normalization)
+
+        with th.cuda.stream(self.stream):
+            staged = []
+            for i, d in enumerate(data):
+                buf = self._pinned(i, d)
+                buf.copy_(d)
+                staged.append(buf.to(self.device, non_blocking=True))
+            staged = _normalize_batch(staged, self.normalization)
+        for t in staged:
+            # Memory allocated on the side stream is used on the compute
+            # stream, so it should not be reused before the computation.
+            t.record_stream(self.compute_stream)
+        # The copy is done when it returns, so the pinned buffers could be
+        # reused by the next batch.
+        self.stream.synchronize()
+        return staged
+
+
+def _batch_bytes(data):
+    return sum(d.numel() * d.element_size() for d in data if isinstance(d, th.Tensor))
+
+
+class _PrefetchTuner(object):
+    """
+    Decide the prefetch depth of a sensor, i.e., the number of batches in
+    flight, and the number of its workers, by how long the consumer waits for
+    batches against how long producers take to fetch one.
+
+    Every `window` batches taken, if the consumer has waited for more than
+    `stall_ratio` of the time, the pipeline falls behind. If fetching a batch
+    takes longer than the consumer computes on as many batches as there are
+    workers, a worker is added, since a deeper queue does not help then.
+    Otherwise, the depth is increased to absorb the jitter of fetching. If
+    there have always been two batches ready when a batch is taken, the depth
+    is decreased to save memory, and workers more than needed are retired.
+
+    The depth is bounded by `max_depth`, and by `max_bytes` of batches in
+    flight if given.
+    """
+    def __init__(self,
+                 depth,
+                 max_depth,
+                 num_workers=1,
+                 max_workers=1,
+                 max_bytes=None,
+                 window=20,
+                 stall_ratio=0.05):
+        self.depth = depth
+        self.max_depth = max(depth, max_depth)
+        self.num_workers = num_workers
+        self.max_workers = max(num_workers, max_workers)
+        self.max_bytes = max_bytes
+        self.window = window
+        self.stall_ratio = stall_ratio
+        # Producers report from other threads.
+        self._lock = threading.Lock()
+        self._fetch_time = 0
+        self._num_fetched = 0
+        self.restart()
+
+    def restart(self):
+        """
+        Start measuring over, e.g., after the pipeline is set up again.
+        """
+        self._last_taken = None
+        self._time = 0
+        self._wait = 0
+        self._min_ready = None
+        self._num_taken = 0
+
+    def fetched(self, seconds):
+        """
+        Called by producers with the time taken to fetch a batch.
+        """
+        with self._lock:
+            self._fetch_time += seconds
+            self._num_fetched += 1
+
+    def taken(self, now, wait, ready, batch_bytes):
+        """
+        Called by the consumer when a batch is taken at time `now`, after
+        waiting `wait` seconds for it, with `ready` batches left in the data
+        queue. Return the changes of the depth and of the number of workers.
+        """
+        max_depth = self.max_depth
+        if self.max_bytes is not None and batch_bytes > 0:
+            max_depth = max(1, min(max_depth, self.max_bytes // batch_bytes))
+        if self.depth > max_depth:
+            # The batches grow larger than before. Since the consumer puts
+            # one batch less in flight for each batch taken, the depth is
+            # decreased by one at a time, without waiting for a window.
+            self._last_taken = now
+            self.depth -= 1
+            return -1, 0
+
+        last, self._last_taken = self._last_taken, now
+        if last is None:
+            return 0, 0
+        self._time += now - last
+        self._wait += wait
+        self._min_ready = ready if self._min_ready is None else min(self._min_ready, ready)
+        self._num_taken += 1
+        if self._num_taken < self.window:
+            return 0, 0
+
+        with self._lock:
+            latency = self._fetch_time / self._num_fetched if self._num_fetched > 0 else None
+            self._fetch_time, self._num_fetched = 0, 0
+        compute = (self._time - self._wait) / self._num_taken
+        stalled = self._wait > self.stall_ratio * self._time
+        min_ready = self._min_ready
+        self._last_taken = now
+        self._time, self._wait, self._min_ready, self._num_taken = 0, 0, None, 0
+
+        d_depth, d_workers = 0, 0
+        if stalled:
+            if latency is not None \
+               and latency > compute * self.num_workers \
+               and self.num_workers < self.max_workers:
+                # Each worker needs a batch in flight to keep busy.
+                d_workers = 1
+                d_depth = 1 if self.depth < max_depth else 0
+            elif self.depth < max_depth:
+                d_depth = 1
+        elif min_ready >= 2:
+            if self.depth > 1:
+                d_depth = -1
+            if latency is not None \
+               and self.num_workers > 1 \
+               and latency < compute * (self.num_workers - 1):
+                d_workers = -1
+
+        self.depth += d_depth
+        self.num_workers += d_workers
+        return d_depth, d_workers
+
+
+class SensorMetrics(object):
+    """
+    Live metrics of the data pipeline of a sensor, to tell whether training
+    is input bound, to size pools of workers, and to spot stragglers. They
+    are accumulated since the last `reset`:
+
+    * the latency of each stage a batch goes through: the `dispatch` of its
+      indices by the consumer, the `fetch` by `Source.get` in a worker, the
+      `transfer` to the device, and the `wait` of the consumer, i.e., the
+      time it stalls for the batch in a step;
+    * the histogram of the number of batches ready in the data queue when a
+      batch is taken;
+    * the utilization of each worker, i.e., the fraction of time it spends
+      fetching.
+
+    Producers record from other threads, so recording is locked.
+    """
+    STAGES = ["dispatch", "fetch", "transfer", "wait"]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._start = time.time()
+            self._time = dict((s, 0.) for s in self.STAGES)
+            self._max_time = dict((s, 0.) for s in self.STAGES)
+            self._count = dict((s, 0) for s in self.STAGES)
+            self._occupancy = []
+            self._busy = {}
+
+    def record(self, stage, seconds, worker=None):
+        """
+        Record that a batch takes `seconds` in `stage`, by `worker` if given.
+        """
+        with self._lock:
+            self._time[stage] += seconds
+            self._max_time[stage] = max(self._max_time[stage], seconds)
+            self._count[stage] += 1
+            if worker is not None:
+                self._busy[worker] = self._busy.get(worker, 0) + seconds
+
+    def observe_queue(self, num_ready):
+        """
+        Record that `num_ready` batches are in the data queue.
+        """
+        with self._lock:
+            if num_ready >= len(self._occupancy):
+                self._occupancy.extend([0] * (num_ready + 1 - len(self._occupancy)))
+            self._occupancy[num_ready] += 1
+
+    def snapshot(self):
+        """
+        Return the metrics as a dict of
+
+        * `latency`: the mean seconds of each stage;
+        * `max_latency`: the largest seconds of each stage;
+        * `queue_occupancy`: the number of times each number of batches is
+          ready, indexed by the number;
+        * `worker_utilization`: the utilization of each worker, by its index;
+        * `num_steps`: the number of batches taken;
+        * `elapsed`: the seconds since the last reset.
+        """
+        with self._lock:
+            elapsed = time.time() - self._start
+            return {
+                "latency": dict((s, self._time[s] / self._count[s] if self._count[s] > 0 else 0.)
+                                for s in self.STAGES),
+                "max_latency": dict(self._max_time),
+                "queue_occupancy": list(self._occupancy),
+                "worker_utilization": dict((w, b / elapsed) for w, b in self._busy.items()),
+                "num_steps": self._count["wait"],
+                "elapsed": elapsed,
+            }
+
+    def summarize(self, name, step):
+        """
+        Add the metrics as scalar summaries of `step`, named under `name`.
+        """
+        metrics = self.snapshot()
+        scalars = []
+        for s in self.STAGES:
+            scalars.append(("{}_latency".format(s), metrics["latency"][s]))
+            scalars.append(("{}_max_latency".format(s), metrics["max_latency"][s]))
+        # The histogram of occupancy as the fraction of each number of
+        # batches ready.
+        occupancy = metrics["queue_occupancy"]
+        for n, c in enumerate(occupancy):
+            scalars.append(("queue_occupancy_{}".format(n), c / max(1, sum(occupancy))))
+        for w, u in sorted(metrics["worker_utilization"].items()):
+            scalars.append(("worker_{}_utilization".format(w), u))
+        for tag, v in scalars:
+            A.summary.add_scalar(name="{}/{}".format(name, tag), value=v, step=step)
+
+
+class _ChunkedFetcher(object):
+    """
+    Get a batch from `source` by a pool of `num_threads` threads: the indices
+    are split into a chunk for each thread, and each thread fills its rows of
+    the batch.
+
+    If the source provides `bulk_data`, and gets batches by `get_many`, i.e.,
+    does not override how to get them, the batch is allocated once, each
+    thread gathers its chunk straight into its rows, and the batch is
+    transformed by `_bulk_transform`, which is what `Source.get_many` does.
+    Otherwise, each thread gets its chunk from the source, and copies it into
+    the batch. Since decoders like PIL, numpy I/O and zlib release the GIL,
+    chunks are decoded in parallel with no serialization, given that the
+    source could be read by threads concurrently, e.g., one in memory or
+    memory mapped. The source is supposed to return a list of arrays or
+    tensors of samples of fixed shape.
+    """
+    def __init__(self, source, num_threads):
+        self.source = source
+        self.num_threads = num_threads
+        self.pool = ThreadPool(num_threads)
+
+    def get(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        chunks = [c for c in np.array_split(indices, self.num_threads) if len(c) > 0]
+        if len(chunks) <= 1:
+            return self.source.get(indices)
+
+        starts = np.cumsum([0] + [len(c) for c in chunks[:-1]])
+        if self._gets_in_bulk():
+            return self._gather(indices, chunks, starts)
+
+        batch = []
+        lock = threading.Lock()
+
+        def fetch(i):
+            part = [d if isinstance(d, th.Tensor) else th.as_tensor(d)
+                    for d in self.source.get(chunks[i])]
+            with lock:
+                # The batch is allocated by the chunk got first.
+                if len(batch) == 0:
+                    batch.extend(th.empty((len(indices),) + d.shape[1:], dtype=d.dtype)
+                                 for d in part)
+            for d, b in zip(part, batch):
+                b[starts[i]:starts[i] + len(chunks[i])].copy_(d)
+
+        self.pool.map(fetch, range(len(chunks)))
+        return batch
+
+    def _gets_in_bulk(self):
+        if self.source.bulk_data is None:
+            return False
+        cls = type(self.source)
+        return all(getattr(cls, m) is getattr(sources.Source, m)
+                   for m in ["get", "_get", "get_many"])
+
+    def _gather(self, indices, chunks, starts):
+        bulk_data = self.source.bulk_data
+        size = len(bulk_data[0])
+        if indices.min() < 0 or indices.max() >= size:
+            raise IndexError("Indices out of the range of {} samples.".format(size))
+
+        batch = []
+        for d in bulk_data:
+            shape = (len(indices),) + tuple(d.shape[1:])
+            if isinstance(d, th.Tensor):
+                batch.append(th.empty(shape, dtype=d.dtype))
+            else:
+                batch.append(np.empty(shape, dtype=d.dtype))
+
+        def gather(i):
+            rows = slice(starts[i], starts[i] + len(chunks[i]))
+            for d, b in zip(bulk_data, batch):
+                if isinstance(d, th.Tensor):
+                    th.index_select(d, 0, th.from_numpy(chunks[i]), out=b[rows])
+                else:
+                    # Indices are checked above. Taking with `raise` mode
+                    # would gather into a temporary array instead.
+                    np.take(d, chunks[i], axis=0, out=b[rows], mode="clip")
+
+        self.pool.map(gather, range(len(chunks)))
+        return self.source._bulk_transform(batch)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def _data_fetching_worker(source, index_queue, data_queue, done_event, stager, metrics, tuner=None):
+    # Fetch the indices of a batch, and load the data to data queue. The
+    # worker blocks on the queues, and quits upon a None in the index queue.
+    try:
+        while True:
+            indices = index_queue.get()
+            if indices is None:
+                return
+            if done_event.is_set():
+                # Consume the indices left without fetching.
+                continue
+
+            start = time.time()
+            data = source.get(indices)
+            seconds = time.time() - start
+            metrics.record("fetch", seconds, 0)
+            if tuner is not None:
+                tuner.fetched(seconds)
+            start = time.time()
+            data = stager.stage(data)
+            metrics.record("transfer", time.time() - start)
+            data_queue.put(data)
+    except Exception as e:
+        log.error("Data Prefetching Worker: Exception {}.".format(e))
+        _put_event(data_queue, DataPrefetchThreadsDeadEvent(), done_event)
+        raise
+
+
+def _data_fetching_worker_process(i, source, index_queue, data_queue, done_event, ring=None):
     NAME = "Data Prefetching Worker {}".format(i)
+    _exit_with_parent()
 
     while True:
-        log.debug("{}: Working ...".format(NAME))
-        try:
-            os.kill(os.getppid(), 0)
-        except ProcessLookupError:
+        # Items are tagged by the sensor. The tag is passed along with the
+        # data, so the sensor could tell which data it asks for, and so are
+        # the worker and the time taken to fetch the data. A None item tells
+        # the worker to quit.
+        item = index_queue.get()
+        if item is None:
             return
-
-        # If the done event is set, quit.
-        log.debug("{}: Done event {}".format(NAME, done_event.is_set()))
         if done_event.is_set():
-            return
+            # Consume the indices left without fetching.
+            continue
 
         try:
-            log.debug("{}: Fetching data according to indices ... ".format(NAME))
-            if not repeat:
-                # It is possible the previous try to enqueue data is timeout,
-                # so we do not fetch data this time.
-                item = index_queue.get(timeout=A.TIMEOUT)
-                if type(item) is EpochCompletedEvent:
-                    # Epoch finishes, we pass on the event to let the sensor
-                    # knows an epoch has indeed finished.
-                    data = item
-                else:
-                    data = source.get(item) # The item is a list of indices now.
-            data_queue.put(data, timeout=A.TIMEOUT)
-            repeat = False
-            log.debug("{}: Data fetched".format(NAME))
-        except queue.Empty:
-            continue
-        except queue.Full:
-            repeat = True
-            continue
+            tag, item = item
+            seconds = 0
+            if type(item) is EpochCompletedEvent:
+                # Epoch finishes, we pass on the event to let the sensor
+                # knows an epoch has indeed finished.
+                data = item
+            else:
+                start = time.time()
+                data = source.get(item) # The item is a list of indices now.
+                seconds = time.time() - start
+                if ring is not None:
+                    # Only a reference to the slot holding the batch goes
+                    # through the queue.
+                    data = ring.write(data, done_event)
+                    if data is None:
+                        continue
+            data_queue.put((tag, data, (i, seconds)))
         except Exception as e:
-            log.debug("Process {} : Exception {}.".format(i, e))
+            log.error("{}: Exception {}.".format(NAME, e))
             raise e
 
 
-def _data_preloading_worker(prefetch_data_queue, data_queue, done_event):
-    log.debug("Data Preloading Worker: Started. ")
-    NAME = "Data Preloading Worker"
-
-    repeat = False
-
+def _data_preloading_worker(prefetch_data_queue, data_queue, done_event, stager, metrics,
+                            ring=None, tuner=None):
+    failed = False
     while True:
-        log.debug("Data Preloading Worker: Working ... ")
-        if _check_if_main_thread_is_dead():
+        try:
+            item = prefetch_data_queue.get()
+        except Exception as e:
+            # For example, a batch sent by a worker that has died cannot be
+            # received. Data are dropped from now on, but we keep consuming,
+            # so the workers alive would not block when tearing down. Batches
+            # of workers that have quit upon tearing down are dropped
+            # silently.
+            if not failed and not done_event.is_set():
+                log.error("Data Preloading Worker: Exception {}.".format(e))
+                _put_event(data_queue, DataPrefetchThreadsDeadEvent(), done_event)
+                failed = True
+            continue
+        if item is None:
+            assert done_event.is_set()
             return
 
+        tag, data, (worker, seconds) = item
+        if done_event.is_set() or failed:
+            # We need to consume all data before finishing, otherwise,
+            # data fetching workers may cannot finish since it waits to
+            # enqueue data (for that the pipe used by the queue may be
+            # full, thus the workers are waiting the data to be
+            # consumed; this is an implementation issue of
+            # multiprocessing.Queue in python). But we do not need to
+            # process them anymore.
+            if type(data) is _SharedBatchSlot:
+                ring.release(data)
+            continue
+
+        if type(data) is EpochCompletedEvent:
+            data_queue.put((tag, data))
+            continue
+
+        slot = data if type(data) is _SharedBatchSlot else None
         try:
-            log.debug("{}: Loading CPU data ... ".format(NAME))
+            metrics.record("fetch", seconds, worker)
+            if tuner is not None:
+                tuner.fetched(seconds)
+
+            start = time.time()
+            if slot is not None:
+                # Copy the batch out of shared memory, so the slot could be
+                # released to workers right away. When using GPU, the copy
+                # to device memory does it.
+                batch = ring.read(slot)
+                if not stager.copies:
+                    batch = [d.clone() for d in batch]
+                data_gpu = stager.stage(batch)
+                slot = None
+                ring.release(data)
+            else:
+                data_gpu = stager.stage(data)
+            metrics.record("transfer", time.time() - start)
+        except Exception as e:
+            # The same as above, but the slot held is released, so workers
+            # would not block on it.
+            if slot is not None:
+                ring.release(slot)
+            log.error("Data Preloading Worker: Exception {}.".format(e))
+            _put_event(data_queue, DataPrefetchThreadsDeadEvent(), done_event)
+            failed = True
+            continue
 
-            if not repeat or done_event.is_set():
-                data = prefetch_data_queue.get(timeout=A.TIMEOUT)
-                if data is None:
-                    assert done_event.is_set()
-                    return
-                elif done_event.is_set():
-                    # We need to consume all data before finishing, otherwise,
-                    # data fetching workers may cannot finish since it waits to
-                    # enqueue data (for that the pipe used by the queue may be
-                    # full, thus the workers are waiting the data to be
-                    # consumed; this is an implementation issue of
-                    # multiprocessing.Queue in python). But we do not need to
-                    # process them anymore.
-                    continue
-                elif type(data) is list:
-                    data_gpu = []
-                    for d in data:
-                        data_gpu.append(A.Tensor(d))
+        data_queue.put((tag, data_gpu))
 
-            log.debug("{}: Enqueuing GPU data ... ".format(NAME))
 
-            if type(data) is EpochCompletedEvent:
-                data_queue.put(data, timeout=A.TIMEOUT)
-            else:
-                data_queue.put(data_gpu, timeout=A.TIMEOUT)
-            repeat = False
+def _stream_shards(shards, seed, epoch, rank=0, world_size=1, worker=0, num_workers=1):
+    """
+    Return the shards streamed by `worker` of `rank` in `epoch`. Shards are
+    shuffled by each epoch, and split across ranks, then across workers.
+    """
+    order = np.random.default_rng([seed, epoch]).permutation(len(shards))
+    return [shards[i] for i in order[rank::world_size][worker::num_workers]]
 
-            log.debug("Data Preloading Worker: Data loaded")
-        except queue.Empty:
-            log.debug("{}: Queue is empty. Repeat.".format(NAME))
-            continue
-        except queue.Full:
-            repeat = True
-            continue
+
+def _data_streaming_worker_process(i, source, num_workers, batch_size, buffer_size,
+                                   seed, rank, world_size, epoch, data_queue, done_event):
+    """
+    Stream batches of the shards of worker `i` epoch after epoch, starting
+    from `epoch`, and put them into the data queue tagged by their epoch,
+    along with the worker and the time taken. The end of an epoch is marked
+    by an `EpochCompletedEvent`. The worker quits when `done_event` is set.
+    """
+    NAME = "Data Streaming Worker {}".format(i)
+    _exit_with_parent()
+
+    def put(item):
+        while not done_event.is_set():
+            try:
+                data_queue.put(item, timeout=A.TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    shards = source.data
+    try:
+        while True:
+            rng = np.random.default_rng([seed, epoch, rank, i])
+            samples = source.stream(
+                _stream_shards(shards, seed, epoch, rank, world_size, i, num_workers),
+                buffer_size,
+                rng)
+            batch = []
+            start = time.time()
+            for sample in samples:
+                batch.append(sample)
+                if len(batch) == batch_size:
+                    data = source.collate(batch)
+                    if not put((epoch, data, (i, time.time() - start))):
+                        return
+                    batch = []
+                    start = time.time()
+                elif done_event.is_set():
+                    return
+            # The last batch of the worker may be smaller.
+            if len(batch) > 0 and not put((epoch, source.collate(batch), (i, time.time() - start))):
+                return
+            if not put((epoch, EpochCompletedEvent(), (i, 0))):
+                return
+            epoch += 1
+    except Exception as e:
+        log.error("{}: Exception {}.".format(NAME, e))
+        raise e
+
+
+def _data_supervising_worker(worker_processes, data_queue, done_event):
+    """
+    Wait till any of the worker processes exits abnormally. If it is not asked
+    to, put a `DataPrefetchProcessesDeadEvent` in the data queue to wake up
+    the consumer. Workers may be added to `worker_processes` while watching,
+    and workers retired exit normally.
+    """
+    while not done_event.is_set():
+        workers = list(worker_processes)
+        connection.wait([p.sentinel for p in workers if p.exitcode is None], A.TIMEOUT)
+        if any(p.exitcode not in (None, 0) for p in workers):
+            break
+    if not done_event.is_set():
+        log.error("Data prefetching processes died unexpectedly.")
+        _put_event(data_queue, DataPrefetchProcessesDeadEvent(), done_event)
 
 
 class Sensor(ValidatableProcessingBlock):
@@ -212,6 +852,15 @@ class Sensor(ValidatableProcessingBlock):
 
     By the default, a sensor is in the "train" mode. To use it in other modes,
     one needs to change the mode first, then set the batch size in that mode.
+
+    If `val_on_device` is True, the validation and test splits are not sensed
+    through the data queue. Instead, a split is fetched from the source once
+    when the sensor is first set up in its mode, and kept on the device as
+    contiguous tensors, from which batches are sliced, or gathered if the
+    sampler does not give contiguous indices. Thus, validation is pure
+    computation, and changing to these modes does not stop the training
+    pipeline if it is run by processes of its own. It suits small splits that
+    fit in the device memory, e.g., those of MNIST and CIFAR.
     """
     NAME = "Sensor"
 
@@ -223,6 +872,14 @@ class Sensor(ValidatableProcessingBlock):
                  queue_size=5,
                  sampler="shuffle",
                  val_sampler="sequence",
+                 sampler_kwargs=None,
+                 val_sampler_kwargs=None,
+                 normalize=None,
+                 pin_memory=True,
+                 auto_tune=False,
+                 max_queue_size=None,
+                 max_prefetch_bytes=None,
+                 val_on_device=False,
                  **kwargs):
         """
         Args:
@@ -234,6 +891,36 @@ class Sensor(ValidatableProcessingBlock):
                 The number of batches to prefetch.
             sampler: str or a Sampler object
                 The sampler that determines the sequence to process data.
+            sampler_kwargs: dict
+                Keyword arguments to build the sampler if it is given by name,
+                e.g., the rank and world size of `distributed_shuffle`.
+            val_sampler_kwargs: dict
+                The same as `sampler_kwargs`, but for `val_sampler`.
+            normalize: tuple or bool
+                If given, the source is supposed to provide uint8 images,
+                which are converted to float and normalized by the pair of
+                mean and standard deviation of channels in [0, 1] after being
+                moved to the device, so a quarter of bytes are passed between
+                processes and copied to the device. If True, `normalization` of
+                the source is used. Jokers apply to normalized images.
+            pin_memory: bool
+                When using GPU, copy batches to the device through pinned
+                host buffers on a side stream, so the copy overlaps the
+                computation. It takes no effect on hosts without GPU.
+            auto_tune: bool
+                Whether to tune the number of batches to prefetch, starting
+                from `queue_size`, and the number of workers if there is a
+                pool of them, by how long the consumer waits for data. The
+                settings chosen are logged, so they could be pinned.
+            max_queue_size: int
+                The largest number of batches to prefetch when tuning. Twice
+                `queue_size` for each worker of the largest pool by default.
+            max_prefetch_bytes: int
+                If given, the number of batches to prefetch when tuning is
+                also bounded by the bytes they take.
+            val_on_device: bool
+                Whether to keep the validation and test splits on the device.
+                See the class documentation for details.
             name: str
                 Name of this sensor.
         """
@@ -242,9 +929,6 @@ class Sensor(ValidatableProcessingBlock):
         self.batch_size_dict = { A.Mode.TRAIN: batch_size,
                                  A.Mode.VAL: val_batch_size,
                                  A.Mode.TEST: val_batch_size if test_batch_size is None else test_batch_size}
-        self.queue_size = queue_size
-        if self.queue_size > self.num_batches_per_epoch:
-            self.queue_size = self.num_batches_per_epoch
 
         # More complex datasets might customized samplers, Sensor supports pass
         # a built sampler directly.
@@ -258,15 +942,124 @@ class Sensor(ValidatableProcessingBlock):
         else:
             self.val_sampler = val_sampler
 
+        self.sampler_kwargs = sampler_kwargs or {}
+        self.val_sampler_kwargs = val_sampler_kwargs or {}
+        self.normalize = normalize
+        self.pin_memory = pin_memory
+        self.auto_tune = auto_tune
+        self.max_queue_size = max_queue_size
+        self.max_prefetch_bytes = max_prefetch_bytes
+        self.val_on_device = val_on_device
+        # Splits kept on the device, by mode.
+        self._resident = {}
+        # Tuners of prefetching, and metrics of pipelines, by mode.
+        self._tuners = {}
+        self._tuner = None
+        self._metrics = {}
+        # Samplers built from names, by mode.
+        self._samplers = {}
+
+        # Jokers that apply to batches of training and validation data.
+        self.training_jokers = JokerSystem(name="training_joker", do_summary=False)
+        self.val_jokers = JokerSystem(name="val_joker", do_summary=False)
+
         self.mode = A.Mode.TRAIN
 
+        self.queue_size = queue_size
+        num_batches = self.num_batches_per_epoch
+        if num_batches is not None and self.queue_size > num_batches:
+            self.queue_size = num_batches
+
     @property
     def batch_size(self):
         return self.batch_size_dict[self.mode]
 
     @property
     def num_batches_per_epoch(self):
-        return (self.source.size - 1) // self.batch_size_dict[self.mode] + 1
+        """
+        The number of batches in an epoch of the current mode. If the sampler
+        only samples a shard of the dataset, it is the number of batches in
+        the shard. If the sampler decides sizes of batches, it is the number
+        of batches it plans for the epoch.
+        """
+        return self._get_sampler(self.mode).num_batches(self.batch_size_dict[self.mode])
+
+    def _get_sampler(self, mode):
+        """
+        Return the sampler of `mode`. Samplers given by names are built when
+        they are asked for the first time, and kept to be used across setups.
+        """
+        if mode == A.Mode.TRAIN:
+            if hasattr(self, "train_sampler"):
+                return self.train_sampler
+            name, kwargs = self.train_sampler_name, self.sampler_kwargs
+        elif mode == A.Mode.VAL or mode == A.Mode.TEST:
+            if hasattr(self, "val_sampler"):
+                return self.val_sampler
+            name, kwargs = self.val_sampler_name, self.val_sampler_kwargs
+        else:
+            raise ValueError("Wrong mode {}".format(mode))
+
+        if mode not in self._samplers:
+            self._samplers[mode] = samplers.get(name, self.source.size, **kwargs)
+        return self._samplers[mode]
+
+    def _get_tuner(self, mode):
+        """
+        Return the tuner of prefetching of `mode`, or None if not tuning.
+        Tuners are kept across setups, so the settings chosen carry on.
+        """
+        if not self.auto_tune:
+            return None
+        if mode not in self._tuners:
+            bounds = self._worker_bounds()
+            # Twice the queue size for each worker of the largest pool.
+            max_depth = self.max_queue_size \
+                or 2 * self.queue_size * bounds.get("max_workers", 1) // bounds.get("num_workers", 1)
+            self._tuners[mode] = _PrefetchTuner(
+                self.queue_size,
+                min(max_depth, self._get_sampler(mode).num_batches(self.batch_size_dict[mode])),
+                max_bytes=self.max_prefetch_bytes,
+                **bounds)
+        return self._tuners[mode]
+
+    def _worker_bounds(self):
+        """
+        The number of workers to start with, and the largest number of
+        workers, as keyword arguments of a tuner.
+        """
+        return {}
+
+    @property
+    def metrics(self):
+        """
+        The `SensorMetrics` of the pipeline of the current mode.
+        """
+        if self.mode not in self._metrics:
+            self._metrics[self.mode] = SensorMetrics()
+        return self._metrics[self.mode]
+
+    @property
+    def prefetch_depth(self):
+        """
+        The number of batches to prefetch now.
+        """
+        return self.queue_size if self._tuner is None else self._tuner.depth
+
+    @property
+    def queue_capacity(self):
+        """
+        The largest number of batches to prefetch, by which queues are sized.
+        """
+        return self.queue_size if self._tuner is None else self._tuner.max_depth
+
+    @property
+    def tuned_settings(self):
+        """
+        The arguments to build the sensor with to pin the prefetching settings
+        tuned in the current mode.
+        """
+        return {"queue_size": self.prefetch_depth}
 
     def set_batch_size(self, size):
         """
@@ -278,8 +1071,9 @@ class Sensor(ValidatableProcessingBlock):
             raise ValueError("The batch size should be of type int. Type {} received".format(type(size)))
         else:
             self.batch_size_dict[self.mode] = size
-            if self.queue_size > self.num_batches_per_epoch:
-                self.queue_size = self.num_batches_per_epoch
+            num_batches = self.num_batches_per_epoch
+            if num_batches is not None and self.queue_size > num_batches:
+                self.queue_size = num_batches
 
     def set_mode(self, mode):
         A.check_mode(mode)
@@ -287,18 +1081,21 @@ class Sensor(ValidatableProcessingBlock):
         # We need to tear down pre-fetching threads before changing the mode,
         # otherwise, source would change mode queue shutdown, thus leading to
         # the result that some new data are fetched to the old data queue, and
-        # not used.
-        if self.is_setup:
-            self._teardown_data_queue()
+        # not used. Splits on the device have no data queue.
+        if self.is_setup and not self._is_resident():
+            self._suspend_data_queue(mode)
 
         self.mode = mode
         self.source.set_mode(mode)
         self.log("Mode {}".format(mode))
 
     def reset(self):
-        if self.is_setup:
+        # Splits on the device have no data queue, so only the sampler starts
+        # over.
+        if self.is_setup and not self._is_resident():
             self._teardown_data_queue()
-            self.sampler.reset()
+        if self.is_setup:
+            self._get_sampler(self.mode).reset()
 
         self.setup()
 
@@ -307,25 +1104,259 @@ class Sensor(ValidatableProcessingBlock):
         Set up a FIFO queue to load data from source.
         """
         self.source.setup()
-        if self.mode == A.Mode.TRAIN:
-            if hasattr(self, "train_sampler"):
-                self.sampler = self.train_sampler
-            else:
-                self.sampler = samplers.get(self.train_sampler_name, self.source.size)
-        elif self.mode == A.Mode.VAL or self.mode == A.Mode.TEST:
-            if hasattr(self, "val_sampler"):
-                self.sampler = self.val_sampler
-            else:
-                self.sampler = samplers.get(self.val_sampler_name, self.source.size)
-        else:
-            raise ValueError("Wrong mode {}".format(self.mode))
+        self.sampler = self._get_sampler(self.mode)
+        if self._is_resident():
+            self._setup_resident()
+            return
+
+        self._reset_dispatched()
+        self._setup_tuner()
 
         self._setup_index_queue()
         self._setup_data_queue()
 
     def teardown(self):
+        if not self._is_resident():
+            self._teardown_data_queue()
+        self._resident = {}
+        self.source.teardown()
+
+    def _is_resident(self, mode=None):
+        """
+        Whether the split of `mode`, the current mode by default, is kept on
+        the device.
+        """
+        mode = self.mode if mode is None else mode
+        return self.val_on_device and mode != A.Mode.TRAIN
+
+    def _setup_resident(self):
+        """
+        Fetch the split of the current mode, and copy it to the device batch
+        by batch, unless it has been done.
+        """
+        if self.mode in self._resident:
+            return
+        start = time.time()
+        size = self.source.size
+        batch_size = self.batch_size_dict[self.mode]
+        stager = _DeviceStager(self.normalization, self.pin_memory)
+        split = None
+        for i in range(0, size, batch_size):
+            data = stager.stage(self.source.get(np.arange(i, min(i + batch_size, size))))
+            if split is None:
+                split = [th.empty((size,) + d.shape[1:], dtype=d.dtype, device=d.device)
+                         for d in data]
+            for d, t in zip(data, split):
+                t[i:i + d.shape[0]].copy_(d)
+        self._resident[self.mode] = split
+        self.log("Kept {} samples of mode {} on the device in {:.2f}s.".format(
+            size, self.mode, time.time() - start))
+
+    def _next_resident(self, stop_at_epoch_end=False):
+        """
+        Return the next batch of the split on the device. If
+        `stop_at_epoch_end` is True, return None when the epoch completes.
+        """
+        batch_size = self.batch_size_dict[self.mode]
+        try:
+            indices = self.sampler.next(batch_size)
+        except EpochCompletedEvent:
+            if stop_at_epoch_end:
+                return None
+            indices = self.sampler.next(batch_size)
+
+        split = self._resident[self.mode]
+        start = indices[0]
+        if indices[-1] - start == len(indices) - 1 and (np.diff(indices) == 1).all():
+            # Views of the split.
+            data = [t[start:start + len(indices)] for t in split]
+        else:
+            index = th.from_numpy(np.asarray(indices, dtype=np.int64)).to(split[0].device)
+            data = [t[index] for t in split]
+        data = self._joke(data)
+
+        A.cache_tensor_auto_scope(data[0], "val_data" if self.is_val else "data")
+        A.cache_tensor_auto_scope(data[1], "val_labels" if self.is_val else "labels")
+        self._data = data
+        return data
+
+    def state_dict(self):
+        """
+        Return the state to resume sensing of the current mode from the batch
+        after the last one taken, e.g., to be saved in checkpoints.
+
+        Batches prefetched but not taken yet are fetched again after
+        resuming. If batches are not taken in the order they are sampled,
+        e.g., by `ParallelSensor` with more than one worker, the position is
+        counted by the number of batches taken, so a few batches around may
+        be repeated or skipped.
+        """
+        if self._is_resident():
+            return {"mode": self.mode, "sampler": self.sampler.state_dict()}
+        return {"mode": self.mode, "sampler": self._resume_state}
+
+    def load_state_dict(self, state):
+        """
+        Restore the sampler of the mode in `state`, whose data queue is
+        restarted if it is running.
+        """
+        if state["mode"] != self.mode:
+            raise ValueError("The state of mode {} cannot be loaded in mode {}.".format(
+                state["mode"], self.mode))
+        is_running = self.is_setup and not self._is_resident()
+        if is_running:
+            self._teardown_data_queue()
+        self._get_sampler(self.mode).load_state_dict(state["sampler"])
+        if is_running:
+            self.setup()
+
+    def attach(self, joker, to_val=False):
+        """
+        Attach a joker to a joker system. If `to_val` is True, attach to
+        validation joker system, otherwise to training joker system.
+
+        Jokers apply to a batch of data in the main process once it is taken
+        from the data queue, so they should work on batches, e.g.,
+        `BatchCropJoker`.
+        """
+        if to_val:
+            self.val_jokers.attach(joker)
+        else:
+            self.training_jokers.attach(joker)
+
+    def _joke(self, data):
+        """
+        Apply jokers of the current mode to the batch `data`, whose first item
+        is the data to augment.
+        """
+        jokers = self.val_jokers if self.is_val else self.training_jokers
+        if jokers.is_empty:
+            return data
+        return [jokers.forward(data[0])] + list(data[1:])
+
+    @property
+    def normalization(self):
+        """
+        The pair of mean and standard deviation to normalize images by, or
+        None if images are not normalized by the sensor.
+        """
+        if self.normalize is True:
+            return self.source.normalization
+        elif self.normalize:
+            return self.normalize
+        return None
+
+    def _reset_dispatched(self):
+        """
+        Forget the batches dispatched, which start from the current position
+        of the sampler.
+        """
+        # States of the sampler after each batch dispatched and not taken.
+        self._dispatched = deque()
+        self._resume_state = self.sampler.state_dict()
+
+    def _next_indices(self):
+        """
+        Return the indices of the next batch given by the sampler, and keep
+        the state after it to resume from.
+        """
+        self._dispatch_start = time.time()
+        indices = self.sampler.next(self.batch_size_dict[self.mode])
+        self._dispatched.append(self.sampler.state_dict())
+        return indices
+
+    def _take_dispatched(self):
+        """
+        Called when a batch is taken.
+        """
+        if len(self._dispatched) > 0:
+            self._resume_state = self._dispatched.popleft()
+
+    def _setup_tuner(self):
+        self._tuner = self._get_tuner(self.mode)
+        self._waited = 0
+        if self._tuner is not None:
+            self._tuner.restart()
+
+    def _taken(self, data):
+        """
+        Called when the batch `data` is taken. Record metrics, tune
+        prefetching if asked to, and return the number of batches to put into
+        the index queue to keep the depth of prefetching.
+        """
+        waited, self._waited = self._waited, 0
+        ready = self.data_queue.qsize()
+        self.metrics.record("wait", waited)
+        self.metrics.observe_queue(ready)
+        if self._tuner is None:
+            return 1
+        d_depth, d_workers = self._tuner.taken(time.time(),
+                                               waited,
+                                               ready,
+                                               _batch_bytes(data))
+        if d_workers != 0:
+            self._resize_workers(d_workers)
+        if d_depth != 0 or d_workers != 0:
+            self.log("Tuned prefetching of mode {}: {}.".format(
+                self.mode,
+                ", ".join("{}={}".format(k, v) for k, v in sorted(self.tuned_settings.items()))))
+        return 1 + d_depth
+
+    def _resize_workers(self, delta):
+        """
+        Add workers if `delta` is positive, otherwise retire some. Sensors
+        with a pool of workers should override it.
+        """
+        pass
+
+    def _get_from_data_queue(self, **kwargs):
+        """
+        Get an item from the data queue, and count the time waited.
+        """
+        start = time.time()
+        try:
+            return self.data_queue.get(**kwargs)
+        finally:
+            self._waited += time.time() - start
+
+    def _suspend_data_queue(self, mode):
+        """
+        Called before the mode of the sensor changes to `mode`. By default,
+        the data queue of the current mode is torn down.
+        """
         self._teardown_data_queue()
 
+    def _enqueue_indices(self, indices):
+        """
+        Put the indices of a batch to fetch into the index queue.
+        """
+        self.index_queue.put(indices)
+        self.metrics.record("dispatch", time.time() - self._dispatch_start)
+
+    def _enqueue_next_batch(self):
+        """
+        Put the indices of the next batch given by the sampler into the index
+        queue. By default, it goes on to the next epoch when an epoch
+        completes.
+        """
+        try:
+            self._enqueue_indices(self._next_indices())
+        except EpochCompletedEvent:
+            # In some cases, it is possible that an epoch is finished, yet
+            # the next epoch has not been started. In such cases, we just
+            # keep fetching.
+            self._enqueue_indices(self._next_indices())
+
+    def _dequeue_data(self, **kwargs):
+        """
+        Get a batch of data fetched from the data queue. `kwargs` are passed
+        to `get` of the queue. If workers die, the event put by them is
+        raised.
+        """
+        ret = self._get_from_data_queue(**kwargs)
+        _raise_if_dead_event(ret)
+        return ret
+
     @abc.abstractmethod
     def _setup_index_queue(self):
         """
@@ -368,20 +1399,22 @@ class Sensor(ValidatableProcessingBlock):
         pass
 
     def _forward(self, *args, **kwargs):
-        if self.index_queue.empty():
-            try:
-                # If we just finishes using the sensor as an iterator, calling
-                # forward now would results in errors, since no data is in the data
-                # queue now. If this is the case, we need to put same indices to
-                # prefetch to continue.
-                self.index_queue.put(self.sampler.next(self.batch_size_dict[self.mode]))
-            except EpochCompletedEvent:
-                # In some cases, it is possible that an epoch is finished, yet
-                # the next epoch has not been started. In such cases, we just
-                # keep fetching.
-                self.index_queue.put(self.sampler.next(self.batch_size_dict[self.mode]))
-
-        ret = self.data_queue.get()
+        if self._is_resident():
+            return self._next_resident()
+
+        if len(self._dispatched) == 0:
+            # If we just finishes using the sensor as an iterator, calling
+            # forward now would results in errors, since no data is in the data
+            # queue now. If this is the case, we need to put same indices to
+            # prefetch to continue. Note that the index queue may be empty
+            # while batches are in flight, since workers take indices as soon
+            # as they are put.
+            self._enqueue_next_batch()
+
+        ret = self._dequeue_data()
+        self._take_dispatched()
+        num_to_enqueue = self._taken(ret)
+        ret = self._joke(ret)
 
         A.cache_tensor_auto_scope(ret[0], "val_data" if self.is_val else "data")
         A.cache_tensor_auto_scope(ret[1], "val_labels" if self.is_val else "labels")
@@ -391,11 +1424,8 @@ class Sensor(ValidatableProcessingBlock):
         # second one below. But it would require the index queue size is not
         # fill before each data queue fetch. Though this is an easy condition
         # to meet, I would like to just keep it in the current way.
-        try:
-            self.index_queue.put(self.sampler.next(self.batch_size_dict[self.mode]))
-        except EpochCompletedEvent:
-            # Just keep prefetching the next batch.
-            self.index_queue.put(self.sampler.next(self.batch_size_dict[self.mode]))
+        for i in range(num_to_enqueue):
+            self._enqueue_next_batch()
 
         return self._data
 
@@ -434,23 +1464,32 @@ class Sensor(ValidatableProcessingBlock):
 class SimpleSensor(Sensor):
     """
     A simple sensor that uses a single thread to prefetch data.
+
+    If `num_threads` is larger than one, the thread gets each batch with a
+    pool of that many threads, each of which decodes a chunk of the batch and
+    writes it into the batch directly. It gives most of the throughput of
+    `ParallelSensor` for sources whose decoding releases the GIL, without
+    processes, thus no pickling of batches, and no fork.
     """
-    def _pre_forward(self):
-        super(SimpleSensor, self)._pre_forward()
-        if threading.active_count() == 1:
-            # Only the main thread is alive. Raise exception.
-            raise DataPrefetchThreadsDeadEvent
+    def __init__(self, *args, num_threads=1, **kwargs):
+        """
+        Args:
+            num_threads: int
+                The number of threads to get a batch with.
+        """
+        super(SimpleSensor, self).__init__(*args, **kwargs)
+        self.num_threads = num_threads
 
     def _setup_index_queue(self):
         # Set up a queue.
-        self._index_queue = Queue(self.queue_size)
+        self._index_queue = Queue(self.queue_capacity)
         # Start loading data from source according to mode.
         ## Put indices to prefetch.
-        for i in range(self.queue_size):
+        for i in range(self.prefetch_depth):
             try:
-                self._index_queue.put(self.sampler.next(self.batch_size_dict[self.mode]))
+                self._index_queue.put(self._next_indices())
             except EpochCompletedEvent:
-                self._index_queue.put(self.sampler.next(self.batch_size_dict[self.mode]))
+                self._index_queue.put(self._next_indices())
 
     @property
     def index_queue(self):
@@ -458,62 +1497,295 @@ class SimpleSensor(Sensor):
 
     def _setup_data_queue(self):
         # Set up a data queue.
-        self._data_queue = Queue(self.queue_size)
+        self._data_queue = Queue(self.queue_capacity)
         # Start loading data from source according to mode.
         ## Start the workers to fetch data.
         self.done_event = threading.Event()
+        if self.num_threads > 1:
+            self._fetcher = _ChunkedFetcher(self.source, self.num_threads)
+        else:
+            self._fetcher = None
         self.worker_thread = threading.Thread(
             target=_data_fetching_worker,
-            args=(self.source, self._index_queue, self._data_queue, self.done_event))
+            args=(self._fetcher or self.source, self._index_queue, self._data_queue,
+                  self.done_event, _DeviceStager(self.normalization, self.pin_memory),
+                  self.metrics, self._tuner))
+        self.worker_thread.daemon = True
         self.worker_thread.start()
 
     def _teardown_data_queue(self):
+        if self.done_event.is_set():
+            # Torn down already.
+            return
+
         self.done_event.set()
+        # The worker may be waiting to put data.
+        _drain(self._data_queue)
+        if self.worker_thread.is_alive():
+            self._index_queue.put(None)
         self.worker_thread.join()
+        if self._fetcher is not None:
+            self._fetcher.close()
 
     @property
     def data_queue(self):
         return self._data_queue
 
 
+class _EpochLedger(object):
+    """
+    Bookkeeping of epochs of batches in flight in `ParallelSensor`.
+
+    Indices of each batch are tagged with the epoch they belong to when being
+    put, and the marker of the end of an epoch carries the number of batches
+    in the epoch. So the consumer could tell when an epoch completes, even if
+    batches arrive out of order, or batches of the next epoch arrive earlier,
+    which are stashed till the epoch being consumed completes.
+
+    Batches and markers are also numbered in the order they are put, so the
+    consumer could hold items that arrive early, and release them in order.
+    """
+    def __init__(self):
+        # The epoch whose indices are being put, and the epoch being consumed.
+        self.enqueuing_epoch = 0
+        self.epoch = 0
+        self._num_enqueued = 0
+        self._num_received = {}
+        self._num_expected = {}
+        self._stash = []
+        # The number of items put, and of items released in order.
+        self._num_tagged = 0
+        self._num_released = 0
+        self._held = {}
+
+    @property
+    def drained(self):
+        """
+        Whether all batches of the epochs whose indices are put are consumed.
+        """
+        return self.epoch == self.enqueuing_epoch
+
+    def _sequence(self):
+        self._num_tagged += 1
+        return self._num_tagged - 1
+
+    def tag(self):
+        """
+        Count a batch to put, and return the epoch it belongs to, and its
+        sequence number.
+        """
+        self._num_enqueued += 1
+        return self.enqueuing_epoch, self._sequence()
+
+    def close(self):
+        """
+        Finish putting the current epoch. Return the epoch, the number of
+        batches in it, and the sequence number of its marker.
+        """
+        ret = (self.enqueuing_epoch, self._num_enqueued, self._sequence())
+        self.enqueuing_epoch += 1
+        self._num_enqueued = 0
+        return ret
+
+    def hold(self, sequence, item):
+        self._held[sequence] = item
+
+    def release(self):
+        """
+        Return the held item next in order, or None if it has not arrived.
+        """
+        item = self._held.pop(self._num_released, None)
+        if item is not None:
+            self._num_released += 1
+        return item
+
+    def expect(self, epoch, num_batches):
+        self._num_expected[epoch] = num_batches
+
+    def receive(self, epoch):
+        self._num_received[epoch] = self._num_received.get(epoch, 0) + 1
+
+    def stash(self, epoch, data):
+        self._stash.append((epoch, data))
+
+    def unstash(self, epoch=None):
+        """
+        Return the earliest stashed batch of `epoch` (or of any epoch if it is
+        None) as a tuple `(epoch, data)`, or None if there is no such batch.
+        """
+        for i, (e, d) in enumerate(self._stash):
+            if epoch is None or e == epoch:
+                del self._stash[i]
+                return e, d
+        return None
+
+    def completed(self):
+        """
+        Whether all batches of the epoch being consumed have been received.
+        """
+        n = self._num_expected.get(self.epoch)
+        return n is not None and self._num_received.get(self.epoch, 0) == n
+
+    def next_epoch(self):
+        self._num_expected.pop(self.epoch, None)
+        self._num_received.pop(self.epoch, None)
+        self.epoch += 1
+
+
 class ParallelSensor(Sensor):
     """
     The sensor that fetches data using multiple processes. It supports to be
     used as an iterator.
+
+    By default, batches fetched by worker processes are pickled to be sent to
+    the main process. If `shared_memory` is True, a ring of batches is
+    preallocated in shared memory. Workers write batches into the ring, and
+    only send the indices of the slots through the queue. It saves the
+    serialization cost for large batches, e.g., images, so throughput could
+    scale with the number of workers. Batches in shared memory keep the data
+    type returned by the source.
+
+    By default, worker processes are joined each time the mode of the sensor
+    changes, and new ones are forked when the sensor is set up in the new
+    mode. If `persistent_workers` is True, a pool of workers is kept for each
+    mode instead. Changing mode parks the pool of the current mode, which keeps
+    prefetching, and setting up the sensor in a mode that has a parked pool
+    resumes it. Thus, switching between training and validation costs no
+    fork or join, and the training batches are ready when validation
+    finishes. All the pools are only shut down by `teardown`. If
+    `val_on_device` is True, the pool of training is parked the same way
+    while validating, whether workers are persistent or not.
+
+    Index batches are tagged with a generation number, which is passed along
+    with the data fetched. `reset` starts a new generation, so data fetched for
+    the previous epoch is dropped, instead of tearing down the workers.
+
+    Index batches are also tagged with the epoch they belong to, and the end of
+    an epoch is marked by an `EpochCompletedEvent` that goes through the
+    pipeline along with data. When used as an iterator, by default, no more
+    indices are put after the end of an epoch, so the pipeline is drained by
+    the end of the iteration, and is filled again when the next iteration
+    starts. If `prefetch_across_epochs` is True, indices of the next epoch are
+    put while the current epoch finishes, so iterating multiple epochs does
+    not stall at epoch boundaries. Batches of the next epoch that arrive early
+    are held until the current iteration stops.
+
+    Workers take indices from a shared queue, so batches arrive in the order
+    they are fetched. If `ordered` is True, batches are delivered in the order
+    the sampler gives them instead: those that arrive early are held, and
+    released once the batches before them arrive. Since indices are only put
+    as batches are taken, no more batches than those prefetched are held, so
+    a sequence sampler gives reproducible runs with any number of workers.
     """
-    def __init__(self, num_workers=4, *args, **kwargs):
+    # Attributes that hold the state of the pipeline of a mode, which are
+    # parked when the mode changes if workers are persistent.
+    _PIPELINE_ATTRS = ["_index_queue",
+                       "_prefetch_data_queue",
+                       "_data_queue",
+                       "_ring",
+                       "done_event",
+                       "worker_processes",
+                       "preloading_thread",
+                       "supervising_thread",
+                       "sampler",
+                       "epoch_finished",
+                       "_ledger",
+                       "_generation",
+                       "_dispatched",
+                       "_resume_state",
+                       "_tuner"]
+
+    def __init__(self,
+                 num_workers=4,
+                 *args,
+                 shared_memory=False,
+                 persistent_workers=False,
+                 prefetch_across_epochs=False,
+                 max_workers=None,
+                 ordered=False,
+                 **kwargs):
+        """
+        Args:
+            num_workers: int
+                The number of processes to fetch data.
+            shared_memory: bool
+                Whether to pass batches from workers through preallocated
+                shared memory instead of pickling them. The shape of slots is
+                decided by a batch fetched upon setup, so the source is
+                supposed to return samples of fixed shape.
+            persistent_workers: bool
+                Whether to keep worker processes of each mode alive across
+                mode changes. See the class documentation for details.
+            prefetch_across_epochs: bool
+                Whether to keep prefetching the next epoch when the sensor is
+                used as an iterator.
+            max_workers: int
+                The largest number of workers when tuning. The number of CPUs
+                by default.
+            ordered: bool
+                Whether to deliver batches in the order they are sampled. See
+                the class documentation for details.
+        """
         super(ParallelSensor, self).__init__(*args, **kwargs)
         self.num_workers = num_workers
+        self.shared_memory = shared_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_across_epochs = prefetch_across_epochs
+        self.max_workers = max_workers or mp.cpu_count()
+        self.ordered = ordered
         self.queue_size *= num_workers
         if self.queue_size > self.num_batches_per_epoch:
             self.queue_size = self.num_batches_per_epoch
 
-    def __iter__(self):
         self.epoch_finished = False
-        if self.index_queue.empty():
-            try:
-                # Upon setup of sensor, we have some indices put in the queue, so
-                # it may not be necessary put some indices. However, after the
-                # second entry to create an iterator, it is possible the index
-                # queue is empty, since further prefetching is disabled. In such a
-                # case, we need to put some indices to prefetch to get started.
-                self.index_queue.put(self.sampler.next(self.batch_size_dict[self.mode]))
-            except EpochCompletedEvent as e:
-                # If the dataset is small, we could finish the dataset while we
-                # are creating the iterator (since we are prefetching data upon
-                # setup). In such a case, we would call it a day.
-                self.epoch_finished = True
-                self.index_queue.put(e)
+        self._ledger = _EpochLedger()
+        self._generation = 0
+        # The mode whose pipeline is running now, and pipelines parked.
+        self._active_mode = None
+        self._parked_pipelines = {}
+
+    def __iter__(self):
+        if self._is_resident():
+            return self
+
+        if self.epoch_finished and self._ledger.drained:
+            # The pipeline has been drained since no more indices are put
+            # after the last epoch. Fill it to get started.
+            self.epoch_finished = False
+            self._fill_index_queue()
 
         return self
 
     def __next__(self):
-        # Get the next batch of data.
-        ret = self.data_queue.get(timeout=A.TIMEOUT)
-
-        # Raise `StopIteration` since we have received the epoch completion
-        # signal we sent earlier.
-        if type(ret) is EpochCompletedEvent:
+        if self._is_resident():
+            ret = self._next_resident(stop_at_epoch_end=True)
+            if ret is None:
+                raise StopIteration
+            return ret
+
+        # Get the next batch of the epoch being iterated. Batches of the next
+        # epoch are held if they arrive earlier.
+        while not self._ledger.completed():
+            item = self._ledger.unstash(self._ledger.epoch)
+            if item is None:
+                epoch, ret = self._dequeue_tagged()
+                if type(ret) is EpochCompletedEvent:
+                    self._ledger.expect(epoch, ret.num_batches)
+                    continue
+                if epoch != self._ledger.epoch:
+                    self._ledger.stash(epoch, ret)
+                    continue
+            else:
+                epoch, ret = item
+            self._ledger.receive(epoch)
+            self._take_dispatched()
+            num_to_enqueue = self._taken(ret)
+            ret = self._joke(ret)
+            break
+        else:
+            # Raise `StopIteration` since all batches before the epoch
+            # completion signal we sent earlier have been received.
+            self._ledger.next_epoch()
             raise StopIteration
 
         # If not, we do our normal data stuff.
@@ -522,33 +1794,214 @@ class ParallelSensor(Sensor):
         self._data = ret
 
         # Put the indices of the batch to be prefetched if we still have not
-        # finished an epoch. But if we have, stop fetching data by putting the
-        # EpochCompletedEvent to the index queue.
-        if not self.epoch_finished:
+        # finished an epoch. But if we have, stop fetching data unless
+        # prefetching across epochs.
+        for i in range(num_to_enqueue):
+            if self.epoch_finished:
+                break
+            self._enqueue_next_batch(stop_at_epoch_end=not self.prefetch_across_epochs)
+
+        return ret
+
+    def _forward(self, *args, **kwargs):
+        if self.epoch_finished and not self._is_resident():
+            # Data crunching after iteration goes on to the next epoch. The
+            # iteration may have stopped with batches left in flight, so the
+            # pipeline is filled up to the depth from them.
+            self.epoch_finished = False
+            for i in range(self.prefetch_depth - len(self._dispatched)):
+                self._enqueue_next_batch()
+
+        return super(ParallelSensor, self)._forward(*args, **kwargs)
+
+    def _setup(self):
+        if self._is_resident():
+            super(ParallelSensor, self)._setup()
+            return
+        if self.persistent_workers and self._active_mode == self.mode:
+            # The pipeline of this mode is running already.
+            self.source.setup()
+            return
+        if self.mode in self._parked_pipelines:
+            self.source.setup()
+            self._resume_pipeline(self.mode)
+            self._setup_tuner()
+            return
+
+        super(ParallelSensor, self)._setup()
+        self._active_mode = self.mode
+
+    def reset(self):
+        if not self.persistent_workers or self._is_resident():
+            if self.mode in self._parked_pipelines:
+                # Parked while validating on the device. It is restarted.
+                self._resume_pipeline(self.mode)
+            super(ParallelSensor, self).reset()
+            return
+
+        # Resume or create the pipeline of the current mode, and start the
+        # epoch over without restarting workers.
+        is_new = self._active_mode != self.mode and self.mode not in self._parked_pipelines
+        self.setup()
+        if is_new:
+            # Workers have just started prefetching from the beginning.
+            return
+
+        self._generation += 1
+        self._drain_index_queue()
+        self.sampler.reset()
+        self._reset_dispatched()
+        self._setup_tuner()
+        self.epoch_finished = False
+        self._ledger = _EpochLedger()
+        self._fill_index_queue()
+
+    def teardown(self):
+        if self._active_mode is not None:
+            self._teardown_data_queue()
+        for mode in list(self._parked_pipelines.keys()):
+            self._resume_pipeline(mode)
+            self._teardown_data_queue()
+        self._resident = {}
+        self.source.teardown()
+
+    def _suspend_data_queue(self, mode):
+        if not self.persistent_workers and not self._is_resident(mode):
+            super(ParallelSensor, self)._suspend_data_queue(mode)
+            return
+
+        if self._active_mode is not None:
+            self._parked_pipelines[self._active_mode] \
+                = dict((k, getattr(self, k)) for k in self._PIPELINE_ATTRS)
+            self.log("Parked workers of mode {}.".format(self._active_mode))
+            self._active_mode = None
+
+    def _resume_pipeline(self, mode):
+        pipeline = self._parked_pipelines.pop(mode)
+        for k in self._PIPELINE_ATTRS:
+            setattr(self, k, pipeline[k])
+        self._active_mode = mode
+        self.log("Resumed workers of mode {}.".format(mode))
+
+    def _drain_index_queue(self):
+        """
+        Remove indices that have not been taken by workers. Indices that are
+        missed would be fetched, and dropped given their generation is old.
+        Workers asked to retire are still asked to.
+        """
+        num_retiring = 0
+        while True:
             try:
-                self.index_queue.put(self.sampler.next(self.batch_size_dict[self.mode]))
-            except EpochCompletedEvent as e:
+                if self._index_queue.get_nowait() is None:
+                    num_retiring += 1
+            except queue.Empty:
+                break
+        for i in range(num_retiring):
+            self._index_queue.put(None)
+
+    def _enqueue_indices(self, indices):
+        epoch, sequence = self._ledger.tag()
+        self.index_queue.put(((self._generation, epoch, sequence), indices))
+        self.metrics.record("dispatch", time.time() - self._dispatch_start)
+
+    def _enqueue_next_batch(self, stop_at_epoch_end=False):
+        """
+        Put the indices of the next batch. If the epoch completes, put the
+        marker of the epoch end first. If `stop_at_epoch_end` is True, stop
+        there, and set `epoch_finished`.
+        """
+        try:
+            self._enqueue_indices(self._next_indices())
+        except EpochCompletedEvent:
+            e = EpochCompletedEvent()
+            epoch, e.num_batches, sequence = self._ledger.close()
+            self.index_queue.put(((self._generation, epoch, sequence), e))
+            if stop_at_epoch_end:
                 self.epoch_finished = True
-                self.index_queue.put(e)
+                return
+            self._enqueue_indices(self._next_indices())
 
-        return ret
+    def _dequeue_tagged(self, **kwargs):
+        """
+        Get the next item of the current generation from the data queue, and
+        return it along with the epoch it belongs to. If `ordered`, items are
+        returned in the order they are put.
+        """
+        while True:
+            if self.ordered:
+                item = self._ledger.release()
+                if item is not None:
+                    return item
+            item = self._get_from_data_queue(**kwargs)
+            _raise_if_dead_event(item)
+            (generation, epoch, sequence), data = item
+            if generation != self._generation:
+                continue
+            if not self.ordered:
+                return epoch, data
+            self._ledger.hold(sequence, (epoch, data))
+
+    def _dequeue_data(self, **kwargs):
+        # Batches are taken as they arrive, while epochs are accounted.
+        while True:
+            item = self._ledger.unstash()
+            if item is None:
+                epoch, data = self._dequeue_tagged(**kwargs)
+                if type(data) is EpochCompletedEvent:
+                    self._ledger.expect(epoch, data.num_batches)
+                    data = None
+            else:
+                epoch, data = item
+            if data is not None:
+                self._ledger.receive(epoch)
+            while self._ledger.completed():
+                self._ledger.next_epoch()
+            if data is not None:
+                return data
+
+    def _fill_index_queue(self):
+        for i in range(self.prefetch_depth):
+            self._enqueue_next_batch()
 
-    def _pre_forward(self):
-        super(ParallelSensor, self)._pre_forward()
-        if len(mp.active_children()) == 0:
-            # If all child processes are dead, we raise error.
-            raise DataPrefetchProcessesDeadEvent
-        if not self.preloading_thread.is_alive():
-            # The thread to move data from CPU to GPU is dead.
-            raise DataPrefetchThreadsDeadEvent
+    def _worker_bounds(self):
+        return {"num_workers": self.num_workers, "max_workers": self.max_workers}
+
+    @property
+    def tuned_settings(self):
+        num_workers = self.num_workers if self._tuner is None else self._tuner.num_workers
+        # The queue size is given per worker.
+        return {"queue_size": -(-self.prefetch_depth // num_workers),
+                "num_workers": num_workers}
+
+    def _resize_workers(self, delta):
+        for i in range(abs(delta)):
+            if delta > 0:
+                self._start_worker()
+            else:
+                # A worker quits upon a None, after the indices put before.
+                self._index_queue.put(None)
+
+    def _start_worker(self):
+        # Workers are daemonic, so they are terminated at exit even if the
+        # sensor is not torn down.
+        process = mp.Process(
+            target=_data_fetching_worker_process,
+            args=(len(self.worker_processes), self.source, self._index_queue,
+                  self._prefetch_data_queue, self.done_event, self._ring))
+        process.daemon = True
+        process.start()
+        self.worker_processes.append(process)
 
     def _setup_index_queue(self):
-        self._index_queue = mp.Queue(self.queue_size)
-        for i in range(self.queue_size):
-            try:
-                self._index_queue.put(self.sampler.next(self.batch_size_dict[self.mode]))
-            except EpochCompletedEvent:
-                self._index_queue.put(self.sampler.next(self.batch_size_dict[self.mode]))
+        # The number of indices in the queue is bounded by the number of
+        # batches to prefetch, since indices are only put when a batch is
+        # taken. The queue has no size limit, so putting indices never blocks
+        # the main thread, e.g., when workers die.
+        self._index_queue = mp.Queue()
+        self._generation = 0
+        self.epoch_finished = False
+        self._ledger = _EpochLedger()
+        self._fill_index_queue()
 
     @property
     def index_queue(self):
@@ -556,39 +2009,329 @@ class ParallelSensor(Sensor):
 
     def _setup_data_queue(self):
         # Set up a data queue.
-        self._prefetch_data_queue = mp.Queue(self.queue_size)
+        self._prefetch_data_queue = mp.Queue(self.queue_capacity)
+        if self._tuner is None:
+            num_workers, max_workers = self.num_workers, self.num_workers
+        else:
+            num_workers, max_workers = self._tuner.num_workers, self._tuner.max_workers
+        if self.shared_memory:
+            # A slot for each batch that could be in the prefetch queue, being
+            # written by a worker, or being read by the preloading thread.
+            template = self.source.get(list(range(min(self.batch_size, self.source.size))))
+            num_slots = self.queue_capacity
+            if self._tuner is not None and self.max_prefetch_bytes is not None:
+                # Batches beyond the bytes allowed wait for slots.
+                num_slots = min(num_slots, max(1, self.max_prefetch_bytes // _batch_bytes(template)))
+            self._ring = _SharedBatchRing(template,
+                                          self.batch_size,
+                                          num_slots + max_workers + 1)
+        else:
+            self._ring = None
         # Start loading data from source according to mode.
         ## Start the workers to fetch data.
         self.done_event = mp.Event()
         self.worker_processes = []
-        for i in range(self.num_workers):
-            process = mp.Process(
-                target=_data_fetching_worker_process,
-                args=(i, self.source, self._index_queue, self._prefetch_data_queue, self.done_event))
-            process.start()
-            self.worker_processes.append(process)
+        for i in range(num_workers):
+            self._start_worker()
 
         # Start a thread to load the CPU data to GPU.
-        self._data_queue = Queue(self.queue_size * 2)
+        self._data_queue = Queue(self.queue_capacity * 2)
         self.preloading_thread = threading.Thread(
             target=_data_preloading_worker,
-            args=(self._prefetch_data_queue, self._data_queue, self.done_event))
+            args=(self._prefetch_data_queue, self._data_queue, self.done_event,
+                  _DeviceStager(self.normalization, self.pin_memory), self.metrics,
+                  self._ring, self._tuner))
+        self.preloading_thread.daemon = True
         self.preloading_thread.start()
 
+        # Start a thread to watch the workers, so no check on them is needed
+        # when fetching data.
+        self.supervising_thread = threading.Thread(
+            target=_data_supervising_worker,
+            args=(self.worker_processes, self._data_queue, self.done_event))
+        self.supervising_thread.daemon = True
+        self.supervising_thread.start()
+
     def _teardown_data_queue(self):
+        if self.done_event.is_set():
+            # Torn down already.
+            return
+
         self.done_event.set()
-        for i in range(self.num_workers):
-            self.log("Waiting worker {} to join ...".format(i))
-            self.worker_processes[i].join()
-        # When training on MNIST, the preloading_thread dies each time data
-        # queues are torn down. To prevent deadlock, check whether it is dead
-        # or not. Why it dies is not clear.
-        if self.preloading_thread.is_alive():
+        # From now on, data are dropped by the preloading thread. Make room
+        # for the batch it may be putting.
+        _drain(self._data_queue)
+        # A worker that dies may leave locks of queues held, so the rest may
+        # block forever. Terminate them instead of asking them to quit. Since
+        # a worker may die while we are waiting, e.g., a worker being killed
+        # is what fails the preloading thread, we keep watching.
+        def is_broken():
+            return any(p.exitcode not in (None, 0) for p in self.worker_processes)
+        broken = is_broken()
+        for p in self.worker_processes:
+            if p.is_alive():
+                if broken:
+                    p.terminate()
+                else:
+                    self._index_queue.put(None)
+        self.log("Waiting workers to join ...")
+        alive = [p for p in self.worker_processes if p.is_alive()]
+        while len(alive) > 0:
+            connection.wait([p.sentinel for p in alive], A.TIMEOUT)
+            alive = [p for p in alive if p.is_alive()]
+            if not broken and is_broken():
+                broken = True
+                for p in alive:
+                    p.terminate()
+        for p in self.worker_processes:
+            p.join()
+        if broken:
+            # For the same reason, the preloading thread may not be able to
+            # read the queue anymore. It is a daemon, so it is left as it is.
+            self.log("Workers died. Preloading thread is not joined.")
+        elif self.preloading_thread.is_alive():
             self._prefetch_data_queue.put(None)
             self.log("Waiting preloading thread to join ...")
             self.preloading_thread.join()
         else:
             self.log("Preloading thread is dead already.")
+        self.supervising_thread.join()
+        self._ring = None
+        self._active_mode = None
+
+    @property
+    def data_queue(self):
+        return self._data_queue
+
+
+class StreamingSensor(Sensor):
+    """
+    The sensor that streams data from a `StreamSource`, for datasets larger
+    than memory. No index is sampled. Instead, shards of the source are
+    shuffled by each epoch, and split across `world_size` ranks, then across
+    `num_workers` processes. Each worker reads its shards sequentially,
+    shuffles samples with a bounded buffer of `buffer_size` samples, and
+    batches them, so the last batch of each worker in an epoch may be
+    smaller. Thus, the number of workers is at most the number of shards of
+    a rank.
+
+    A worker goes on to the next epoch once it finishes one, so the pipeline
+    never drains. An epoch completes when all workers finish it. When the
+    sensor is used as an iterator, an iteration stops by the end of the
+    epoch, and batches of the next epoch that arrive earlier are held.
+
+    Sensing resumes from the beginning of the epoch being consumed, e.g.,
+    after `setup` or loading a state.
+    """
+    def __init__(self,
+                 num_workers=4,
+                 *args,
+                 buffer_size=1000,
+                 seed=0,
+                 rank=0,
+                 world_size=1,
+                 **kwargs):
+        """
+        Args:
+            num_workers: int
+                The number of processes to stream data.
+            buffer_size: int
+                The number of samples each worker holds to shuffle.
+            seed: int
+                The seed of the order of shards, and of shuffling.
+            rank: int
+                The rank of the process among `world_size` processes of
+                distributed training, which stream disjoint shards.
+        """
+        # Used to tell the number of batches upon building.
+        self.rank = rank
+        self.world_size = world_size
+        super(StreamingSensor, self).__init__(*args, **kwargs)
+        if self.val_on_device:
+            raise ValueError("Streaming sensors stream all splits, which cannot be kept on the device.")
+        self.num_workers = num_workers
+        self.buffer_size = buffer_size
+        self.seed = seed
+        # The epoch being consumed, by mode.
+        self._epochs = {}
+
+    @property
+    def num_batches_per_epoch(self):
+        """
+        The number of batches of an epoch of the current mode estimated by the
+        number of samples of the source, or None if it is unknown.
+        """
+        size = self.source.size
+        if size is None:
+            return None
+        return -(-size // (self.batch_size_dict[self.mode] * self.world_size))
+
+    @property
+    def epoch(self):
+        return self._epochs.get(self.mode, 0)
+
+    @epoch.setter
+    def epoch(self, epoch):
+        self._epochs[self.mode] = epoch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self._receive(stop_at_epoch_end=True)
+        if data is None:
+            raise StopIteration
+        return self._take(data)
+
+    def _forward(self, *args, **kwargs):
+        return self._take(self._receive(stop_at_epoch_end=False))
+
+    def _take(self, data):
+        self._taken(data)
+        data = self._joke(data)
+        A.cache_tensor_auto_scope(data[0], "val_data" if self.is_val else "data")
+        A.cache_tensor_auto_scope(data[1], "val_labels" if self.is_val else "labels")
+        self._data = data
+        return data
+
+    def _receive(self, stop_at_epoch_end):
+        """
+        Return the next batch. If `stop_at_epoch_end` is True, only batches of
+        the epoch being consumed are returned, and None is returned once it
+        completes.
+        """
+        while True:
+            item = self._unstash(self.epoch if stop_at_epoch_end else None)
+            if item is not None:
+                return item
+            if stop_at_epoch_end and self._epoch_completed():
+                self._next_epoch()
+                return None
+
+            epoch, data = self._dequeue_data()
+            if type(data) is EpochCompletedEvent:
+                # Batches of a worker arrive in order, so all batches of an
+                # epoch have arrived once all workers finish it.
+                self._num_finished[epoch] = self._num_finished.get(epoch, 0) + 1
+                while not stop_at_epoch_end and self._epoch_completed():
+                    self._next_epoch()
+                continue
+            if stop_at_epoch_end and epoch != self.epoch:
+                self._stash.append((epoch, data))
+                continue
+            return data
+
+    def _unstash(self, epoch=None):
+        for i, (e, d) in enumerate(self._stash):
+            if epoch is None or e == epoch:
+                del self._stash[i]
+                return d
+        return None
+
+    def _epoch_completed(self):
+        return self._num_finished.get(self.epoch, 0) == len(self.worker_processes)
+
+    def _next_epoch(self):
+        self._num_finished.pop(self.epoch, None)
+        self.epoch += 1
+
+    def reset(self):
+        """
+        Start the epoch being consumed over.
+        """
+        if self.is_setup:
+            self._teardown_data_queue()
+        self.setup()
+
+    def state_dict(self):
+        """
+        Return the state to resume sensing of the current mode from. Only the
+        epoch is kept.
+        """
+        return {"mode": self.mode, "epoch": self.epoch}
+
+    def load_state_dict(self, state):
+        if state["mode"] != self.mode:
+            raise ValueError("The state of mode {} cannot be loaded in mode {}.".format(
+                state["mode"], self.mode))
+        is_running = self.is_setup
+        if is_running:
+            self._teardown_data_queue()
+        self.epoch = state["epoch"]
+        if is_running:
+            self.setup()
+
+    def _setup(self):
+        self.source.setup()
+        self._waited = 0
+        self._num_finished = {}
+        self._stash = []
+        self._setup_data_queue()
+
+    def _setup_index_queue(self):
+        pass
+
+    @property
+    def index_queue(self):
+        return None
+
+    def _setup_data_queue(self):
+        num_shards = len(self.source.data[self.rank::self.world_size])
+        if num_shards == 0:
+            raise ValueError("No shard is left for rank {} of {}.".format(self.rank, self.world_size))
+        num_workers = min(self.num_workers, num_shards)
+
+        self._prefetch_data_queue = mp.Queue(self.queue_size)
+        self.done_event = mp.Event()
+        self.worker_processes = []
+        for i in range(num_workers):
+            process = mp.Process(
+                target=_data_streaming_worker_process,
+                args=(i, self.source, num_workers, self.batch_size, self.buffer_size,
+                      self.seed, self.rank, self.world_size, self.epoch,
+                      self._prefetch_data_queue, self.done_event))
+            process.daemon = True
+            process.start()
+            self.worker_processes.append(process)
+
+        self._data_queue = Queue(self.queue_size)
+        self.preloading_thread = threading.Thread(
+            target=_data_preloading_worker,
+            args=(self._prefetch_data_queue, self._data_queue, self.done_event,
+                  _DeviceStager(self.normalization, self.pin_memory), self.metrics))
+        self.preloading_thread.daemon = True
+        self.preloading_thread.start()
+
+        self.supervising_thread = threading.Thread(
+            target=_data_supervising_worker,
+            args=(self.worker_processes, self._data_queue, self.done_event))
+        self.supervising_thread.daemon = True
+        self.supervising_thread.start()
+
+    def _teardown_data_queue(self):
+        if self.done_event.is_set():
+            # Torn down already.
+            return
+
+        self.done_event.set()
+        # Workers quit once they see the event. Make room for the batch the
+        # preloading thread may be putting, which drops data from now on.
+        _drain(self._data_queue)
+        self.log("Waiting workers to join ...")
+        alive = [p for p in self.worker_processes if p.is_alive()]
+        while len(alive) > 0:
+            connection.wait([p.sentinel for p in alive], A.TIMEOUT)
+            alive = [p for p in alive if p.is_alive()]
+        for p in self.worker_processes:
+            p.join()
+        if any(p.exitcode != 0 for p in self.worker_processes):
+            # The preloading thread may not be able to read the queue
+            # anymore. It is a daemon, so it is left as it is.
+            self.log("Workers died. Preloading thread is not joined.")
+        elif self.preloading_thread.is_alive():
+            self._prefetch_data_queue.put(None)
+            self.preloading_thread.join()
+        self.supervising_thread.join()
 
     @property
     def data_queue(self):
@@ -44,11 +44,15 @@ import abc
 import sys
 import inspect
 import os
+import json
+import mmap
+import multiprocessing
 import six.moves.urllib.request, six.moves.urllib.parse, six.moves.urllib.error
 import tarfile
 
 import numpy as np
 import tensorflow as tf
+import torch as th
 from torch.utils.data.dataloader import default_collate
 
 from .blocks import DataBlock, FlowBlock
@@ -72,6 +76,16 @@ class Source(DataBlock):
 
     Subclasses should implement their own `_get` method normally (though a
     default `_get` method is implemented for PyTorch for now).
+
+    If the whole dataset is held in contiguous arrays, a subclass could
+    provide them through `bulk_data`, and the default `_get` gathers a batch
+    by `get_many`, which indexes each array once with all the indices, instead
+    of getting samples one by one. Transforms are then done on the whole
+    batch in `_bulk_transform`.
+
+    Samples are indexed by their labels upon the first call of `label_index`
+    in each mode, from which subsets are made by `subset` without reading
+    samples.
     """
     NAME = "Source"
 
@@ -85,6 +99,8 @@ class Source(DataBlock):
         super(Source, self).__init__(*args, **kwargs)
         self.mode = A.Mode.TRAIN
         self.work_dir = work_dir
+        # Indices of samples by label, by mode.
+        self._label_indices = {}
 
     @abc.abstractproperty
     def data(self):
@@ -106,6 +122,52 @@ class Source(DataBlock):
         """
         pass
 
+    @property
+    def bulk_data(self):
+        """
+        A list of arrays (torch Tensor or numpy ndarray) that hold the whole
+        dataset in its current mode, with samples stacked along the first
+        dimension, e.g., `[images, labels]`. It is None if the source cannot
+        provide it, which is the default.
+        """
+        return None
+
+    @property
+    def labels(self):
+        """
+        A 1-D numpy array of the labels of all samples in the current mode. By
+        default, it is the second array of `bulk_data`, or labels of batches
+        got otherwise, which decodes the whole dataset. Subclasses that could
+        read labels alone should override it.
+        """
+        if self.bulk_data is not None:
+            labels = self.bulk_data[1]
+        else:
+            labels = np.concatenate(
+                [_as_numpy(self.get(np.arange(i, min(i + 1024, self.size)))[1])
+                 for i in range(0, self.size, 1024)])
+        return _as_numpy(labels)
+
+    def label_index(self):
+        """
+        Return a dict from each label to the ascending indices of the samples
+        with it in the current mode. It is built by sorting `labels` the first
+        time, and kept afterwards.
+        """
+        if self.mode not in self._label_indices:
+            labels = self.labels
+            order = np.argsort(labels, kind="stable")
+            classes, starts = np.unique(labels[order], return_index=True)
+            self._label_indices[self.mode] \
+                = dict(zip(classes.tolist(), np.split(order, starts[1:])))
+        return self._label_indices[self.mode]
+
+    def subset(self, **kwargs):
+        """
+        Return a `SubsetSource` of this source, which is built with `kwargs`.
+        """
+        return SubsetSource(source_in=self, **kwargs)
+
     def set_mode(self, mode):
         A.check_mode(mode)
         self.mode = mode
@@ -119,17 +181,749 @@ class Source(DataBlock):
 
         return self._get(indices)
 
+    def get_many(self, indices):
+        """
+        Gather the batch of `indices` from `bulk_data`, with one indexing
+        operation for each array, and transform it by `_bulk_transform`.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        batch = []
+        for d in self.bulk_data:
+            if isinstance(d, th.Tensor):
+                batch.append(d[th.from_numpy(indices)])
+            else:
+                batch.append(d[indices])
+
+        return self._bulk_transform(batch)
+
+    def _bulk_transform(self, batch):
+        """
+        Transforms done on a batch gathered by `get_many`, which should be
+        equivalent to the ones done on each sample when getting it from
+        `data`. By default, the batch is returned as it is.
+        """
+        return batch
+
     def _get(self, indices):
         """
         This is a default `get` method to work with the `DataSet` class of
         PyTorch. A customized source that does not use `DataSet` in PyTorch
         should implement a `get` method of its own.
+
+        If the source provides `bulk_data`, the batch is gathered by
+        `get_many`.
         """
+        if self.bulk_data is not None:
+            return self.get_many(indices)
+
         # Only work in torch for now.
         sample_batch = default_collate([self.data[i] for i in indices])
         return sample_batch
 
 
+class InMemorySource(Source):
+    """
+    A source whose data are held in memory as arrays, which are gathered by
+    batch. For example, to make a source of numpy arrays::
+
+        source = InMemorySource(train_data=[images, labels],
+                                val_data=[val_images, val_labels],
+                                name="source")
+
+    Each data is a list of arrays (torch Tensor or numpy ndarray) that have
+    the same number of samples in the first dimension.
+    """
+    def __init__(self, train_data=None, val_data=None, test_data=None, **kwargs):
+        super(InMemorySource, self).__init__(**kwargs)
+        self._data_dict = {A.Mode.TRAIN: train_data,
+                           A.Mode.VAL: val_data,
+                           A.Mode.TEST: test_data}
+        for mode, data in self._data_dict.items():
+            if data is not None:
+                for d in data:
+                    if len(d) != len(data[0]):
+                        raise ValueError("Arrays of mode {} do not have the"
+                                         " same number of samples.".format(mode))
+
+    @property
+    def data(self):
+        data = self._data_dict[self.mode]
+        if data is None:
+            raise ValueError("No data is provided for mode {}.".format(self.mode))
+        return data
+
+    @property
+    def bulk_data(self):
+        return self.data
+
+    @property
+    def size(self):
+        return len(self.data[0])
+
+
+class SubsetSource(Source):
+    """
+    A view of samples of another source selected by their labels, which
+    shares the storage of the source. For example, to take 100 samples of each
+    of the digits 0 and 1 of MNIST::
+
+        subset = SubsetSource(source_in=mnist,
+                              classes=[0, 1],
+                              num_per_class=100,
+                              name="subset")
+
+    Samples are selected in each mode when the subset is set up, by indexing
+    `label_index` of the source, so no sample is read. Batches are got from
+    the source by the indices of the samples selected. Subclasses could select
+    samples otherwise by overriding `_select`.
+    """
+    def __init__(self,
+                 source_in=None,
+                 classes=None,
+                 num_per_class=None,
+                 predicate=None,
+                 seed=None,
+                 **kwargs):
+        """
+        Args:
+            source_in: Source
+                The source to select samples from.
+            classes: list
+                The labels of samples to select. All labels by default.
+            num_per_class: int or dict
+                The number of samples to select for each label, or a dict from
+                labels to numbers. All samples of a label by default.
+            predicate: callable
+                If given, only labels for which it returns True are selected.
+            seed: int
+                If given, samples of a label are drawn randomly with it.
+                Otherwise, the first ones are taken.
+        """
+        super(SubsetSource, self).__init__(**kwargs)
+        self.source = source_in
+        self.classes = classes
+        self.num_per_class = num_per_class
+        self.predicate = predicate
+        self.seed = seed
+        # Indices of samples selected from the source, by mode.
+        self._indices_dict = {}
+
+    def _setup(self):
+        if self.source.mode != self.mode:
+            self.source.set_mode(self.mode)
+        self.source.setup()
+        if self.mode not in self._indices_dict:
+            self._indices_dict[self.mode] = self._select()
+
+    def _select(self):
+        """
+        Return the ascending indices of the samples of the source in the
+        current mode to select.
+        """
+        index = self.source.label_index()
+        classes = sorted(index.keys()) if self.classes is None else self.classes
+        if self.predicate is not None:
+            classes = [c for c in classes if self.predicate(c)]
+        rng = None if self.seed is None else np.random.default_rng(self.seed)
+
+        selected = []
+        for c in classes:
+            indices = index.get(c, np.zeros(0, dtype=np.int64))
+            if isinstance(self.num_per_class, dict):
+                n = self.num_per_class.get(c)
+            else:
+                n = self.num_per_class
+            if n is not None and n < len(indices):
+                indices = np.sort(rng.choice(indices, n, replace=False)) \
+                          if rng is not None else indices[:n]
+            selected.append(indices)
+        return np.sort(np.concatenate(selected)) if selected else np.zeros(0, dtype=np.int64)
+
+    @property
+    def data(self):
+        """
+        The indices of the samples selected from the source in the current
+        mode.
+        """
+        return self._indices_dict[self.mode]
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    @property
+    def labels(self):
+        return self.source.labels[self.data]
+
+    @property
+    def normalization(self):
+        return self.source.normalization
+
+    def _get(self, indices):
+        return self.source.get(self.data[np.asarray(indices, dtype=np.int64)])
+
+
+def _as_numpy(d):
+    if isinstance(d, th.Tensor):
+        return d.numpy()
+    return np.asarray(d)
+
+
+def shuffle_buffer(samples, buffer_size, rng):
+    """
+    Shuffle the iterator `samples` with a buffer of `buffer_size` samples:
+    each sample read replaces one drawn from the buffer by `rng`, a numpy
+    `Generator`, which is yielded. So samples are shuffled locally with
+    bounded memory. The buffer is flushed in random order at the end.
+    """
+    buf = []
+    for sample in samples:
+        if len(buf) < buffer_size:
+            buf.append(sample)
+            continue
+        i = rng.integers(buffer_size)
+        yield buf[i]
+        buf[i] = sample
+    for i in rng.permutation(len(buf)):
+        yield buf[i]
+
+
+class StreamSource(Source):
+    """
+    A source whose data are streamed from shards, e.g., files, read
+    sequentially, instead of being got by indices, for datasets larger than
+    memory. It is to be used with `StreamingSensor`, which splits shards
+    across workers. For example::
+
+        source = StreamSource(train_shards=glob.glob("train-*.npz"),
+                              read_fn=read_npz,
+                              name="source")
+
+    where `read_fn` reads a shard, and returns an iterator of samples, each a
+    list of arrays, e.g., `[image, label]`. Subclasses may override `_read`
+    instead.
+
+    The number of samples of each mode is optional, and only needed to tell
+    the number of batches in an epoch.
+    """
+    def __init__(self,
+                 train_shards=None,
+                 val_shards=None,
+                 test_shards=None,
+                 read_fn=None,
+                 sizes=None,
+                 **kwargs):
+        """
+        Args:
+            train_shards, val_shards, test_shards: list
+                Shards of each mode, e.g., paths of files.
+            read_fn: callable
+                Read a shard into an iterator of samples.
+            sizes: dict
+                The number of samples of modes, e.g., `{"train": 10000}`.
+        """
+        super(StreamSource, self).__init__(**kwargs)
+        self._shards_dict = {A.Mode.TRAIN: train_shards,
+                             A.Mode.VAL: val_shards,
+                             A.Mode.TEST: test_shards}
+        self.read_fn = read_fn
+        self.sizes = sizes or {}
+
+    @property
+    def data(self):
+        """
+        The list of shards of the current mode.
+        """
+        shards = self._shards_dict[self.mode]
+        if shards is None:
+            raise ValueError("No shards are provided for mode {}.".format(self.mode))
+        return list(shards)
+
+    @property
+    def size(self):
+        """
+        The number of samples of the current mode, or None if unknown.
+        """
+        return self.sizes.get(self.mode)
+
+    def _read(self, shard):
+        """
+        Return an iterator of samples in `shard`.
+        """
+        return self.read_fn(shard)
+
+    def stream(self, shards, buffer_size=0, rng=None):
+        """
+        Return an iterator of samples of `shards` read in order, shuffled by a
+        buffer of `buffer_size` samples with `rng` if it is positive.
+        """
+        def read():
+            for shard in shards:
+                for sample in self._read(shard):
+                    yield sample
+        if buffer_size > 0:
+            return shuffle_buffer(read(), buffer_size, rng or np.random.default_rng())
+        return read()
+
+    def collate(self, samples):
+        """
+        Batch a list of samples streamed.
+        """
+        return default_collate(samples)
+
+    def _get(self, indices):
+        raise NotImplementedError("Samples of {} are streamed, and cannot be got by"
+                                  " indices.".format(self.name))
+
+
+class ArrayCache(object):
+    """
+    An on-disk cache of lists of arrays, e.g., decoded images and labels of a
+    dataset, so they do not need to be parsed from raw files each time.
+
+    Each array is saved contiguously in a `.npy` file in `cache_dir`, and an
+    index file `index.json` records the files, shapes and data types of each
+    list of arrays cached. Arrays are opened with memory mapping, so opening
+    the cache takes no time, and processes that read them, e.g., workers of
+    `ParallelSensor`, share the page cache instead of holding copies of their
+    own.
+    """
+    INDEX_NAME = "index.json"
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get(self, key, build):
+        """
+        Return the list of arrays cached under `key`, which are read-only
+        `numpy.memmap`. If they are not cached yet, call `build`, which should
+        return a list of arrays, to make them and save them first.
+        """
+        arrays = self._load(key)
+        if arrays is None:
+            self._save(key, [np.asarray(a) for a in build()])
+            arrays = self._load(key)
+
+        return arrays
+
+    def _read_index(self):
+        path = os.path.join(self.cache_dir, self.INDEX_NAME)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def _load(self, key):
+        entry = self._read_index().get(key)
+        if entry is None:
+            return None
+
+        arrays = []
+        for name, shape, dtype in zip(entry["files"], entry["shapes"], entry["dtypes"]):
+            path = os.path.join(self.cache_dir, name)
+            if not os.path.exists(path):
+                return None
+            a = np.load(path, mmap_mode="r")
+            if list(a.shape) != shape or str(a.dtype) != dtype:
+                # The cache is stale.
+                return None
+            arrays.append(a)
+
+        return arrays
+
+    def _save(self, key, arrays):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # Files are written to temporary names and renamed, so a cache that is
+        # being written is never read.
+        entry = {"files": [], "shapes": [], "dtypes": []}
+        for i, a in enumerate(arrays):
+            name = "{}_{}.npy".format(key, i)
+            path = os.path.join(self.cache_dir, name)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, np.ascontiguousarray(a))
+            os.rename(path + ".tmp", path)
+            entry["files"].append(name)
+            entry["shapes"].append(list(a.shape))
+            entry["dtypes"].append(str(a.dtype))
+
+        index = self._read_index()
+        index[key] = entry
+        path = os.path.join(self.cache_dir, self.INDEX_NAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.rename(path + ".tmp", path)
+
+
+class SharedLRUCache(object):
+    """
+    An in-memory cache of uint8 arrays (e.g., decoded images) keyed by sample
+    indices, with a budget of bytes and least recently used eviction.
+
+    Arrays are held in fixed-size slots of an anonymous shared memory map,
+    and the bookkeeping is held in shared memory as well, guarded by a
+    lock. So if the cache is created before worker processes are forked,
+    e.g., by `ParallelSensor` or a torch `DataLoader`, an array cached by a
+    worker could be read by all of them. Arrays larger than a slot are not
+    cached.
+    """
+    def __init__(self, num_keys, budget_bytes, slot_bytes):
+        """
+        Args:
+            num_keys: int
+                Keys are integers in [0, num_keys).
+            budget_bytes: int
+                The number of bytes to hold arrays.
+            slot_bytes: int
+                The largest number of bytes of an array to cache.
+        """
+        self.slot_bytes = slot_bytes
+        self.num_slots = max(1, budget_bytes // slot_bytes)
+
+        self._buffer = mmap.mmap(-1, self.num_slots * slot_bytes)
+        n = self.num_slots
+        self._meta = mmap.mmap(-1, 8 * (num_keys + 6 * n + 2))
+        meta = np.frombuffer(self._meta, dtype=np.int64)
+        # The slot holding a key, or -1.
+        self._key_slot = meta[:num_keys]
+        meta = meta[num_keys:]
+        # The key held in a slot, or -1.
+        self._slot_key = meta[:n]
+        # The shape of the array held in a slot, padded with zeros.
+        self._slot_shape = meta[n:4*n].reshape(n, 3)
+        # Slots are linked from the least recently used one, the head, to the
+        # most recently used one, the tail, by the previous and next slots,
+        # or -1. Empty slots are the least recently used ones.
+        self._prev = meta[4*n:5*n]
+        self._next = meta[5*n:6*n]
+        self._ends = meta[6*n:]
+
+        self._key_slot[:] = -1
+        self._slot_key[:] = -1
+        self._prev[:] = np.arange(n) - 1
+        self._next[:] = np.arange(1, n + 1)
+        self._next[n - 1] = -1
+        self._ends[:] = [0, n - 1]
+        self._lock = multiprocessing.Lock()
+
+    def _slot(self, i, shape):
+        n = int(np.prod(shape))
+        return np.frombuffer(self._buffer, dtype=np.uint8, count=n,
+                             offset=i * self.slot_bytes).reshape(shape)
+
+    def _touch(self, i):
+        """
+        Move slot `i` to the tail, as the most recently used one.
+        """
+        head, tail = self._ends
+        if i == tail:
+            return
+        prev_slot, next_slot = self._prev[i], self._next[i]
+        if prev_slot >= 0:
+            self._next[prev_slot] = next_slot
+        else:
+            head = next_slot
+        self._prev[next_slot] = prev_slot
+        self._prev[i] = tail
+        self._next[i] = -1
+        self._next[tail] = i
+        self._ends[:] = [head, i]
+
+    def get(self, key):
+        """
+        Return a copy of the array cached under `key`, or None if it is not
+        cached.
+        """
+        with self._lock:
+            i = self._key_slot[key]
+            if i < 0:
+                return None
+            self._touch(i)
+            shape = tuple(d for d in self._slot_shape[i] if d > 0)
+            return self._slot(i, shape).copy()
+
+    def put(self, key, array):
+        """
+        Cache uint8 `array` of at most three dimensions under `key`, evicting
+        the least recently used one if the cache is full.
+        """
+        if array.nbytes > self.slot_bytes or array.ndim > 3 or array.size == 0:
+            return
+
+        with self._lock:
+            if self._key_slot[key] >= 0:
+                return
+            i = int(self._ends[0])
+            evicted = self._slot_key[i]
+            if evicted >= 0:
+                self._key_slot[evicted] = -1
+            self._slot(i, array.shape)[...] = array
+            self._slot_shape[i] = 0
+            self._slot_shape[i, :array.ndim] = array.shape
+            self._slot_key[i] = key
+            self._key_slot[key] = i
+            self._touch(i)
+
+
+def _parse_fields(fields):
+    return [(np.dtype(dtype), None if shape is None else tuple(shape)) for dtype, shape in fields]
+
+
+def _record_bytes(fields):
+    """
+    The number of bytes of a record, or None if it has variable fields.
+    """
+    if any(shape is None for _, shape in fields):
+        return None
+    return sum(int(np.prod(shape)) * dtype.itemsize for dtype, shape in fields)
+
+
+def _encode_record(sample, fields):
+    chunks = []
+    for x, (dtype, shape) in zip(sample, fields):
+        a = np.asarray(x, dtype=dtype)
+        if shape is None:
+            a = a.reshape(-1)
+            chunks.append(np.array(len(a), dtype="<u8").tobytes())
+        elif a.shape != shape:
+            raise ValueError("Expect a field of shape {}, got {}.".format(shape, a.shape))
+        # Bytes are in C order.
+        chunks.append(a.tobytes())
+    return b"".join(chunks)
+
+
+def _decode_record(buf, fields):
+    sample = []
+    pos = 0
+    for dtype, shape in fields:
+        if shape is None:
+            n = int(buf[pos:pos+8].view("<u8")[0])
+            pos += 8
+            shape = (n,)
+        else:
+            n = int(np.prod(shape))
+        nbytes = n * dtype.itemsize
+        sample.append(buf[pos:pos+nbytes].view(dtype).reshape(shape).copy())
+        pos += nbytes
+    return sample
+
+
+class RecordWriter(object):
+    """
+    Write samples, each a list of arrays, as records of a shard at `path`.
+    Records are written back to back in `<path>.rec`, and `<path>.idx` holds
+    their offsets as little-endian int64, one more than the number of
+    records, so record `i` lies in `[offsets[i], offsets[i+1])`.
+
+    `fields` gives the dtype and the shape of each array of a sample. A
+    field of shape None is of variable length, which is flattened, and
+    prefixed by its length.
+    """
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = _parse_fields(fields)
+        self._file = open(path + ".rec.tmp", "wb")
+        self._offsets = [0]
+
+    def write(self, sample):
+        record = _encode_record(sample, self.fields)
+        self._file.write(record)
+        self._offsets.append(self._offsets[-1] + len(record))
+
+    def close(self):
+        """
+        Finish the shard, and return the number of records written.
+        """
+        self._file.close()
+        np.asarray(self._offsets, dtype="<i8").tofile(self.path + ".idx.tmp")
+        # Files are renamed at last, so a shard being written is never read.
+        os.rename(self.path + ".rec.tmp", self.path + ".rec")
+        os.rename(self.path + ".idx.tmp", self.path + ".idx")
+        return len(self._offsets) - 1
+
+
+class RecordReader(object):
+    """
+    Read records of a shard written by `RecordWriter`. Both files are memory
+    mapped, so a record is read in O(1) without any system call, and
+    processes that read the shard share the page cache.
+    """
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = _parse_fields(fields)
+        self.record_bytes = _record_bytes(self.fields)
+        self.offsets = np.memmap(path + ".idx", dtype="<i8", mode="r")
+        if os.path.getsize(path + ".rec") > 0:
+            self.records = np.memmap(path + ".rec", dtype=np.uint8, mode="r")
+        else:
+            self.records = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.read(i)
+
+    def read(self, i):
+        """
+        Return record `i` as a list of arrays.
+        """
+        return _decode_record(self.records[self.offsets[i]:self.offsets[i+1]], self.fields)
+
+    def read_many(self, indices):
+        """
+        Return the records of `indices` as a list of arrays, each of which
+        stacks a field. Only records of fixed size could be read in this way,
+        which takes one indexing operation.
+        """
+        if self.record_bytes is None:
+            raise ValueError("Records of {} are not of fixed size.".format(self.path))
+        rows = self.records.reshape(len(self), self.record_bytes)[indices]
+        batch = []
+        pos = 0
+        for dtype, shape in self.fields:
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            field = np.ascontiguousarray(rows[:, pos:pos+nbytes])
+            batch.append(field.view(dtype).reshape((len(rows),) + shape))
+            pos += nbytes
+        return batch
+
+
+def _write_shards(dataset, paths, bounds, fields, shards):
+    for k in shards:
+        writer = RecordWriter(paths[k], fields)
+        for i in range(bounds[k], bounds[k+1]):
+            writer.write(dataset[i])
+        writer.close()
+
+
+def write_records(dataset, prefix, fields=None, num_shards=1, num_workers=1):
+    """
+    Convert `dataset` into records of `num_shards` shards with `num_workers`
+    processes. `dataset` supports `len` and indexing, which gives a sample
+    as a list of arrays, e.g., `data` of a source built on a torch dataset.
+    Shards hold contiguous ranges of samples, so a record is indexed as the
+    sample it is from.
+
+    Shards are written as `<prefix>-<k>-of-<num_shards>` along with a meta
+    file `<prefix>.json` that lists shards and fields, which is to be given
+    to `RecordSource`. If `fields` is not given, it is decided by the first
+    sample, and all fields are of fixed size.
+
+    Return the path of the meta file.
+    """
+    n = len(dataset)
+    if fields is None:
+        fields = [(np.asarray(x).dtype, np.asarray(x).shape) for x in dataset[0]]
+    fields = [[np.dtype(dtype).str, None if shape is None else list(shape)]
+              for dtype, shape in _parse_fields(fields)]
+    bounds = np.linspace(0, n, num_shards + 1).astype(np.int64)
+    directory, name = os.path.split(prefix)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    names = ["{}-{:05d}-of-{:05d}".format(name, k, num_shards) for k in range(num_shards)]
+    paths = [os.path.join(directory, name) for name in names]
+
+    if num_workers <= 1:
+        _write_shards(dataset, paths, bounds, fields, range(num_shards))
+    else:
+        processes = [multiprocessing.Process(
+            target=_write_shards,
+            args=(dataset, paths, bounds, fields, range(w, num_shards, num_workers)))
+                     for w in range(num_workers)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        if any(p.exitcode != 0 for p in processes):
+            raise RuntimeError("Failed to write records of {}.".format(prefix))
+
+    meta = {"fields": fields,
+            "shards": [[names[k], int(bounds[k+1] - bounds[k])] for k in range(num_shards)]}
+    path = prefix + ".json"
+    with open(path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.rename(path + ".tmp", path)
+    return path
+
+
+class RecordSource(StreamSource):
+    """
+    A source of records written by `write_records`, e.g.::
+
+        write_records(MNISTSource(...).data, "mnist/train", num_shards=8, num_workers=8)
+        source = RecordSource(train_records="mnist/train", name="source")
+
+    Shards are memory mapped. If all fields are of fixed size, `get` gathers
+    the records of a shard in a batch of indices with one indexing
+    operation; otherwise, records are read one by one, and variable fields
+    are batched as lists of tensors. Shards could also be streamed one by
+    one by `StreamingSensor`.
+    """
+    def __init__(self, train_records=None, val_records=None, test_records=None, **kwargs):
+        """
+        Args:
+            train_records, val_records, test_records: str
+                The prefix of records of each mode given to `write_records`.
+        """
+        super(RecordSource, self).__init__(**kwargs)
+        self._prefix_dict = {A.Mode.TRAIN: train_records,
+                             A.Mode.VAL: val_records,
+                             A.Mode.TEST: test_records}
+
+    def _setup(self):
+        prefix = self._prefix_dict[self.mode]
+        if prefix is None:
+            raise ValueError("No records are provided for mode {}.".format(self.mode))
+        with open(prefix + ".json") as f:
+            meta = json.load(f)
+        self.fields = _parse_fields(meta["fields"])
+        directory = os.path.dirname(prefix)
+        self._shards = [os.path.join(directory, name) for name, _ in meta["shards"]]
+        self._readers = dict((p, RecordReader(p, self.fields)) for p in self._shards)
+        self._starts = np.cumsum([0] + [n for _, n in meta["shards"]])
+
+    @property
+    def data(self):
+        """
+        The list of shards of the current mode.
+        """
+        return list(self._shards)
+
+    @property
+    def size(self):
+        return int(self._starts[-1])
+
+    def _read(self, shard):
+        return iter(self._readers[shard])
+
+    def collate(self, samples):
+        batch = []
+        for i, (_, shape) in enumerate(self.fields):
+            if shape is None:
+                batch.append([th.from_numpy(s[i]) for s in samples])
+            else:
+                batch.append(th.from_numpy(np.stack([s[i] for s in samples])))
+        return batch
+
+    def _get(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_ids = np.searchsorted(self._starts, indices, side="right") - 1
+        if _record_bytes(self.fields) is None:
+            return self.collate([self._readers[self._shards[s]].read(i - self._starts[s])
+                                 for i, s in zip(indices, shard_ids)])
+
+        batch = [np.empty((len(indices),) + shape, dtype=dtype) for dtype, shape in self.fields]
+        for s in np.unique(shard_ids):
+            mask = shard_ids == s
+            fields = self._readers[self._shards[s]].read_many(indices[mask] - self._starts[s])
+            for b, f in zip(batch, fields):
+                b[mask] = f
+        return [th.from_numpy(b) for b in batch]
+
+
 class OldSource(six.with_metaclass(abc.ABCMeta, FlowBlock)):
     """
     An abstract class to model data source from the world.
@@ -12,16 +12,18 @@ import six.moves.cPickle as pickle
 
 import numpy as np
 import tensorflow as tf
+import torch as th
 from torchvision import datasets, transforms
 
 from ..core.sources import (
     Source,
+    ArrayCache,
     InMemoryFeedSource,
     SupervisedSource,
     ClassificationTFSource,
     StaticSource
 )
-from .datasets import DataSet, DataSets
+from .datasets import DataSet, DataSets, ToUint8Tensor
 from six.moves import range
 
 from akid import backend as A
@@ -35,20 +37,36 @@ class Cifar10Source(SupervisedSource):
     IMAGE_SIZE = 32
     SAMPLE_NUM = 50000
 
-    def __init__(self, use_zca=False, **kwargs):
+    def __init__(self, use_zca=False, use_cache=False, **kwargs):
         """
         Args:
             use_zca: Boolean
                 Use ZCA whitened data or not. If this is specified, the ZCA
                 whitened data has to be in `work_dir` already.
+            use_cache: Boolean
+                Whether to keep the dataset loaded from python version of
+                Cifar10 in an `ArrayCache` under `work_dir`, so it is only
+                parsed the first time.
         """
         super(Cifar10Source, self).__init__(**kwargs)
         self.use_zca = use_zca
+        self.use_cache = use_cache
 
-    def _load_cifar10_python(self, filenames):
+    def _load_cifar10_python(self, filenames, cache_key=None):
         """
-        Load python version of Cifar10 dataset.
+        Load python version of Cifar10 dataset. If the cache is used, arrays
+        loaded are cached under `cache_key`.
         """
+        if self.use_cache and cache_key is not None:
+            cache = ArrayCache(os.path.join(self.work_dir, "akid_cache"))
+            data, labels = cache.get(
+                cache_key,
+                lambda: self._load_cifar10_python_arrays(filenames))
+            return DataSet(data, labels)
+
+        return DataSet(*self._load_cifar10_python_arrays(filenames))
+
+    def _load_cifar10_python_arrays(self, filenames):
         # Load the first batch of data to get shape info.
         filename = filenames[0]
         with open(filename, "rb") as f:
@@ -66,7 +84,7 @@ class Cifar10Source(SupervisedSource):
         data = np.reshape(data, [-1, 3, 32, 32])
         data = np.einsum("nchw->nhwc", data)
 
-        return DataSet(data, labels)
+        return data, labels
 
 
 class Cifar10FeedSource(Cifar10Source, InMemoryFeedSource):
@@ -88,11 +106,13 @@ class Cifar10FeedSource(Cifar10Source, InMemoryFeedSource):
         train_filenames = [os.path.join(self.work_dir, 'cifar-10-batches-py',
                                         'data_batch_%d' % i)
                            for i in range(1, 6)]
-        training_dataset = self._load_cifar10_python(train_filenames)
+        training_dataset = self._load_cifar10_python(train_filenames,
+                                                     "cifar10_python_train")
 
         test_filenames = [os.path.join(self.work_dir, 'cifar-10-batches-py',
                                        'test_batch')]
-        test_dataset = self._load_cifar10_python(test_filenames)
+        test_dataset = self._load_cifar10_python(test_filenames,
+                                                 "cifar10_python_test")
 
         if self.use_zca:
             sample_num = len(train_filenames) * 10000
@@ -335,33 +355,39 @@ class Cifar10TorchSource(StaticSource, SupervisedSource):
 
 
 class Cifar10AkidSource(Source):
-    def _setup(self):
-        if not hasattr(self, "_data"):
+    # The mean and standard deviation of pixels in [0, 1] by channel.
+    normalization = ([i/255 for i in [125.3, 123.0, 113.9]],
+                     [i/255 for i in [63.0, 62.1, 66.7]])
+
+    def __init__(self, *args, use_cache=False, normalize=True, **kwargs):
+        """
+        Args:
+            use_cache: bool
+                Whether to keep decoded images and labels in an `ArrayCache`
+                under `work_dir`. The raw files are only parsed the first
+                time, and afterwards the cache is memory mapped, so it is
+                shared by all workers of a sensor.
+            normalize: bool
+                Whether to return normalized float images. If False, uint8
+                images are returned, which are supposed to be normalized by
+                `normalization` later, e.g., by a sensor after transferring
+                them.
+        """
+        super(Cifar10AkidSource, self).__init__(*args, **kwargs)
+        self.use_cache = use_cache
+        self.normalize = normalize
+        if use_cache:
+            self._cache = ArrayCache(os.path.join(self.work_dir, "akid_cache"))
+
+    def _make_dataset(self, mode):
+        if self.normalize:
             convert = transforms.Compose([
                 transforms.ToTensor(),
                 # lambda x: x.permute(2, 0, 1),
-                transforms.Normalize([i/255 for i in [125.3, 123.0, 113.9]],
-                                    [i/255 for i in [63.0, 62.1, 66.7]]),
-            ])
-            train_transform = transforms.Compose([
-                transforms.RandomHorizontalFlip(),
-                transforms.Pad(4),
-                transforms.RandomCrop(32),
-                convert,
+                transforms.Normalize(*self.normalization),
             ])
-
-            self._data = datasets.CIFAR10(self.work_dir, train=True, download=True,
-                                            transform=train_transform)
-
-    def set_mode(self, mode):
-        super(Cifar10AkidSource, self).set_mode(mode)
-
-        convert = transforms.Compose([
-            transforms.ToTensor(),
-            # lambda x: x.permute(2, 0, 1),
-            transforms.Normalize([i/255 for i in [125.3, 123.0, 113.9]],
-                                 [i/255 for i in [63.0, 62.1, 66.7]]),
-        ])
+        else:
+            convert = ToUint8Tensor()
         train_transform = transforms.Compose([
             transforms.RandomHorizontalFlip(),
             transforms.Pad(4),
@@ -370,18 +396,89 @@ class Cifar10AkidSource(Source):
         ])
 
         if mode == A.Mode.TRAIN:
-            self._data = datasets.CIFAR10(self.work_dir, train=True, download=True,
-                                          transform=train_transform)
+            return datasets.CIFAR10(self.work_dir, train=True, download=True,
+                                    transform=train_transform)
         elif mode == A.Mode.VAL:
-            self._data = datasets.CIFAR10(self.work_dir, train=False,
-                                          transform=convert)
+            return datasets.CIFAR10(self.work_dir, train=False,
+                                    transform=convert)
         else:
             raise ValueError("Mode {} not supported yet.".format(mode))
 
+    def _make_arrays(self):
+        dataset = self._make_dataset(self.mode)
+        return [dataset.data, np.asarray(dataset.targets)]
+
+    def _load_dataset(self, mode):
+        self._data = self._make_dataset(mode)
+        # Targets are a list, so convert them once for bulk fetching.
+        self._targets = np.asarray(self._data.targets)
+
+    def _load_arrays(self):
+        self._arrays = self._cache.get("cifar10_{}".format(self.mode),
+                                       self._make_arrays)
+
+    def _setup(self):
+        if self.use_cache:
+            if not hasattr(self, "_arrays"):
+                self._load_arrays()
+        elif not hasattr(self, "_data"):
+            self._load_dataset(self.mode)
+
+    def set_mode(self, mode):
+        super(Cifar10AkidSource, self).set_mode(mode)
+        if self.use_cache:
+            if mode not in (A.Mode.TRAIN, A.Mode.VAL):
+                raise ValueError("Mode {} not supported yet.".format(mode))
+            # The dataset is only made when samples are got one by one.
+            self._data = None
+            # Load the arrays of the mode now, so `size` and `bulk_data` do
+            # not return the ones of the last mode before set up.
+            self._load_arrays()
+        else:
+            self._load_dataset(mode)
+
     @property
     def data(self):
+        if self.use_cache and getattr(self, "_data", None) is None:
+            self._data = self._make_dataset(self.mode)
         return self._data
 
+    @property
+    def bulk_data(self):
+        if self.use_cache:
+            return self._arrays
+        return [self._data.data, self._targets]
+
+    def _bulk_transform(self, batch):
+        # The same transforms as the ones done on each image, but on a batch
+        # of images in NHWC.
+        images, labels = batch
+        images = th.from_numpy(images)
+        if self.mode == A.Mode.TRAIN:
+            n, h, w, _ = images.shape
+            # Random horizontal flip.
+            flip = th.rand(n) < 0.5
+            images[flip] = images[flip].flip(2)
+            # Pad by 4 with zeros and randomly crop back to 32.
+            padded = images.new_zeros((n, h + 8, w + 8, images.shape[3]))
+            padded[:, 4:h+4, 4:w+4] = images
+            top = th.randint(0, 9, (n, 1, 1))
+            left = th.randint(0, 9, (n, 1, 1))
+            rows = top + th.arange(h).view(1, h, 1)
+            cols = left + th.arange(w).view(1, 1, w)
+            images = padded[th.arange(n).view(n, 1, 1), rows, cols]
+
+        images = images.permute(0, 3, 1, 2)
+        if self.normalize:
+            # `ToTensor` and `Normalize`.
+            mean, std = [th.tensor(v).view(1, 3, 1, 1) for v in self.normalization]
+            images = images.float().div_(255).sub_(mean).div_(std)
+        else:
+            images = images.contiguous()
+        return [images, th.from_numpy(labels)]
+
     @property
     def size(self):
+        if self.use_cache:
+            return len(self._arrays[0])
         return len(self._data)
@@ -9,16 +9,20 @@ from abc import ABCMeta
 from abc import abstractmethod
 import os
 
+import numpy as np
 import tensorflow as tf
+from PIL import Image
 from torchvision import datasets, transforms
 
 from akid import (
     SupervisedSource,
     ClassificationTFSource,
-    StaticSource
+    StaticSource,
+    SharedLRUCache
 )
 
 from akid import backend as A
+from .datasets import ToUint8Tensor
 import six
 
 
@@ -358,16 +362,87 @@ class ImagenetTFSource(ClassificationTFSource):
         return image
 
 
+class _CachedImageFolder(datasets.ImageFolder):
+    """
+    An `ImageFolder` that keeps images decoded and resized, of which the
+    shorter side is `size`, as uint8 arrays in a `SharedLRUCache`. For images
+    cached, only the transforms are done.
+    """
+    def __init__(self, root, transform, cache_bytes, size=256):
+        super(_CachedImageFolder, self).__init__(root, transform)
+        self.size = size
+        # Images whose longer side is more than twice of the shorter one are
+        # not cached.
+        self.cache = SharedLRUCache(len(self.imgs), cache_bytes, 2 * size * size * 3)
+
+    def _decode(self, path):
+        img = self.loader(path)
+        w, h = img.size
+        if w < h:
+            img = img.resize((self.size, int(self.size * h / w)), Image.BILINEAR)
+        else:
+            img = img.resize((int(self.size * w / h), self.size), Image.BILINEAR)
+        return np.asarray(img, dtype=np.uint8)
+
+    def __getitem__(self, index):
+        path, target = self.imgs[index]
+        img = self.cache.get(index)
+        if img is None:
+            img = self._decode(path)
+            self.cache.put(index, img)
+        img = Image.fromarray(img)
+
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+
+        return img, target
+
+
 class ImagenetTorchSource(StaticSource, SupervisedSource):
-    def __init__(self, random_sized_crop=True, **kwargs):
+    # The mean and standard deviation of pixels in [0, 1] by channel.
+    normalization = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+
+    def __init__(self,
+                 random_sized_crop=True,
+                 decoded_cache_bytes=0,
+                 normalize=True,
+                 **kwargs):
+        """
+        Args:
+            random_sized_crop: bool
+                Whether to crop training images of random size and aspect
+                ratio, or after scaling them.
+            decoded_cache_bytes: int
+                The number of bytes to cache images decoded and scaled, of
+                which the shorter side is 256, shared by all data loading
+                workers. It is split by training and validation set in
+                proportion to their sizes. Images cached are only cropped and
+                flipped each epoch, instead of being decoded again. If it is
+                0, no image is cached.
+            normalize: bool
+                Whether to return normalized float images. If False, uint8
+                images are returned, which are supposed to be normalized by
+                `normalization` later, e.g., after being transferred to GPU.
+        """
         super(ImagenetTorchSource, self).__init__(**kwargs)
         self.random_sized_crop = random_sized_crop
+        self.decoded_cache_bytes = decoded_cache_bytes
+        self.normalize = normalize
+
+    def _image_folder(self, root, transform, cache_bytes):
+        if self.decoded_cache_bytes > 0:
+            return _CachedImageFolder(root, transform, cache_bytes)
+        return datasets.ImageFolder(root, transform)
 
     def _setup(self):
-        mean=[0.485, 0.456, 0.406]
-        std=[0.229, 0.224, 0.225]
-        normalize = transforms.Normalize(mean=mean, std=std)
+        mean, std = self.normalization
         A.summary.set_normalization(mean, std)
+        if self.normalize:
+            convert = [transforms.ToTensor(), transforms.Normalize(mean=mean, std=std)]
+        else:
+            convert = [ToUint8Tensor()]
 
         t_list = []
         if self.random_sized_crop:
@@ -377,19 +452,27 @@ class ImagenetTorchSource(StaticSource, SupervisedSource):
             t_list.append(transforms.RandomCrop(224))
 
         t_list.append(transforms.RandomHorizontalFlip())
-        t_list.append(transforms.ToTensor())
-        t_list.append(normalize)
-
-        self.dataset = datasets.ImageFolder(
+        t_list.extend(convert)
+
+        train_transform = transforms.Compose(t_list)
+        val_transform = transforms.Compose([
+            transforms.Scale(256),
+            transforms.CenterCrop(224)] + convert)
+        if getattr(self, "dataset", None) is not None:
+            # The source is set up again, e.g., upon switching modes. Folders
+            # are kept, so are images decoded in their caches.
+            self.dataset.transform = train_transform
+            self.val_dataset.transform = val_transform
+            return
+
+        train_bytes = self.decoded_cache_bytes * self.num_train // (self.num_train + self.num_val)
+        self.dataset = self._image_folder(
             self.work_dir + "/train",
-            transforms.Compose(t_list))
-        self.val_dataset = datasets.ImageFolder(
+            train_transform,
+            train_bytes)
+        self.val_dataset = self._image_folder(
             self.work_dir + "/val",
-            transforms.Compose([
-                transforms.Scale(256),
-                transforms.CenterCrop(224),
-                transforms.ToTensor(),
-                normalize,
-            ]))
+            val_transform,
+            self.decoded_cache_bytes - train_bytes)
     def _forward(self):
         pass
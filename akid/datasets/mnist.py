@@ -6,11 +6,18 @@ import gzip
 import zipfile
 
 import numpy as np
+import torch as th
 
 from torchvision import datasets, transforms
 
-from ..core.sources import Source, InMemoryFeedSource, SupervisedSource, StaticSource
-from .datasets import DataSet, DataSets
+from ..core.sources import (
+    Source,
+    ArrayCache,
+    InMemoryFeedSource,
+    SupervisedSource,
+    StaticSource
+)
+from .datasets import DataSet, DataSets, ToUint8Tensor
 from .. import backend as A
 
 
@@ -211,32 +218,96 @@ class MNISTTorchSource(StaticSource, SupervisedSource):
 
 
 class MNISTSource(Source):
-    def _setup(self):
-        if not hasattr(self, "_data"):
-            self._data = datasets.MNIST(self.work_dir, train=True, download=True,
-                                        transform=transforms.Compose([
-                                            transforms.ToTensor(),
-                                            transforms.Normalize((0.1307,), (0.3081,))]))
+    # The mean and standard deviation of pixels in [0, 1].
+    normalization = ((0.1307,), (0.3081,))
 
-    def set_mode(self, mode):
-        super(MNISTSource, self).set_mode(mode)
+    def __init__(self, *args, use_cache=False, normalize=True, **kwargs):
+        """
+        Args:
+            use_cache: bool
+                Whether to keep decoded images and labels in an `ArrayCache`
+                under `work_dir`. The raw files are only parsed the first
+                time, and afterwards the cache is memory mapped, so it is
+                shared by all workers of a sensor.
+            normalize: bool
+                Whether to return normalized float images. If False, uint8
+                images are returned, which are supposed to be normalized by
+                `normalization` later, e.g., by a sensor after transferring
+                them.
+        """
+        super(MNISTSource, self).__init__(*args, **kwargs)
+        self.use_cache = use_cache
+        self.normalize = normalize
+        if use_cache:
+            self._cache = ArrayCache(os.path.join(self.work_dir, "akid_cache"))
+
+    def _make_dataset(self, mode):
+        if self.normalize:
+            transform = transforms.Compose([
+                transforms.ToTensor(),
+                transforms.Normalize(*self.normalization)])
+        else:
+            transform = ToUint8Tensor()
         if mode == A.Mode.TRAIN:
-            self._data = datasets.MNIST(self.work_dir, train=True, download=True,
-                                        transform=transforms.Compose([
-                                            transforms.ToTensor(),
-                                            transforms.Normalize((0.1307,), (0.3081,))]))
+            return datasets.MNIST(self.work_dir, train=True, download=True,
+                                  transform=transform)
         elif mode == A.Mode.VAL:
-            self._data = datasets.MNIST(self.work_dir, train=False,
-                                        transform=transforms.Compose([
-                                            transforms.ToTensor(),
-                                            transforms.Normalize((0.1307,), (0.3081,))]))
+            return datasets.MNIST(self.work_dir, train=False,
+                                  transform=transform)
         else:
             raise ValueError("Mode {} not supported yet.".format(mode))
 
+    def _make_arrays(self):
+        dataset = self._make_dataset(self.mode)
+        return [dataset.data.numpy(), dataset.targets.numpy()]
+
+    def _load_arrays(self):
+        self._arrays = self._cache.get("mnist_{}".format(self.mode),
+                                       self._make_arrays)
+
+    def _setup(self):
+        if self.use_cache:
+            if not hasattr(self, "_arrays"):
+                self._load_arrays()
+        elif not hasattr(self, "_data"):
+            self._data = self._make_dataset(self.mode)
+
+    def set_mode(self, mode):
+        super(MNISTSource, self).set_mode(mode)
+        if self.use_cache:
+            if mode not in (A.Mode.TRAIN, A.Mode.VAL):
+                raise ValueError("Mode {} not supported yet.".format(mode))
+            # The dataset is only made when samples are got one by one.
+            self._data = None
+            # Load the arrays of the mode now, so `size` and `bulk_data` do
+            # not return the ones of the last mode before set up.
+            self._load_arrays()
+        else:
+            self._data = self._make_dataset(mode)
+
     @property
     def data(self):
+        if self.use_cache and getattr(self, "_data", None) is None:
+            self._data = self._make_dataset(self.mode)
         return self._data
 
+    @property
+    def bulk_data(self):
+        if self.use_cache:
+            return self._arrays
+        return [self._data.data, self._data.targets]
+
+    def _bulk_transform(self, batch):
+        # The same as `ToTensor` and `Normalize` on each image.
+        images, labels = [th.as_tensor(d) for d in batch]
+        images = images.unsqueeze(1)
+        if self.normalize:
+            mean, std = self.normalization
+            images = images.float().div_(255).sub_(mean[0]).div_(std[0])
+        return [images, labels]
+
     @property
     def size(self):
+        if self.use_cache:
+            return len(self._arrays[0])
         return len(self._data)
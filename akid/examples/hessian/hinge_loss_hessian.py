@@ -2,11 +2,9 @@ import seaborn as sns
 from matplotlib import pyplot as plt
 import pickle as pk
 import numpy as np
-import random
+import torch as th
 
-from torchvision import datasets, transforms
-
-from akid import Source, ParallelSensor, AKID_DATA_PATH, Kid, MomentumKongFu
+from akid import Source, MNISTSource, ParallelSensor, AKID_DATA_PATH, Kid, MomentumKongFu
 from akid import GraphBrain
 from akid import ops
 from akid.layers import (
@@ -55,43 +53,31 @@ class MNISTBinarySource(Source):
             # Load MNIST data from torch source into memory, and according to
             # the data needed, build the dataset.
 
-        self._train_data_o = datasets.MNIST(self.work_dir, train=True, download=True,
-                                    transform=transforms.Compose([
-                                        transforms.ToTensor(),
-                                        transforms.Normalize((0.1307,), (0.3081,))]))
-        self._test_data_o = datasets.MNIST(self.work_dir, train=False,
-                                    transform=transforms.Compose([
-                                        transforms.ToTensor(),
-                                        transforms.Normalize((0.1307,), (0.3081,))]))
-
-        self._train_data = self.extract_subset(self._train_data_o)
-        self._test_data = self.extract_subset(self._test_data_o)
+        mnist = MNISTSource(work_dir=self.work_dir, name="{}_mnist".format(self.name))
+        mnist.setup()
+        # Subsets are gathered into arrays, so batches are gathered in bulk.
+        self._train_data = self.extract_subset(mnist)
+        mnist.set_mode("val")
+        mnist.setup()
+        self._test_data = self.extract_subset(mnist)
 
-
-    def extract_subset(self, dataset):
-        subset = []
-        other_class_candidates = []
-        for i, d in enumerate(dataset):
-            if self.example_per_class is not None and len(subset) >= self.example_per_class:
-                break
-
-            img, label = d
-            if label == self.positive_class:
-                subset.append(d)
-            else:
-                other_class_candidates.append(d)
+    def extract_subset(self, source):
+        index = source.label_index()
+        subset = index[self.positive_class][:self.example_per_class]
 
         # Get equal number of samples from other classes to make up negative
         # samples.
         # NOTE: we assume negative samples are more (if the original dataset is
         # random), so we just pick the first part.
         N = len(subset)
-        negative_subset = [other_class_candidates[i] for i in range(N)]
+        other_class_candidates = np.sort(np.concatenate(
+            [v for c, v in index.items() if c != self.positive_class]))
+        negative_subset = other_class_candidates[:N]
 
         # Mix the two sets.
-        subset.extend(negative_subset)
-        random.shuffle(subset)
-        return subset
+        subset = np.concatenate([subset, negative_subset])
+        np.random.shuffle(subset)
+        return source.get(subset)
 
     @property
     def data(self):
@@ -102,20 +88,19 @@ class MNISTBinarySource(Source):
         else:
             raise ValueError("Wrong mode {}".format(self.mode))
 
+    @property
+    def bulk_data(self):
+        return self.data
+
     @property
     def size(self):
-        return len(self.data)
+        return len(self.data[0])
 
-    def _get(self, indices):
-        data = [self.data[i] for i in indices]
-        data = list(zip(*data))
-        data = [np.stack(data[0]), np.stack(data[1]).astype(np.float32)]
-        labels = np.ones_like(data[1], dtype=np.float32)
-        for i, l in enumerate(data[1]):
-            if l != 0:
-                labels[i] = -1
-        data = [data[0], labels]
-        return data
+    def _bulk_transform(self, batch):
+        images, labels = batch
+        signs = th.ones(labels.shape[0], dtype=th.float32)
+        signs[labels != self.positive_class] = -1
+        return [images, signs]
 
 
 # # VGG11 on MNIST with hinge loss.
@@ -236,6 +221,10 @@ spectrum_sensor = ParallelSensor(
     batch_size=200,
     # Do not shuffle training set for reproducible test
     sampler="sequence",
+    # Keep the order of batches across workers, so the test is reproducible.
+    ordered=True,
+    # Lanczos iterations go through the dataset many times.
+    prefetch_across_epochs=True,
     name='mnist_spectrum')
 
 
@@ -2,7 +2,12 @@ from __future__ import absolute_import
 from akid.utils.test import AKidTestCase, TestFactory, main, skipUnless, skip
 from akid import (
     IntegratedSensor,
+    SimpleSensor,
+    MNISTSource,
     RescaleJoker,
+    BatchCropJoker,
+    BatchFlipJoker,
+    BatchLightJoker,
     Kid,
     GradientDescentKongFu
 )
@@ -10,6 +15,8 @@ from akid.models.brains import AlexNet
 from akid import LearningRateScheme
 from akid import backend as A
 
+import torch as th
+
 
 class TestJoker(AKidTestCase):
     @skip("The test is badly written, and does not pass")
@@ -45,5 +52,68 @@ class TestJoker(AKidTestCase):
         assert loss < 3
 
 
+class TestBatchJoker(AKidTestCase):
+    def setUp(self):
+        A.reset()
+        self.use_cuda_save = A.use_cuda()
+        A.use_cuda(False)
+
+    def tearDown(self):
+        A.use_cuda(self.use_cuda_save)
+        A.reset()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Batch jokers are for the torch backend")
+    def test_crop(self):
+        data = th.arange(2 * 3 * 6 * 6, dtype=th.float32).reshape(2, 3, 6, 6)
+        crop = BatchCropJoker(4, 4, name="crop").forward(data)
+        self.assertEquals(tuple(crop.shape), (2, 3, 4, 4))
+        for n in range(2):
+            assert any(th.equal(crop[n], data[n, :, i:i+4, j:j+4])
+                       for i in range(3) for j in range(3))
+
+        crop = BatchCropJoker(4, 4, center=True, name="center_crop").forward(data)
+        self.assertTensorEquals(crop, data[..., 1:5, 1:5])
+
+        crop = BatchCropJoker(6, 6, padding=2, name="pad_crop").forward(data)
+        self.assertEquals(tuple(crop.shape), (2, 3, 6, 6))
+
+    @skipUnless(A.backend() == A.TORCH, msg="Batch jokers are for the torch backend")
+    def test_flip(self):
+        data = th.rand(4, 3, 5, 5)
+        self.assertTensorEquals(BatchFlipJoker(prob=1, name="flip").forward(data),
+                                data.flip(-1))
+        self.assertTensorEquals(BatchFlipJoker(prob=0, name="no_flip").forward(data),
+                                data)
+        flip = BatchFlipJoker(name="random_flip").forward(data)
+        for n in range(4):
+            assert th.equal(flip[n], data[n]) or th.equal(flip[n], data[n].flip(-1))
+
+    @skipUnless(A.backend() == A.TORCH, msg="Batch jokers are for the torch backend")
+    def test_light(self):
+        data = th.randint(0, 256, (4, 3, 8, 8), dtype=th.uint8)
+        out = BatchLightJoker(name="light").forward(data)
+        self.assertEquals(out.dtype, th.uint8)
+        self.assertEquals(out.shape, data.shape)
+
+        # Contrast keeps means of channels.
+        data = th.rand(4, 3, 8, 8)
+        out = BatchLightJoker(brightness=False, name="contrast").forward(data)
+        self.assertTensorAlmostEquals(out.mean(dim=(2, 3)), data.mean(dim=(2, 3)), places=5)
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_sensor(self):
+        source = MNISTSource(work_dir="data", name="source")
+        source.setup()
+        sensor = SimpleSensor(source_in=source, batch_size=8, name="sensor")
+        sensor.attach(BatchCropJoker(24, 24, name="crop"))
+        sensor.attach(BatchFlipJoker(name="flip"))
+        sensor.setup()
+        self.assertEquals(tuple(sensor.forward()[0].shape), (8, 1, 24, 24))
+        sensor.set_mode("val")
+        sensor.setup()
+        self.assertEquals(tuple(sensor.forward()[0].shape), (100, 1, 28, 28))
+        sensor.teardown()
+
+
 if __name__ == "__main__":
     main()
@@ -8,7 +8,7 @@ from akid import (
     MomentumKongFu
 )
 
-from akid.utils.test import AKidTestCase, TestFactory, main, debug_on
+from akid.utils.test import AKidTestCase, TestFactory, main, debug_on, skipUnless
 from akid import backend as A
 from akid.core import initializers
 
@@ -42,6 +42,73 @@ class TestKid(AKidTestCase):
                 "Loss: {}".format(loss)
         kid.teardown()
 
+    def test_lazy_eval(self):
+        brain = TestFactory.get_test_brain()
+        sensor = TestFactory.get_test_sensor()
+        kid = TestFactory.get_test_kid(sensor, brain)
+        kid.do_summary = False
+        kid.lazy_eval = True
+        kid.setup()
+
+        loss = kid.practice()
+        assert loss < 0.2, \
+                "Loss: {}".format(loss)
+        # Training loss is pulled at each training log step, besides the
+        # initial one.
+        self.assertEquals(len(kid.loss_data_train), 900 // kid.train_log_step + 1)
+        self.assertEquals(np.ndim(kid.loss_data_train[-1]), 0)
+        kid.teardown()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Tensors are summed lazily only for torch")
+    def test_running_evals(self):
+        import torch as th
+        brain = TestFactory.get_test_brain()
+        sensor = TestFactory.get_test_sensor()
+        kid = TestFactory.get_test_kid(sensor, brain)
+        # Evals that are not tensors, e.g., computed on the host, are averaged
+        # as well.
+        for values in [[th.tensor(1.), th.tensor(3.)], [1., 3.]]:
+            for v in values:
+                kid._accumulate_evals(v, [v * 2])
+            loss, evals = kid._pull_evals()
+            self.assertEquals(loss, 2.)
+            self.assertEquals(evals, [4.])
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_streaming_sensor(self):
+        from akid import AKID_DATA_PATH, MNISTSource, StreamSource, StreamingSensor
+        # Stream MNIST by shards of 100 samples, whose size is not told.
+        mnist = MNISTSource(work_dir=AKID_DATA_PATH + '/mnist', name='mnist')
+        shards = {}
+        for mode in [A.Mode.TRAIN, A.Mode.VAL]:
+            mnist.set_mode(mode)
+            mnist.setup()
+            shards[mode] = [mnist.get(list(range(i, min(i + 100, mnist.size))))
+                            for i in range(0, mnist.size, 100)]
+        source = StreamSource(train_shards=shards[A.Mode.TRAIN],
+                              val_shards=shards[A.Mode.VAL],
+                              read_fn=read_shard,
+                              name="source")
+        sensor = StreamingSensor(source_in=source, num_workers=2, name="sensor")
+        brain = TestFactory.get_test_brain()
+        kid = Kid(sensor,
+                  brain,
+                  MomentumKongFu(),
+                  max_epoch=2,
+                  log_by_step=False,
+                  log_by_epoch=True)
+        kid.do_summary = False
+        kid.setup()
+
+        # Epochs are counted by the sensor, and validation goes through an
+        # epoch of the validation set after each epoch, besides the initial
+        # one.
+        loss = kid.practice()
+        assert loss is not None
+        self.assertEquals(kid.epoch, 2)
+        self.assertEquals(len(kid.loss_data_val), 3)
+        kid.teardown()
+
     def test_summary(self):
         brain = TestFactory.get_test_brain()
         sensor = TestFactory.get_test_sensor()
@@ -152,5 +219,10 @@ class TestKid(AKidTestCase):
 
         kid.teardown()
 
+def read_shard(shard):
+    images, labels = shard
+    for i in range(len(labels)):
+        yield [images[i], labels[i]]
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,146 @@
+from __future__ import absolute_import
+from akid.utils.test import AKidTestCase, main
+from akid.core import samplers
+from akid.core.events import EpochCompletedEvent
+
+import numpy as np
+
+
+class TestSamplers(AKidTestCase):
+    def get_epoch(self, sampler, size):
+        batches = []
+        while True:
+            try:
+                batches.append(sampler.next(size))
+            except EpochCompletedEvent:
+                return batches
+
+    def test_sequence(self):
+        sampler = samplers.get("sequence", 10)
+        batches = self.get_epoch(sampler, 4)
+        assert [len(b) for b in batches] == [4, 4, 2]
+        assert (np.concatenate(batches) == np.arange(10)).all()
+        # Batches are views of the indices.
+        assert batches[0].base is sampler.indices
+
+    def test_shuffle(self):
+        sampler = samplers.get("shuffle", 100, seed=1)
+        first = self.get_epoch(sampler, 32)
+        first_copy = [b.copy() for b in first]
+        second = self.get_epoch(sampler, 32)
+        assert sorted(np.concatenate(first)) == list(range(100))
+        assert sorted(np.concatenate(second)) == list(range(100))
+        assert not (np.concatenate(first) == np.concatenate(second)).all()
+        # Batches of the last epoch are not touched by the reshuffle.
+        for b, c in zip(first, first_copy):
+            assert (b == c).all()
+
+        # The same seed gives the same order.
+        other = samplers.get("shuffle", 100, seed=1)
+        assert (np.concatenate(self.get_epoch(other, 32))
+                == np.concatenate(first)).all()
+
+    def test_distributed_shuffle(self):
+        world_size = 3
+        shards = [samplers.get("distributed_shuffle", 10,
+                               rank=i, world_size=world_size, seed=2)
+                  for i in range(world_size)]
+        for epoch in range(2):
+            batches = [self.get_epoch(s, 2) for s in shards]
+            assert [s.num_samples for s in shards] == [4] * world_size
+            assert [len(b) for b in batches] == [2] * world_size
+            # Shards cover the dataset, and only padded samples are repeated.
+            indices = np.concatenate([np.concatenate(b) for b in batches])
+            assert sorted(set(indices)) == list(range(10))
+            assert len(indices) == 12
+
+        shard = samplers.get("distributed_shuffle", 10,
+                             rank=2, world_size=world_size, drop_last=True)
+        assert len(np.concatenate(self.get_epoch(shard, 2))) == 3
+
+    def test_alias_table(self):
+        rng = np.random.RandomState(0)
+        for weights in [rng.rand(100), rng.rand(1000) ** 8, [1, 0, 0, 0, 5],
+                        np.concatenate([[1000.], np.ones(10000)])]:
+            prob, alias = samplers.build_alias_table(weights)
+            # The probability of each outcome implied by the table.
+            p = prob.copy()
+            np.add.at(p, alias, 1 - prob)
+            self.assertNdarrayAlmostEquals(p / len(p),
+                                           np.asarray(weights) / np.sum(weights))
+
+    def test_weighted(self):
+        weights = np.zeros(100)
+        weights[:10] = 1
+        sampler = samplers.get("weighted", 100, weights=weights,
+                               num_samples=50, seed=0)
+        indices = np.concatenate(self.get_epoch(sampler, 16))
+        assert len(indices) == 50
+        assert (indices < 10).all()
+
+        # New weights take effect from the next epoch.
+        weights = np.zeros(100)
+        weights[-1] = 1
+        sampler.set_weights(weights)
+        assert (sampler.next(16) < 10).all()
+        self.get_epoch(sampler, 16)
+        assert (np.concatenate(self.get_epoch(sampler, 16)) == 99).all()
+
+    def test_class_balanced(self):
+        labels = np.concatenate([np.zeros(9000), np.ones(1000)])
+        sampler = samplers.get("class_balanced", 10000, labels=labels, seed=0)
+        indices = np.concatenate(self.get_epoch(sampler, 100))
+        self.assertAlmostEquals((labels[indices] == 1).mean(), 0.5, delta=0.02)
+
+    def test_bucket(self):
+        rng = np.random.RandomState(0)
+        sizes = rng.randint(1, 50, size=1000)
+        sampler = samplers.get("bucket", 1000, sizes=sizes, bucket_size=10, seed=0)
+        self.assertEquals(sampler.num_batches(16), 63)
+        batches = self.get_epoch(sampler, 16)
+        assert len(batches) == 63
+        assert sorted(np.concatenate(batches)) == list(range(1000))
+        # Padding is much less than that of random batches.
+        padded = sum(len(b) * sizes[b].max() for b in batches)
+        assert padded < 1.2 * sizes.sum()
+
+        sampler = samplers.get("bucket", 1000, size_fn=lambda i: sizes[i],
+                               max_tokens=256, seed=0)
+        num_batches = sampler.num_batches(16)
+        batches = self.get_epoch(sampler, 16)
+        assert sorted(np.concatenate(batches)) == list(range(1000))
+        assert len(batches) == num_batches
+        for b in batches:
+            assert len(b) * sizes[b].max() <= 256
+
+        # Most items are empty.
+        sizes = np.zeros(1000, dtype=np.int64)
+        sizes[:10] = 3
+        sampler = samplers.get("bucket", 1000, sizes=sizes, max_tokens=64, seed=0)
+        batches = self.get_epoch(sampler, 16)
+        assert sorted(np.concatenate(batches)) == list(range(1000))
+        for b in batches:
+            assert len(b) * max(sizes[b].max(), 1) <= 64
+
+    def test_state_dict(self):
+        sizes = np.arange(1000) % 37 + 1
+        for name, kwargs in [("shuffle", {}),
+                             ("distributed_shuffle", {"rank": 1, "world_size": 3}),
+                             ("weighted", {"weights": np.arange(1000.)}),
+                             ("bucket", {"sizes": sizes, "max_tokens": 300})]:
+            sampler = samplers.get(name, 1000, seed=1, **kwargs)
+            self.get_epoch(sampler, 32)
+            for i in range(5):
+                sampler.next(32)
+            state = sampler.state_dict()
+            batches = [sampler.next(32) for i in range(5)]
+
+            # Resume with a sampler seeded differently.
+            other = samplers.get(name, 1000, seed=2, **kwargs)
+            other.load_state_dict(state)
+            for b in batches:
+                self.assertNdarrayEquals(other.next(32), b)
+
+
+if __name__ == "__main__":
+    main()
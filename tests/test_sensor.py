@@ -21,8 +21,15 @@ from akid import LearningRateScheme
 from akid import backend as A
 
 from akid import SimpleSensor, MNISTSource, ParallelSensor
+from akid.core.events import DataPrefetchProcessesDeadEvent, DataPrefetchThreadsDeadEvent
+from akid.core.sensors import _DeviceStager
 import akid
 
+import os
+import signal
+import numpy as np
+from unittest import mock
+import torch as th
 import time
 from six.moves import range
 from six.moves import zip
@@ -59,6 +66,173 @@ class TestSimpleSensor(AKidTestCase):
 
         sensor.teardown()
 
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_threads(self):
+        source = MNISTSource(work_dir="data", normalize=False, name="source")
+        source.setup()
+
+        b_size = 30
+        d_ref = source.get(list(range(b_size)))
+        # Samples are gathered from the data of the source by each thread
+        # into the batch, and a source without such data is read by chunks,
+        # which are written into the batch.
+        for s in [source, source.subset(name="subset")]:
+            s.setup()
+            sensor = SimpleSensor(source_in=s,
+                                  batch_size=b_size,
+                                  queue_size=2,
+                                  num_threads=4,
+                                  sampler="sequence",
+                                  name="sensor")
+            with mock.patch.object(s, "get", wraps=s.get) as get:
+                sensor.setup()
+                d = sensor.forward()
+                if s is source:
+                    self.assertEquals(get.call_count, 0)
+                else:
+                    chunks = [c[0][0] for c in get.call_args_list[:4]]
+                    self.assertEquals(sorted(len(c) for c in chunks), [7, 7, 8, 8])
+                    self.assertEquals(sorted(np.concatenate(chunks)), list(range(b_size)))
+            for t in zip(A.eval(d), A.eval(d_ref)):
+                self.assertNdarrayEquals(t[0], t[1])
+            self.assertEquals(d[0].dtype, th.uint8)
+
+            sensor.teardown()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_threads_overridden_get(self):
+        class ShiftedMNISTSource(MNISTSource):
+            def _get(self, indices):
+                images, labels = super(ShiftedMNISTSource, self)._get(indices)
+                return [images, labels + 1]
+
+        source = ShiftedMNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        b_size = 30
+        d_ref = source.get(list(range(b_size)))
+        # The batch is not gathered from the data of the source, since the
+        # source gets samples in its own way.
+        sensor = SimpleSensor(source_in=source,
+                              batch_size=b_size,
+                              queue_size=2,
+                              num_threads=4,
+                              sampler="sequence",
+                              name="sensor")
+        with mock.patch.object(source, "get", wraps=source.get) as get:
+            sensor.setup()
+            d = sensor.forward()
+            self.assertTrue(get.call_count >= 4)
+        for t in zip(A.eval(d), A.eval(d_ref)):
+            self.assertNdarrayEquals(t[0], t[1])
+
+        sensor.teardown()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_distributed_sampler(self):
+        source = MNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        b_size = 32
+        sensors = [SimpleSensor(source_in=source,
+                                batch_size=b_size,
+                                queue_size=2,
+                                sampler="distributed_shuffle",
+                                sampler_kwargs={"rank": i, "world_size": 2},
+                                name="sensor")
+                   for i in range(2)]
+        # Each sensor iterates half of the dataset.
+        for sensor in sensors:
+            self.assertEquals(sensor.num_batches_per_epoch,
+                              (source.size // 2 - 1) // b_size + 1)
+        # Shards are disjoint.
+        indices = []
+        for sensor in sensors:
+            sensor.setup()
+            indices.append(set(sensor.sampler.indices.tolist()))
+            sensor.teardown()
+        self.assertEquals(len(indices[0] & indices[1]), 0)
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_state_dict(self):
+        source = MNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        sensor = SimpleSensor(source_in=source,
+                              batch_size=32,
+                              queue_size=4,
+                              name="sensor")
+        sensor.setup()
+        for i in range(10):
+            sensor.forward()
+        state = sensor.state_dict()
+        labels = [A.eval(sensor.forward()[1]) for i in range(3)]
+        sensor.teardown()
+
+        # A new sensor resumes from the batch after the last one taken, though
+        # more batches have been prefetched.
+        sensor = SimpleSensor(source_in=source,
+                              batch_size=32,
+                              queue_size=4,
+                              name="sensor")
+        sensor.setup()
+        sensor.load_state_dict(state)
+        for l in labels:
+            self.assertNdarrayEquals(A.eval(sensor.forward()[1]), l)
+        sensor.teardown()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_normalize(self):
+        source = MNISTSource(work_dir="data", name="source")
+        source.setup()
+        raw_source = MNISTSource(work_dir="data", normalize=False, name="raw_source")
+        raw_source.setup()
+        self.assertEquals(raw_source.get([0])[0].dtype, th.uint8)
+
+        # Normalizing uint8 batches in the sensor gives the same as normalizing
+        # each image in the source.
+        for cls in [SimpleSensor, ParallelSensor]:
+            sensor = cls(source_in=raw_source,
+                         batch_size=32,
+                         sampler="sequence",
+                         normalize=True,
+                         name="sensor")
+            sensor.setup()
+            d = sensor.forward()
+            d_ref = source.get(list(range(32)))
+            self.assertTensorAlmostEquals(d[0], d_ref[0], places=5)
+            sensor.teardown()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_stager(self):
+        from akid.core.sensors import _DeviceStager
+        images = np.zeros((4, 1, 2, 2), dtype=np.float32)
+        labels = np.arange(4)
+        stager = _DeviceStager()
+        data = stager.stage([images, labels])
+        self.assertEquals(data[1].dtype, th.int64)
+        if A.use_cuda():
+            self.assertEquals(data[0].device.type, "cuda")
+        else:
+            # Arrays are wrapped without copy on CPU.
+            images[0] = 1
+            self.assertEquals(int(data[0][0].sum()), 4)
+
+        # Arrays are float32 as `A.Tensor` gives, unless they are int64, or
+        # images normalized by the stager.
+        images = np.full((4, 1, 2, 2), 255, dtype=np.uint8)
+        data = stager.stage([images, labels.astype(np.int32)])
+        self.assertEquals([d.dtype for d in data], [th.float32, th.float32])
+        stager = _DeviceStager(normalization=((0.5,), (0.5,)))
+        data = stager.stage([images, labels.astype(np.float64)])
+        self.assertEquals(data[1].dtype, th.float32)
+        self.assertTensorAlmostEquals(data[0].cpu(), th.ones(4, 1, 2, 2), places=5)
+
+        # Batches of different shapes reuse the buffers.
+        data = stager.stage([th.ones(2, 3), th.arange(2)])
+        self.assertEquals(tuple(data[0].shape), (2, 3))
+        self.assertTensorEquals(data[1].cpu(), th.arange(2))
+
     @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
     def test_summary(self):
         source = MNISTSource(work_dir="data", name="source")
@@ -129,6 +303,19 @@ class TestSimpleSensor(AKidTestCase):
         sensor.teardown()
 
 
+class SlowMNISTSource(MNISTSource):
+    def get(self, indices):
+        time.sleep(0.05)
+        return super(SlowMNISTSource, self).get(indices)
+
+
+class JitteryMNISTSource(MNISTSource):
+    def get(self, indices):
+        # Earlier batches take longer, so they arrive out of order.
+        time.sleep(0.1 / (1 + indices[0] // 32 % 4))
+        return super(JitteryMNISTSource, self).get(indices)
+
+
 class TestParallelSensor(AKidTestCase):
     def setUp(self):
         A.reset()
@@ -192,6 +379,398 @@ class TestParallelSensor(AKidTestCase):
 
         sensor.teardown()
 
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_shared_memory(self):
+        source = MNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        b_size = 32
+        sensor = ParallelSensor(source_in=source,
+                                batch_size=b_size,
+                                queue_size=2,
+                                num_workers=2,
+                                shared_memory=True,
+                                sampler="sequence",
+                                name="sensor")
+        sensor.setup()
+
+        d = sensor.forward()
+        d_ref = source.get(list(range(b_size)))
+        for t in zip(A.eval(d), A.eval(d_ref)):
+            self.assertNdarrayEquals(t[0], t[1])
+
+        # Iterate through an epoch to recycle the slots many times.
+        for b in sensor:
+            pass
+        sensor.forward()
+
+        sensor.teardown()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_persistent_workers(self):
+        source = MNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        b_size = 32
+        sensor = ParallelSensor(source_in=source,
+                                batch_size=b_size,
+                                val_batch_size=b_size,
+                                queue_size=2,
+                                num_workers=1,
+                                persistent_workers=True,
+                                sampler="sequence",
+                                name="sensor")
+        sensor.setup()
+        sensor.forward()
+        pids = [p.pid for p in sensor.worker_processes]
+
+        # Validation starts from the beginning of the validation set each time.
+        for i in range(2):
+            sensor.set_mode("val")
+            sensor.reset()
+            sensor.forward()
+            d = sensor.forward()
+            d_ref = source.get(list(range(b_size, 2 * b_size)))
+            for t in zip(A.eval(d), A.eval(d_ref)):
+                self.assertNdarrayEquals(t[0], t[1])
+
+        # Training resumes where it stops, with the same workers.
+        sensor.set_mode("train")
+        sensor.setup()
+        self.assertEquals([p.pid for p in sensor.worker_processes], pids)
+        d = sensor.forward()
+        d_ref = source.get(list(range(b_size, 2 * b_size)))
+        for t in zip(A.eval(d), A.eval(d_ref)):
+            self.assertNdarrayEquals(t[0], t[1])
+
+        sensor.teardown()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_val_on_device(self):
+        source = MNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        b_size = 32
+        sensor = ParallelSensor(source_in=source,
+                                batch_size=b_size,
+                                val_batch_size=b_size,
+                                queue_size=2,
+                                num_workers=1,
+                                val_on_device=True,
+                                sampler="sequence",
+                                name="sensor")
+        sensor.setup()
+        sensor.forward()
+        pids = [p.pid for p in sensor.worker_processes]
+
+        # The validation set is fetched once, and batches are its slices.
+        with mock.patch.object(source, "get", wraps=source.get) as get:
+            for i in range(2):
+                sensor.set_mode("val")
+                sensor.reset()
+                sensor.forward()
+                d = sensor.forward()
+                d_ref = source.get(list(range(b_size, 2 * b_size)))
+                for t in zip(A.eval(d), A.eval(d_ref)):
+                    self.assertNdarrayEquals(t[0], t[1])
+            num_gets = -(-source.size // b_size) + 2
+            self.assertEquals(get.call_count, num_gets)
+            self.assertEquals(sum(len(b[1]) for b in sensor), source.size - 2 * b_size)
+            self.assertEquals(get.call_count, num_gets)
+
+        # Training resumes where it stops, with the same workers.
+        sensor.set_mode("train")
+        sensor.setup()
+        self.assertEquals([p.pid for p in sensor.worker_processes], pids)
+        d = sensor.forward()
+        d_ref = source.get(list(range(b_size, 2 * b_size)))
+        for t in zip(A.eval(d), A.eval(d_ref)):
+            self.assertNdarrayEquals(t[0], t[1])
+
+        sensor.teardown()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_prefetch_across_epochs(self):
+        source = MNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        sensor = ParallelSensor(source_in=source,
+                                batch_size=1000,
+                                queue_size=2,
+                                num_workers=4,
+                                prefetch_across_epochs=True,
+                                name="sensor")
+        sensor.setup()
+
+        # Each iteration stops exactly at the end of an epoch, though batches
+        # of the next epoch are being fetched.
+        for i in range(3):
+            num_batches, num_samples = 0, 0
+            for b in sensor:
+                num_batches += 1
+                num_samples += b[1].shape[0]
+            self.assertEquals(num_batches, sensor.num_batches_per_epoch)
+            self.assertEquals(num_samples, source.size)
+
+        sensor.forward()
+
+        sensor.teardown()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_break_iteration(self):
+        source = MNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        sensor = ParallelSensor(source_in=source,
+                                batch_size=50,
+                                queue_size=2,
+                                num_workers=2,
+                                name="sensor")
+        sensor.setup()
+
+        # Stop iterating with batches of the epoch left in flight.
+        for i, b in enumerate(sensor):
+            if i == sensor.num_batches_per_epoch - 3:
+                break
+        # The depth of prefetching is restored when data crunching goes on.
+        for i in range(5):
+            sensor.forward()
+            self.assertEquals(len(sensor._dispatched), sensor.prefetch_depth)
+
+        sensor.teardown()
+
+    def test_tuner(self):
+        from akid.core.sensors import _PrefetchTuner
+        tuner = _PrefetchTuner(2, 4, num_workers=2, max_workers=3, max_bytes=300, window=2)
+        # Fetching takes longer than computing, so a worker is added.
+        tuner.fetched(2)
+        self.assertEquals(tuner.taken(0, 0, 0, 100), (0, 0))
+        self.assertEquals(tuner.taken(1, 0.5, 0, 100), (0, 0))
+        self.assertEquals(tuner.taken(2, 0.5, 0, 100), (1, 1))
+        # No more workers could be added, and the depth is bounded by the
+        # bytes allowed.
+        tuner.fetched(2)
+        self.assertEquals(tuner.taken(3, 0.5, 0, 100), (0, 0))
+        self.assertEquals(tuner.taken(4, 0.5, 0, 100), (0, 0))
+        self.assertEquals((tuner.depth, tuner.num_workers), (3, 3))
+        # Batches are always ready, and fetching is fast.
+        tuner.fetched(0.1)
+        tuner.taken(5, 0, 2, 100)
+        self.assertEquals(tuner.taken(6, 0, 3, 100), (-1, -1))
+        self.assertEquals((tuner.depth, tuner.num_workers), (2, 2))
+        # Batches grow larger, and the depth is decreased by one for each
+        # batch taken, since only one batch less could be put in flight.
+        tuner = _PrefetchTuner(4, 4, max_bytes=400, window=2)
+        self.assertEquals(tuner.taken(0, 0, 0, 100), (0, 0))
+        self.assertEquals(tuner.taken(1, 0, 0, 400), (-1, 0))
+        self.assertEquals(tuner.taken(2, 0, 0, 400), (-1, 0))
+        self.assertEquals(tuner.taken(3, 0, 0, 400), (-1, 0))
+        self.assertEquals(tuner.taken(4, 0, 0, 400), (0, 0))
+        self.assertEquals(tuner.depth, 1)
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_ordered(self):
+        source = JitteryMNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        b_size = 32
+        sensor = ParallelSensor(source_in=source,
+                                batch_size=b_size,
+                                queue_size=2,
+                                num_workers=4,
+                                ordered=True,
+                                persistent_workers=True,
+                                sampler="sequence",
+                                name="sensor")
+        sensor.setup()
+        labels = A.eval(source.get(list(range(source.size)))[1])
+        num_batches = sensor.num_batches_per_epoch
+        for i in range(num_batches + 2):
+            d = sensor.forward()
+            j = i % num_batches
+            self.assertNdarrayEquals(A.eval(d[1]), labels[j * b_size:(j + 1) * b_size])
+
+        # Batches are in order after starting over, and when iterating.
+        sensor.reset()
+        for i in range(3):
+            self.assertNdarrayEquals(A.eval(sensor.forward()[1]),
+                                     labels[i * b_size:(i + 1) * b_size])
+        self.assertNdarrayEquals(np.concatenate([A.eval(b[1]) for b in sensor]),
+                                 labels[3 * b_size:])
+        sensor.teardown()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_auto_tune(self):
+        source = SlowMNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        sensor = ParallelSensor(source_in=source,
+                                batch_size=32,
+                                queue_size=1,
+                                num_workers=1,
+                                max_workers=3,
+                                sampler="sequence",
+                                auto_tune=True,
+                                name="sensor")
+        sensor.setup()
+        for i in range(100):
+            sensor.forward()
+        # Workers are added since fetching is slower than computing.
+        self.assertEquals(sensor.tuned_settings["num_workers"], 3)
+        self.assertEquals(len([p for p in sensor.worker_processes if p.is_alive()]), 3)
+        sensor.teardown()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_metrics(self):
+        source = SlowMNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        sensor = ParallelSensor(source_in=source,
+                                batch_size=32,
+                                queue_size=1,
+                                num_workers=2,
+                                sampler="sequence",
+                                name="sensor")
+        sensor.setup()
+        for i in range(10):
+            sensor.forward()
+        metrics = sensor.metrics.snapshot()
+        self.assertEquals(metrics["num_steps"], 10)
+        self.assertEquals(sum(metrics["queue_occupancy"]), 10)
+        # The consumer stalls for the slow source.
+        self.assertGreater(metrics["latency"]["fetch"], 0.05)
+        self.assertGreater(metrics["latency"]["wait"], 0)
+        self.assertEquals(sorted(metrics["worker_utilization"].keys()), [0, 1])
+        for u in metrics["worker_utilization"].values():
+            self.assertGreater(u, 0.3)
+
+        with mock.patch.object(A.summary, "add_scalar") as add_scalar:
+            sensor.metrics.summarize(sensor.name, 1)
+        names = [c[1]["name"] for c in add_scalar.call_args_list]
+        assert "sensor/fetch_latency" in names
+        assert "sensor/worker_1_utilization" in names
+        sensor.teardown()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_dead_workers(self):
+        source = MNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        sensor = ParallelSensor(source_in=source,
+                                batch_size=32,
+                                queue_size=2,
+                                num_workers=2,
+                                sampler="sequence",
+                                name="sensor")
+        sensor.setup()
+        sensor.forward()
+
+        # The death of a worker is reported by the sensor, instead of data
+        # fetching blocking forever. A batch in flight from the worker may
+        # also fail the preloading thread first.
+        os.kill(sensor.worker_processes[0].pid, signal.SIGKILL)
+        with self.assertRaises((DataPrefetchProcessesDeadEvent, DataPrefetchThreadsDeadEvent)):
+            for _ in range(sensor.num_batches_per_epoch):
+                sensor.forward()
+
+        sensor.teardown()
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_failed_staging(self):
+        source = MNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        stage = _DeviceStager.stage
+        calls = []
+        def fail_third(stager, data):
+            calls.append(None)
+            if len(calls) == 3:
+                raise RuntimeError("Staging fails.")
+            return stage(stager, data)
+
+        with mock.patch.object(_DeviceStager, "stage", autospec=True, side_effect=fail_third):
+            sensor = ParallelSensor(source_in=source,
+                                    batch_size=32,
+                                    queue_size=2,
+                                    num_workers=1,
+                                    sampler="sequence",
+                                    name="sensor")
+            sensor.setup()
+
+            # A failure of the preloading thread is reported by the sensor,
+            # instead of data fetching blocking forever.
+            with self.assertRaises(DataPrefetchThreadsDeadEvent):
+                for _ in range(sensor.num_batches_per_epoch):
+                    sensor.forward()
+
+            sensor.teardown()
+
+def read_shard(shard):
+    for x in shard:
+        yield [np.full((2, 2), x, dtype=np.float32), x]
+
+
+class TestStreamingSensor(AKidTestCase):
+    def setUp(self):
+        A.reset()
+        self.use_cuda_save = A.use_cuda()
+        A.use_cuda(False)
+
+    def tearDown(self):
+        A.use_cuda(self.use_cuda_save)
+        A.reset()
+
+    @skipUnless(A.backend() == A.TORCH)
+    def test_iterator(self):
+        from akid import StreamSource, StreamingSensor
+        shards = [np.arange(25 * i, 25 * i + 25) for i in range(4)]
+        source = StreamSource(train_shards=shards,
+                              read_fn=read_shard,
+                              sizes={"train": 100},
+                              name="source")
+        sensor = StreamingSensor(source_in=source,
+                                 batch_size=10,
+                                 num_workers=3,
+                                 buffer_size=20,
+                                 name="sensor")
+        sensor.setup()
+        self.assertEquals(sensor.num_batches_per_epoch, 10)
+        orders = []
+        for epoch in range(2):
+            labels = np.concatenate([A.eval(b[1]) for b in sensor])
+            self.assertEquals(sorted(labels), list(range(100)))
+            orders.append(labels)
+        self.assertEquals(sensor.epoch, 2)
+        assert (orders[0] != orders[1]).any()
+
+        # Batches go on across epochs when not iterating.
+        for i in range(15):
+            d = sensor.forward()
+        self.assertTensorEquals(d[0][:, 0, 0].long(), d[1])
+        sensor.teardown()
+
+    @skipUnless(A.backend() == A.TORCH)
+    def test_distributed(self):
+        from akid import StreamSource, StreamingSensor
+        shards = [np.arange(10 * i, 10 * i + 10) for i in range(5)]
+        labels = []
+        for rank in range(2):
+            source = StreamSource(train_shards=shards, read_fn=read_shard, name="source")
+            sensor = StreamingSensor(source_in=source,
+                                     batch_size=4,
+                                     num_workers=4,
+                                     rank=rank,
+                                     world_size=2,
+                                     name="sensor")
+            sensor.setup()
+            # No more workers than shards.
+            self.assertEquals(len(sensor.worker_processes), 3 - rank)
+            labels.append(np.concatenate([A.eval(b[1]) for b in sensor]))
+            sensor.teardown()
+        # Ranks stream disjoint shards.
+        self.assertEquals(sorted(np.concatenate(labels)), list(range(50)))
+
+
 class TestFeedSensor(AKidTestCase):
     def setUp(self):
         super(TestFeedSensor, self).setUp()
@@ -2,6 +2,8 @@ from __future__ import absolute_import
 from __future__ import print_function
 import seaborn as sns
 import matplotlib.pyplot as plt
+import os
+import time
 import numpy as np
 import tensorflow as tf
 
@@ -16,6 +18,49 @@ from akid import backend as A
 from six.moves import range
 
 
+def serve_ranges(directory, delay_first=None):
+    """
+    Serve files of `directory` over HTTP with range requests in a thread.
+    Return the server, and the list of paths requested. The first request of
+    `delay_first` is delayed by two seconds.
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            requested.append(self.path)
+            if self.path == delay_first and requested.count(self.path) == 1:
+                time.sleep(2)
+            path = os.path.join(directory, self.path.lstrip("/"))
+            if not os.path.exists(path):
+                self.send_error(404)
+                return
+            with open(path, "rb") as f:
+                data = f.read()
+            status = 200
+            if "Range" in self.headers:
+                start, end = self.headers["Range"][len("bytes="):].split("-")
+                data = data[int(start):int(end) + 1]
+                status = 206
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, requested
+
+
 class TestSource(AKidTestCase):
     def setUp(self):
         A.reset()
@@ -269,5 +314,298 @@ class TestSource(AKidTestCase):
                       source.val_datum,
                       source.val_label])
 
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_mnist_bulk_fetch(self):
+        from torch.utils.data.dataloader import default_collate
+        from akid import MNISTSource
+        source = MNISTSource(work_dir="data", name="source")
+        source.setup()
+
+        # Batches gathered in bulk are the same with the ones collated sample
+        # by sample.
+        indices = [3, 1000, 7, 42]
+        d = source.get(indices)
+        d_ref = default_collate([source.data[i] for i in indices])
+        for t in zip(A.eval(d), A.eval(d_ref)):
+            self.assertNdarrayEquals(t[0], t[1])
+
+    @skipUnless(A.backend() == A.TORCH)
+    def test_in_memory_source(self):
+        from akid import InMemorySource
+        images = np.arange(20).reshape(10, 2)
+        labels = np.arange(10)
+        source = InMemorySource(train_data=[images, labels],
+                                val_data=[images[:5], labels[:5]],
+                                name="source")
+        source.setup()
+        self.assertEquals(source.size, 10)
+        d = source.get([9, 0, 4])
+        self.assertNdarrayEquals(d[0], images[[9, 0, 4]])
+        self.assertNdarrayEquals(d[1], labels[[9, 0, 4]])
+
+        source.set_mode("val")
+        source.setup()
+        self.assertEquals(source.size, 5)
+
+    @skipUnless(A.backend() == A.TORCH)
+    def test_subset_source(self):
+        from akid import InMemorySource, SubsetSource
+        labels = np.arange(30) % 3
+        images = np.arange(30) * 10
+        source = InMemorySource(train_data=[images, labels],
+                                val_data=[images[:6], labels[:6]],
+                                name="source")
+        source.setup()
+        index = source.label_index()
+        self.assertEquals(sorted(index.keys()), [0, 1, 2])
+        self.assertNdarrayEquals(index[1], np.arange(1, 30, 3))
+
+        subset = source.subset(classes=[0, 2], num_per_class=2, name="subset")
+        subset.setup()
+        self.assertNdarrayEquals(subset.data, np.array([0, 2, 3, 5]))
+        d = subset.get([3, 0])
+        self.assertNdarrayEquals(d[0], np.array([50, 0]))
+        self.assertNdarrayEquals(d[1], np.array([2, 0]))
+        self.assertNdarrayEquals(subset.labels, np.array([0, 2, 0, 2]))
+
+        # Subsets follow the mode of the view.
+        subset.set_mode("val")
+        subset.setup()
+        self.assertNdarrayEquals(subset.data, np.array([0, 2, 3, 5]))
+        self.assertEquals(source.mode, "val")
+
+        subset = SubsetSource(source_in=source,
+                              predicate=lambda c: c != 0,
+                              num_per_class={1: 5},
+                              seed=0,
+                              name="subset")
+        subset.setup()
+        self.assertEquals(subset.size, 15)
+        self.assertEquals((subset.labels == 1).sum(), 5)
+        self.assertEquals(sorted(set(subset.labels)), [1, 2])
+
+    @skipUnless(A.backend() == A.TORCH)
+    def test_array_cache(self):
+        import shutil
+        import tempfile
+        from akid import ArrayCache
+        cache_dir = tempfile.mkdtemp()
+        images = np.arange(60, dtype=np.uint8).reshape(10, 3, 2)
+        labels = np.arange(10)
+
+        built = []
+        def build():
+            built.append(True)
+            return [images, labels]
+
+        # The arrays are only built the first time, and memory mapped after.
+        for i in range(2):
+            cache = ArrayCache(cache_dir)
+            arrays = cache.get("toy", build)
+            self.assertEquals(len(built), 1)
+            self.assertTrue(isinstance(arrays[0], np.memmap))
+            self.assertNdarrayEquals(arrays[0], images)
+            self.assertNdarrayEquals(arrays[1], labels)
+
+        shutil.rmtree(cache_dir)
+
+    @skipUnless(A.backend() == A.TORCH, msg="Currently MNISTSource depends on torch")
+    def test_mnist_cache(self):
+        from akid import MNISTSource
+        source = MNISTSource(work_dir="data", name="source")
+        source.setup()
+        cached_source = MNISTSource(use_cache=True, work_dir="data", name="cached_source")
+        cached_source.setup()
+
+        indices = [3, 1000, 7, 42]
+        for t in zip(A.eval(cached_source.get(indices)), A.eval(source.get(indices))):
+            self.assertNdarrayEquals(t[0], t[1])
+
+        # The arrays of a mode are used once it is set, before set up.
+        cached_source.set_mode(A.Mode.VAL)
+        source.set_mode(A.Mode.VAL)
+        self.assertEquals(cached_source.size, source.size)
+        self.assertEquals(len(cached_source.bulk_data[1]), source.size)
+
+    @skipUnless(A.backend() == A.TORCH)
+    def test_shared_lru_cache(self):
+        import multiprocessing
+        from akid import SharedLRUCache
+        cache = SharedLRUCache(num_keys=10, budget_bytes=300, slot_bytes=100)
+
+        # An array cached by a forked process is visible to others.
+        p = multiprocessing.Process(
+            target=cache.put, args=(0, np.full((10, 10), 0, dtype=np.uint8)))
+        p.start()
+        p.join()
+        self.assertNdarrayEquals(cache.get(0), np.full((10, 10), 0))
+
+        # The least recently used one is evicted when the cache is full.
+        for k in range(1, 3):
+            cache.put(k, np.full((10, 10), k, dtype=np.uint8))
+        cache.get(0)
+        cache.put(3, np.full((5, 4), 3, dtype=np.uint8))
+        self.assertTrue(cache.get(1) is None)
+        self.assertEquals(cache.get(3).shape, (5, 4))
+        for k in [0, 2]:
+            self.assertNdarrayEquals(cache.get(k), np.full((10, 10), k))
+
+        # Arrays larger than a slot are not cached.
+        cache.put(4, np.zeros((11, 10), dtype=np.uint8))
+        self.assertTrue(cache.get(4) is None)
+
+        # Keys cached are the same as the ones of an LRU dict.
+        from collections import OrderedDict
+        cache = SharedLRUCache(num_keys=50, budget_bytes=500, slot_bytes=100)
+        ref = OrderedDict()
+        rng = np.random.RandomState(0)
+        for _ in range(1000):
+            k = rng.randint(50)
+            if rng.rand() < 0.5:
+                self.assertEquals(cache.get(k) is None, k not in ref)
+                if k in ref:
+                    ref.move_to_end(k)
+            elif k not in ref:
+                cache.put(k, np.full((2, 2), k, dtype=np.uint8))
+                ref[k] = None
+                if len(ref) > 5:
+                    ref.popitem(last=False)
+        for k in range(50):
+            self.assertEquals(cache.get(k) is None, k not in ref)
+
+    @skipUnless(A.backend() == A.TORCH)
+    def test_stream_source(self):
+        from akid import StreamSource
+        from akid.core.sources import shuffle_buffer
+
+        # Samples only move within the buffer.
+        rng = np.random.default_rng(0)
+        samples = list(shuffle_buffer(iter(range(100)), 10, rng))
+        self.assertEquals(sorted(samples), list(range(100)))
+        self.assertNotEquals(samples, list(range(100)))
+        for i, x in enumerate(samples):
+            self.assertTrue(x <= i + 10)
+
+        shards = [np.arange(10 * i, 10 * i + 10) for i in range(3)]
+        source = StreamSource(train_shards=shards,
+                              read_fn=lambda shard: ([x, x % 2] for x in shard),
+                              name="source")
+        source.setup()
+        self.assertEquals(source.size, None)
+        samples = list(source.stream(source.data))
+        self.assertEquals([s[0] for s in samples], list(range(30)))
+        d = source.collate(samples[:4])
+        self.assertNdarrayEquals(A.eval(d[1]), np.array([0, 1, 0, 1]))
+        with self.assertRaises(NotImplementedError):
+            source.get([0])
+
+    @skipUnless(A.backend() == A.TORCH)
+    def test_records(self):
+        import shutil
+        import tempfile
+        from akid import RecordSource, write_records
+        work_dir = tempfile.mkdtemp()
+        images = np.arange(10 * 6, dtype=np.uint8).reshape(10, 3, 2)
+        labels = np.arange(10)
+        dataset = [[images[i], labels[i]] for i in range(10)]
+
+        write_records(dataset, os.path.join(work_dir, "train"), num_shards=3, num_workers=2)
+        source = RecordSource(train_records=os.path.join(work_dir, "train"), name="source")
+        source.setup()
+        self.assertEquals(source.size, 10)
+        self.assertEquals(len(source.data), 3)
+        indices = [9, 0, 4, 5, 3]
+        d = source.get(indices)
+        self.assertNdarrayEquals(A.eval(d[0]), images[indices])
+        self.assertNdarrayEquals(A.eval(d[1]), labels[indices])
+        # Shards are streamed in order.
+        samples = list(source.stream(source.data))
+        self.assertEquals([int(s[1]) for s in samples], list(range(10)))
+
+        # Variable fields.
+        dataset = [[np.arange(i), i] for i in range(5)]
+        write_records(dataset, os.path.join(work_dir, "val"), fields=[("int64", None), ("int64", [])])
+        source = RecordSource(val_records=os.path.join(work_dir, "val"), name="source")
+        source.set_mode("val")
+        source.setup()
+        d = source.get([3, 1])
+        self.assertNdarrayEquals(A.eval(d[0][0]), np.arange(3))
+        self.assertNdarrayEquals(A.eval(d[0][1]), np.arange(1))
+        self.assertNdarrayEquals(A.eval(d[1]), np.array([3, 1]))
+
+        shutil.rmtree(work_dir)
+
+    @skipUnless(A.backend() == A.TORCH)
+    def test_remote_records(self):
+        import asyncio
+        import shutil
+        import tempfile
+        from akid import RemoteRecordSource, write_records, ParallelSensor
+        use_cuda_save = A.use_cuda()
+        A.use_cuda(False)
+        work_dir = tempfile.mkdtemp()
+        cache_dir = tempfile.mkdtemp()
+        images = np.arange(100 * 6, dtype=np.uint8).reshape(100, 3, 2)
+        labels = np.arange(100)
+        write_records([[images[i], labels[i]] for i in range(100)],
+                      os.path.join(work_dir, "train"), num_shards=2)
+        server, requested = serve_ranges(
+            work_dir, delay_first="/train-00001-of-00002.rec")
+        url = "http://127.0.0.1:{}/train".format(server.server_port)
+
+        # Blocks hold 4 records, and the first request of the second shard
+        # is slow, which is hedged.
+        source = RemoteRecordSource(train_records=url,
+                                    cache_dir=cache_dir,
+                                    block_size=56,
+                                    hedge_after=0.2,
+                                    name="source")
+        source.setup()
+        self.assertEquals(source.size, 100)
+        indices = [99, 0, 1, 2, 3, 4, 55]
+        start = time.time()
+        d = source.get(indices)
+        self.assertLess(time.time() - start, 1.5)
+        self.assertNdarrayEquals(A.eval(d[0]), images[indices])
+        self.assertNdarrayEquals(A.eval(d[1]), labels[indices])
+        # Contiguous blocks of the first shard are fetched by one request.
+        self.assertEquals(requested.count("/train-00000-of-00002.rec"), 1)
+
+        # Blocks are read from the cache afterwards.
+        num_requests = len(requested)
+        d = source.get([3, 55])
+        self.assertNdarrayEquals(A.eval(d[1]), np.array([3, 55]))
+        self.assertEquals(len(requested), num_requests)
+
+        sensor = ParallelSensor(source_in=source,
+                                batch_size=10,
+                                num_workers=2,
+                                sampler="sequence",
+                                name="sensor")
+        sensor.setup()
+        labels = np.concatenate([A.eval(b[1]) for b in sensor])
+        self.assertEquals(sorted(labels), list(range(100)))
+        # Event loops and connections are closed along with the sensor.
+        loops = [l for l, _ in source._loops.values()]
+        sensor.teardown()
+        self.assertEquals(len(source._loops), 0)
+        assert all(l.is_closed() for l in loops)
+
+        # When the request of a shard fails, the one of the other shard is
+        # still waited for.
+        os.remove(os.path.join(work_dir, "train-00001-of-00002.rec"))
+        source = RemoteRecordSource(train_records=url, num_retries=0, name="source")
+        source.setup()
+        with self.assertRaises(IOError):
+            source.get([40, 80])
+        loop = list(source._loops.values())[0][0]
+        self.assertEquals(len(asyncio.all_tasks(loop)), 0)
+        source.teardown()
+
+        server.shutdown()
+        shutil.rmtree(work_dir)
+        shutil.rmtree(cache_dir)
+        A.use_cuda(use_cuda_save)
+
 if __name__ == "__main__":
     main()